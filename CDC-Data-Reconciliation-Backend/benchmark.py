@@ -0,0 +1,186 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import compare
+import create_benchmark_data
+import metrics
+import report_db
+
+# Benchmark of a whole report on generated data, timed phase by phase. Results can be stored as a named baseline
+# and later runs compared against it, so a change that makes compare.py or server.py slower shows up
+
+baselines_folder = os.path.join(os.path.dirname(__file__), "benchmarks")
+
+PHASES = ['load', 'dedup', 'compare', 'write', 'persist']
+
+# A phase only counts as slower than its baseline if it is both this much slower relatively and in seconds,
+# so tiny phases do not fail the comparison because of timer noise
+DEFAULT_TOLERANCE = 0.15
+MIN_DIFFERENCE = 0.05
+
+def prepare_data(data_dir, params):
+    """
+    Generates the benchmark files into data_dir, unless it already has files made with the same parameters.
+    Returns the CDC and State file paths and the generator's summary.
+    """
+    cdc_path = os.path.join(data_dir, "cdc_bench.csv")
+    state_path = os.path.join(data_dir, "state_bench.csv")
+    params_path = os.path.join(data_dir, "params.json")
+    if os.path.exists(params_path) and os.path.exists(cdc_path) and os.path.exists(state_path):
+        with open(params_path, "r") as f:
+            saved = json.load(f)
+        if saved["params"] == params:
+            return cdc_path, state_path, saved["summary"]
+
+    os.makedirs(data_dir, exist_ok=True)
+    print(f"Generating {params['cases']} cases into {data_dir}")
+    summary = create_benchmark_data.generate(cdc_path, state_path, **params)
+    with open(params_path, "w") as f:
+        json.dump({"params": params, "summary": summary}, f, indent=2)
+    return cdc_path, state_path, summary
+
+def run_once(cdc_path, state_path, filterCDC, work_dir):
+    """
+    Runs one report the way the server does (python engine) and returns the seconds each phase took, and the stats.
+    load reads and indexes the CDC file, dedup reads the State file and keeps the latest row per case, compare is
+    Reconciler.comp, write is results.csv / stats.csv and persist is saving the report into a new SQLite database.
+    """
+    timings = {}
+    reconciler = compare.Reconciler()
+    cdc_layout, state_layout = compare.row_layouts(compare.read_header(cdc_path), compare.read_header(state_path))
+
+    start = time.perf_counter()
+    cdc_dict, cdcEventCodes = reconciler.index_cdc_records(compare.read_records(cdc_path, cdc_layout), filterCDC)
+    timings['load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    state_dict = compare.get_state_dict(state_path, state_layout, cdcEventCodes)
+    timings['dedup'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reconciler.comp(state_dict, cdc_dict, state_layout, cdc_layout)
+    timings['compare'] = time.perf_counter() - start
+    del state_dict, cdc_dict
+
+    start = time.perf_counter()
+    compare.write_results(reconciler.results, os.path.join(work_dir, "results.csv"))
+    compare.write_stats(reconciler.stats, os.path.join(work_dir, "stats.csv"))
+    timings['write'] = time.perf_counter() - start
+
+    # The report goes into a database of its own in work_dir, the way server.save_report stores it (without an archive)
+    conn = report_db.connect(os.path.join(work_dir, "benchmark.db"))
+    report_db.setup(conn)
+    start = time.perf_counter()
+    report_id = report_db.insert_report(conn, len(reconciler.results), "Benchmark")
+    report_db.insert_cases(conn, ((report_id,) + result.as_tuple() for result in reconciler.results))
+    report_db.insert_statistics(conn, [(report_id,) + row for row in compare.stats_rows(reconciler.stats)])
+    timings['persist'] = time.perf_counter() - start
+    conn.close()
+
+    return timings, reconciler.stats
+
+def check_stats(stats, summary):
+    # The generator knows how many discrepancies of each kind it made, the comparison has to find exactly those
+    expected = {'totalDuplicates': summary['duplicates'], 'totalMissingCDC': summary['missingCDC'],
+                'totalMissingState': summary['missingState'], 'totalWrongAttributes': summary['mismatched']}
+    found = {key: sum(data[key] for data in stats.values()) for key in expected}
+    return [f"{key}: expected {expected[key]}, found {found[key]}" for key in expected if expected[key] != found[key]]
+
+def compare_to_baseline(result, baseline, tolerance):
+    # Returns the phases that got slower than the baseline allows
+    regressions = []
+    for phase in PHASES:
+        now, then = result["phases"][phase], baseline["phases"][phase]
+        if now > then * (1 + tolerance) and now - then > MIN_DIFFERENCE:
+            regressions.append(phase)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(prog="Benchmark", description='Time every phase of a report on generated data')
+    parser.add_argument('-n', '--cases', type=int, default=200000, help='Number of cases to generate')
+    parser.add_argument('--duplicate-rate', type=float, default=create_benchmark_data.DEFAULTS['duplicate_rate'])
+    parser.add_argument('--missing-cdc-rate', type=float, default=create_benchmark_data.DEFAULTS['missing_cdc_rate'])
+    parser.add_argument('--missing-state-rate', type=float, default=create_benchmark_data.DEFAULTS['missing_state_rate'])
+    parser.add_argument('--mismatch-rate', type=float, default=create_benchmark_data.DEFAULTS['mismatch_rate'])
+    parser.add_argument('--event-codes', type=int, default=create_benchmark_data.DEFAULTS['event_codes'])
+    parser.add_argument('--max-races', type=int, default=create_benchmark_data.DEFAULTS['max_races'])
+    parser.add_argument('--updated-rate', type=float, default=create_benchmark_data.DEFAULTS['updated_rate'])
+    parser.add_argument('--seed', type=int, default=create_benchmark_data.DEFAULTS['seed'])
+    parser.add_argument('-f', '--filter', default=False, action="store_true", help='Filter the State data by the CDC event codes')
+    parser.add_argument('--data-dir', help='Folder to keep the generated files in between runs (a temporary folder if not given)')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of timed runs, the fastest time of each phase is kept')
+    parser.add_argument('--save-baseline', metavar='NAME', help='Store the result as benchmarks/NAME.json')
+    parser.add_argument('--baseline', metavar='NAME', help='Compare the result against benchmarks/NAME.json, exits with 1 if a phase got slower')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='How much slower (0.15 is 15%%) a phase may get')
+    args = parser.parse_args()
+
+    params = {'cases': args.cases, 'duplicate_rate': args.duplicate_rate, 'missing_cdc_rate': args.missing_cdc_rate,
+              'missing_state_rate': args.missing_state_rate, 'mismatch_rate': args.mismatch_rate, 'event_codes': args.event_codes,
+              'max_races': args.max_races, 'updated_rate': args.updated_rate, 'seed': args.seed}
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="benchmark-data-")
+    work_dir = tempfile.mkdtemp(prefix="benchmark-run-")
+    try:
+        cdc_path, state_path, summary = prepare_data(data_dir, params)
+
+        best = {}
+        for run in range(args.repeat):
+            timings, stats = run_once(cdc_path, state_path, args.filter, work_dir)
+            os.remove(os.path.join(work_dir, "benchmark.db"))
+            for phase, seconds in timings.items():
+                best[phase] = min(seconds, best.get(phase, seconds))
+            print(f"run {run + 1}: " + ", ".join(f"{phase} {timings[phase]:.3f}s" for phase in PHASES))
+
+        problems = check_stats(stats, summary)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    result = {
+        "params": dict(params, filter=args.filter),
+        "phases": best,
+        "totalSeconds": sum(best.values()),
+        "peakRSSMB": metrics.peak_rss_mb(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "createdAt": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+    print(f"{summary['cdcRows']} CDC rows, {summary['stateRows']} State rows")
+    for phase in PHASES:
+        print(f"{phase:<8} {best[phase]:8.3f}s")
+    print(f"{'total':<8} {result['totalSeconds']:8.3f}s")
+    if result["peakRSSMB"] is not None:
+        print(f"peak RSS {result['peakRSSMB']:.0f} MB")
+
+    if problems:
+        print("The comparison did not find the discrepancies that were generated:\n  " + "\n  ".join(problems))
+        raise SystemExit(1)
+
+    if args.save_baseline:
+        os.makedirs(baselines_folder, exist_ok=True)
+        with open(os.path.join(baselines_folder, f"{args.save_baseline}.json"), "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"Saved baseline {args.save_baseline}")
+
+    if args.baseline:
+        with open(os.path.join(baselines_folder, f"{args.baseline}.json"), "r") as f:
+            baseline = json.load(f)
+        if baseline["params"] != result["params"]:
+            raise SystemExit(f"Baseline {args.baseline} was run with different parameters: {baseline['params']}")
+        for phase in PHASES:
+            change = result["phases"][phase] / baseline["phases"][phase] - 1 if baseline["phases"][phase] else 0
+            print(f"{phase:<8} {baseline['phases'][phase]:8.3f}s -> {result['phases'][phase]:8.3f}s ({change:+.0%})")
+        regressions = compare_to_baseline(result, baseline, args.tolerance)
+        if regressions:
+            print(f"Slower than baseline {args.baseline}: {', '.join(regressions)}")
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
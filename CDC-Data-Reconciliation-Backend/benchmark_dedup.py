@@ -0,0 +1,74 @@
+import argparse
+import random
+import time
+
+import compare
+
+# Microbenchmark for the State dedup stage (compare.index_state_rows)
+# The rows mimic query.sql's Person_race join: one row per race for every case, mostly with the same add_time
+
+HEADER = compare.STATE_REQUIRED_COLUMNS + ['Race']
+CASE_ID, ADD_TIME, RACE = HEADER.index('CaseID'), HEADER.index('add_time'), HEADER.index('Race')
+
+def generate_rows(num_cases, max_races, changed_rate, seed):
+    rng = random.Random(seed)
+    rows = []
+    for i in range(num_cases):
+        add_time = f"2023-{rng.randint(1, 12):02}-{rng.randint(1, 28):02} {rng.randint(0, 23):02}:{rng.randint(0, 59):02}:{rng.randint(0, 59):02}.{rng.randint(0, 999):03}"
+        for race in range(rng.randint(1, max_races)):
+            # Every so often a case was updated, so its rows carry a different add_time
+            if race > 0 and rng.random() < changed_rate:
+                add_time = f"2023-12-{rng.randint(1, 28):02} {rng.randint(0, 23):02}:{rng.randint(0, 59):02}:{rng.randint(0, 59):02}"
+            rows.append([f"CAS{i:08}GA01", '11065', 'Salmonellosis', '2023', '12', 'Confirmed', add_time, str(race)])
+    return rows
+
+def reference_dedup(rows):
+    # The original dedup loop, which re-parses both add_time values with strptime for every duplicate
+    state_dict = {}
+    for row in rows:
+        if row[CASE_ID] in state_dict:
+            existing_datetime = compare.parse_time(state_dict[row[CASE_ID]][ADD_TIME])
+            new_datetime = compare.parse_time(row[ADD_TIME])
+            if new_datetime > existing_datetime:
+                state_dict[row[CASE_ID]] = row
+        else:
+            state_dict[row[CASE_ID]] = row
+    return state_dict
+
+def best_time(function, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(rows)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(prog="BenchmarkDedup", description='Time the State dedup stage')
+    parser.add_argument('-n', '--cases', type=int, default=200000, help='Number of cases to generate')
+    parser.add_argument('-r', '--races', type=int, default=4, help='Maximum number of rows per case')
+    parser.add_argument('-u', '--updated', type=float, default=0.1, help='Rate of duplicate rows with a different add_time')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs, the best one is reported')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+
+    rows = generate_rows(args.cases, args.races, args.updated, args.seed)
+
+    layout = compare.RowLayout(HEADER, compare.STATE_REQUIRED_COLUMNS, ['Race'])
+    reference_time, reference_dict = best_time(reference_dedup, rows, args.repeat)
+    fast_time, fast_dict = best_time(lambda rows: compare.index_state_rows(rows, layout), rows, args.repeat)
+
+    # index_state_rows keeps records of the rows, the Race tells which row of a case they were made from
+    race = layout.index['Race']
+    if ({key: (row[ADD_TIME], row[RACE]) for key, row in reference_dict.items()} !=
+            {key: (record[compare.ADD_TIME], record[race]) for key, record in fast_dict.items()}):
+        raise SystemExit("index_state_rows kept different rows than the reference dedup")
+
+    print(f"{len(rows)} rows, {len(fast_dict)} cases, {len(rows) - len(fast_dict)} duplicates collapsed")
+    print(f"reference (strptime every duplicate): {reference_time:.3f}s ({len(rows) / reference_time:,.0f} rows/s)")
+    print(f"index_state_rows:                     {fast_time:.3f}s ({len(rows) / fast_time:,.0f} rows/s)")
+    print(f"speedup: {reference_time / fast_time:.1f}x")
+
+if __name__ == "__main__":
+    main()
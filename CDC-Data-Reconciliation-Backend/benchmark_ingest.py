@@ -0,0 +1,76 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import benchmark
+import compare
+import create_benchmark_data
+import metrics
+
+# Microbenchmark for reading the CDC and State files (compare.read_records), csv.reader against fast_csv, and against
+# the Parquet copies of the files the report archive keeps (see parquet_archive).
+# Each reader runs in a fresh process so the peak memory of one does not hide the other's
+
+def read_file(file_path, fast, attributes):
+    header = compare.read_header(file_path)
+    required = compare.STATE_REQUIRED_COLUMNS if 'add_time' in header else compare.CDC_REQUIRED_COLUMNS
+    layout = compare.RowLayout(header, required, attributes if attributes is not None else header)
+    start = time.perf_counter()
+    records = list(compare.read_records(file_path, layout, fast))
+    return time.perf_counter() - start, records
+
+def timed_read(file_path, fast, attributes, repeat):
+    # Runs in a worker process, returns the best time, the peak memory and a checksum of the records
+    best = None
+    for _ in range(repeat):
+        elapsed, records = read_file(file_path, fast, attributes)
+        best = elapsed if best is None else min(best, elapsed)
+        checksum = (len(records), hash(tuple(records)))
+        del records
+    return (best, metrics.peak_rss_mb()) + checksum
+
+def main():
+    parser = argparse.ArgumentParser(prog="BenchmarkIngest", description='Time reading the CDC and State files with csv.reader, fast_csv and from Parquet')
+    parser.add_argument('-n', '--cases', type=int, default=1000000, help='Number of cases to generate')
+    parser.add_argument('-a', '--attributes', nargs='*', help='Attributes to read besides the required columns (all of them if not given)')
+    parser.add_argument('--data-dir', help='Folder to keep the generated files in between runs (a temporary folder if not given)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs, the best one is reported')
+    args = parser.parse_args()
+
+    try:
+        # Without pyarrow compare.read_records would quietly time csv.reader twice
+        import fast_csv  # noqa: F401
+        import parquet_archive
+    except ImportError:
+        raise SystemExit("fast_csv needs pyarrow, install it with pip install pyarrow")
+
+    params = dict(create_benchmark_data.DEFAULTS, cases=args.cases)
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="benchmark-data-")
+    try:
+        cdc_path, state_path, summary = benchmark.prepare_data(data_dir, params)
+        for name, file_path, rows in [("CDC", cdc_path, summary['cdcRows']), ("State", state_path, summary['stateRows'])]:
+            parquet_path = os.path.splitext(file_path)[0] + ".parquet"
+            if not os.path.exists(parquet_path) or os.path.getmtime(parquet_path) < os.path.getmtime(file_path):
+                parquet_archive.write_input(file_path, parquet_path)
+            readers = [("csv.reader", file_path, False), ("fast_csv", file_path, True), ("parquet", parquet_path, True)]
+            results = {}
+            for label, path, fast in readers:
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    results[label] = executor.submit(timed_read, path, fast, args.attributes, args.repeat).result()
+                if results[label][2:] != results["csv.reader"][2:]:
+                    raise SystemExit(f"{label} read different records from the {name} file than csv.reader")
+            print(f"{name} file, {rows} rows, {os.path.getsize(file_path) / 2**20:.1f} MB as CSV, "
+                  f"{os.path.getsize(parquet_path) / 2**20:.1f} MB as Parquet")
+            for label, _, _ in readers:
+                elapsed, peak, _, _ = results[label]
+                print(f"  {label:<10} {elapsed:7.3f}s ({rows / elapsed:,.0f} rows/s, {results['csv.reader'][0] / elapsed:.1f}x), "
+                      f"peak {peak:.0f} MB")
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import argparse
+import os
+import shutil
+import tempfile
+
+import compare
+
+# Checks that blank lines in the CDC and State files do not change the results of any engine: every engine has to
+# give the same results.csv and stats.csv for copies of the files with blank lines added as the python engine gives
+# for the files themselves
+
+def add_blank_lines(source, destination, every):
+    # Copies a CSV file with a blank line after its header, after every `every` rows and at its end
+    with open(source, newline='', encoding='utf-8-sig') as f:
+        lines = f.read().splitlines()
+    with open(destination, 'w', newline='', encoding='utf-8') as f:
+        for i, line in enumerate(lines):
+            f.write(line + '\n')
+            if i % every == 0:
+                f.write('\n')
+        f.write('\n\n')
+
+def run(cdc_file, state_file, output_folder, engine, workers, filterCDC):
+    os.makedirs(output_folder)
+    results, stats = compare.reconcile(cdc_file, state_file, filterCDC, engine=engine, workers=workers)
+    compare.write_results(results, os.path.join(output_folder, 'results.csv'))
+    compare.write_stats(stats, os.path.join(output_folder, 'stats.csv'))
+    return [open(os.path.join(output_folder, name), 'rb').read() for name in ('results.csv', 'stats.csv')]
+
+def main():
+    folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example-data')
+    parser = argparse.ArgumentParser(prog="CheckBlankLines", description='Check every engine against CSV files with blank lines')
+    parser.add_argument('-c', '--cdc', default=os.path.join(folder, 'cdc.csv'), help='Local Path to CDC CSV file')
+    parser.add_argument('-s', '--state', default=os.path.join(folder, 'state.csv'), help='Local Path to State CSV file')
+    parser.add_argument('--every', type=int, default=7, help='Add a blank line after every EVERY rows')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="check-blank-lines-")
+    cdc_file, state_file = os.path.join(work_dir, 'cdc.csv'), os.path.join(work_dir, 'state.csv')
+    add_blank_lines(args.cdc, cdc_file, args.every)
+    add_blank_lines(args.state, state_file, args.every)
+
+    checks = []
+    for filterCDC in (False, True):
+        expected = run(args.cdc, args.state, os.path.join(work_dir, f'baseline-{filterCDC}'), 'python', 1, filterCDC)
+        for engine, workers in (('python', 1), ('python', 2), ('columnar', 1), ('streaming', 1)):
+            name = f"{engine} engine, {workers} worker{'s' if workers > 1 else ''}{', filtered by CDC event codes' if filterCDC else ''}"
+            try:
+                passed = run(cdc_file, state_file, os.path.join(work_dir, f'{engine}-{workers}-{filterCDC}'), engine, workers,
+                             filterCDC) == expected
+            except ImportError as e:
+                print(f"SKIPPED: {name} ({e})")
+                continue
+            checks.append((name, passed))
+
+    for name, passed in checks:
+        print(f"{'OK' if passed else 'FAILED'}: {name}")
+    if not all(passed for _, passed in checks):
+        print(f"The outputs are in {work_dir}")
+        raise SystemExit(1)
+    shutil.rmtree(work_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import db_pool
+
+# Runs db_pool.ConnectionPool against a local SQLite database standing in for the state database, and checks that it
+# recovers from a database that is briefly unreachable and from connections that are dropped while idle or mid-query
+
+def main():
+    parser = argparse.ArgumentParser(prog="CheckDbPool", description='Check the state database connection pool against SQLite')
+    parser.add_argument('--failures', type=int, default=2, help='Number of times connecting fails before it works')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix="check-db-pool-")
+    path = os.path.join(folder, "state.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE State (CaseID TEXT, EventCode TEXT)")
+    conn.executemany("INSERT INTO State VALUES (?, ?)", [(f"CAS{i:08}", "11065") for i in range(1000)])
+    conn.commit()
+    conn.close()
+
+    failures = [args.failures]
+
+    def connect():
+        if failures[0] > 0:
+            failures[0] -= 1
+            raise sqlite3.OperationalError("unable to open database (simulated outage)")
+        return sqlite3.connect(path, check_same_thread=False)
+
+    pool = db_pool.ConnectionPool(connect, max_size=2, retries=args.failures, backoff=0.01, wait_timeout=1)
+
+    def count_cases(conn):
+        return conn.execute("SELECT COUNT(*) FROM State").fetchone()[0]
+
+    checks = []
+    with pool.query(count_cases) as count:
+        checks.append(("connects after the database comes back", count == 1000))
+
+    # The idle connection is dropped (e.g. the server restarted), the next query has to get a new one
+    pool.idle[0].close()
+    with pool.query(count_cases) as count:
+        checks.append(("replaces a connection dropped while idle", count == 1000 and pool.counters['replaced'] == 1))
+
+    dropped = [False]
+
+    def drop_then_count(conn):
+        if not dropped[0]:
+            dropped[0] = True
+            conn.close()
+            raise sqlite3.ProgrammingError("connection lost (simulated)")
+        return count_cases(conn)
+
+    with pool.query(drop_then_count) as count:
+        checks.append(("retries a query whose connection dropped", count == 1000 and pool.counters['replaced'] == 2))
+
+    try:
+        with pool.query(lambda conn: conn.execute("SELECT NoSuchColumn FROM State")):
+            pass
+        checks.append(("raises errors of live connections", False))
+    except sqlite3.OperationalError:
+        checks.append(("raises errors of live connections", pool.counters['replaced'] == 2))
+
+    first, second = pool.acquire(), pool.acquire()
+    try:
+        pool.acquire()
+        checks.append(("never opens more than max_size connections", False))
+    except db_pool.PoolTimeout:
+        checks.append(("never opens more than max_size connections", True))
+    pool.release(first)
+    pool.release(second)
+    pool.close()
+
+    # Without a wait_timeout (how state_query builds its pools) acquire waits for a connection to be released
+    waiting_pool = db_pool.ConnectionPool(lambda: sqlite3.connect(path, check_same_thread=False), max_size=1)
+    held = waiting_pool.acquire()
+    releaser = threading.Timer(0.5, waiting_pool.release, (held,))
+    releaser.start()
+    start = time.perf_counter()
+    try:
+        waiting_pool.release(waiting_pool.acquire())
+        checks.append(("a default pool waits for a free connection", time.perf_counter() - start >= 0.4))
+    except db_pool.PoolTimeout:
+        checks.append(("a default pool waits for a free connection", False))
+    releaser.join()
+    waiting_pool.close()
+
+    for name, passed in checks:
+        print(f"{'OK' if passed else 'FAILED'}: {name}")
+    print(pool.counters)
+    os.remove(path)
+    os.rmdir(folder)
+    if not all(passed for _, passed in checks):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
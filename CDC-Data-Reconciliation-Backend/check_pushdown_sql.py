@@ -0,0 +1,69 @@
+import state_query
+
+# Checks the SQL state_query sends for the pushed down query without a state database: a cursor that only records
+# the statements stands in for the pyodbc one. check_query_pushdown.py compares the results against a live server
+
+class RecordingCursor:
+    def __init__(self) -> None:
+        self.statements = []
+        self.fast_executemany = False
+
+    def execute(self, statement, *params):
+        self.statements.append((statement, params))
+
+    def executemany(self, statement, rows):
+        self.statements.append((statement, list(rows)))
+
+class RecordingConnection:
+    def __init__(self) -> None:
+        self.cursors = []
+
+    def cursor(self):
+        self.cursors.append(RecordingCursor())
+        return self.cursors[-1]
+
+def run_query(eventCodes, pushdown):
+    conn = RecordingConnection()
+    state_query.execute_state_query(conn, 2023, eventCodes, pushdown, query="SELECT * FROM State WHERE MMWRYear = ?;\n")
+    return conn.cursors[0].statements
+
+def main():
+    checks = []
+
+    statements = run_query({"11065", "10030"}, pushdown=True)
+    create = statements[1][0]
+    checks.append(("the event code table is dropped first, then created, filled and queried",
+                   [statement.split()[0] for statement, _ in statements] == ["IF", "CREATE", "INSERT", "SELECT"]))
+    # tempdb can have another collation than the state database, comparing the two columns would then fail (error 468)
+    checks.append(("the event code column takes the database's collation",
+                   f"CREATE TABLE {state_query.EVENT_CODES_TABLE} (EventCode VARCHAR(50) COLLATE DATABASE_DEFAULT NOT NULL PRIMARY KEY)" == create))
+    checks.append(("the event codes are inserted as parameters", statements[2][1] == [("10030",), ("11065",)]))
+    query, params = statements[3]
+    checks.append(("the query is filtered by the event code table",
+                   f"state.EventCode IN (SELECT EventCode FROM {state_query.EVENT_CODES_TABLE})" in query))
+    checks.append(("query.sql is a derived table without its semicolon", "(\nSELECT * FROM State WHERE MMWRYear = ?\n) AS state" in query))
+    checks.append(("the year is the only parameter of the query", params == (2023,)))
+    checks.append(("one row is kept per CaseID, the latest add_time",
+                   "TOP 1 WITH TIES" in query and "PARTITION BY state.CaseID ORDER BY state.add_time DESC" in query))
+
+    statements = run_query(set(), pushdown=True)
+    checks.append(("an empty set of event codes still filters (by an empty table)",
+                   [statement.split()[0] for statement, _ in statements] == ["IF", "CREATE", "SELECT"]
+                   and state_query.EVENT_CODES_TABLE in statements[-1][0]))
+
+    statements = run_query(None, pushdown=True)
+    checks.append(("without event codes no table is made and nothing is filtered by it",
+                   len(statements) == 1 and state_query.EVENT_CODES_TABLE not in statements[0][0]
+                   and "state.EventCode NOT LIKE '%[^0-9]%'" in statements[0][0]))
+
+    statements = run_query({"11065"}, pushdown=False)
+    checks.append(("without pushdown query.sql runs as it is",
+                   statements == [("SELECT * FROM State WHERE MMWRYear = ?;\n", (2023,))]))
+
+    for name, passed in checks:
+        print(f"{'OK' if passed else 'FAILED'}: {name}")
+    if not all(passed for _, passed in checks):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
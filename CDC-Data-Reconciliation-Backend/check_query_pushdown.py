@@ -0,0 +1,62 @@
+import argparse
+import json
+import os
+import pyodbc
+import compare
+import state_query
+
+# Checks that the pushed down query (dedup and event code filtering in SQL Server) returns the same
+# State cases as running the plain query.sql and doing the filtering in Python with compare.index_state_rows
+
+def fetch_rows(cursor):
+    # Returns the column names and the rows, with the values turned into strings the same way they are
+    # when the State data is written to state.csv
+    column_names = [col[0] for col in cursor.description]
+    return column_names, [['' if value is None else str(value) for value in row] for row in cursor.fetchall()]
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="CheckQueryPushdown", description='Compare the pushed down state query against the Python side filtering')
+    parser.add_argument('-y', '--year', required=True, help='Year to query')
+    parser.add_argument('-c', '--cdc', help='Local Path to a CDC CSV file to filter the event codes by')
+    args = parser.parse_args()
+
+    with open(os.path.join(os.path.dirname(__file__), "config.json"), "r") as f:
+        config = json.load(f)
+    conn = pyodbc.connect(state_query.build_connection_string(config))
+
+    eventCodes = compare.get_cdc_event_codes(args.cdc) if args.cdc else None
+
+    # Both sides are cut down to the same records, every column of the query is kept
+    header, rows = fetch_rows(state_query.execute_state_query(conn, args.year, pushdown=False))
+    layout = compare.RowLayout(header, compare.STATE_REQUIRED_COLUMNS, header)
+    python_side = compare.index_state_rows(rows, layout, eventCodes)
+    database_side = {}
+    header, rows = fetch_rows(state_query.execute_state_query(conn, args.year, eventCodes, pushdown=True))
+    for row in compare.RowLayout(header, compare.STATE_REQUIRED_COLUMNS, header).records(rows):
+        if row[compare.CASE_ID] in database_side:
+            print(f"CaseID {row[compare.CASE_ID]} was returned more than once by the pushed down query")
+        database_side[row[compare.CASE_ID]] = row
+
+    missing = python_side.keys() - database_side.keys()
+    extra = database_side.keys() - python_side.keys()
+    different_time = [case_id for case_id in python_side.keys() & database_side.keys()
+                      if python_side[case_id][compare.ADD_TIME] != database_side[case_id][compare.ADD_TIME]]
+    # Rows with the same latest add_time (e.g. one per race) are interchangeable, neither side orders them
+    ties = [case_id for case_id in python_side.keys() & database_side.keys()
+            if case_id not in different_time and python_side[case_id] != database_side[case_id]]
+
+    print(f"Python side: {len(python_side)} cases, pushed down query: {len(database_side)} cases")
+    print(f"Missing from pushed down query: {len(missing)}")
+    print(f"Only in pushed down query: {len(extra)}")
+    print(f"Different add_time kept: {len(different_time)}")
+    print(f"Same add_time, different row kept (ties): {len(ties)}")
+    for case_id in sorted(missing)[:10] + sorted(extra)[:10] + sorted(different_time)[:10]:
+        print(f"  {case_id}")
+
+    if missing or extra or different_time:
+        raise SystemExit(1)
+    print("Pushed down query matches the Python side filtering")
+
+if __name__ == "__main__":
+    main()
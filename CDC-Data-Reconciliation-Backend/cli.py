@@ -1,13 +1,15 @@
 import argparse
+import csv
 import os
-import pyodbc
 import json
-import uuid
-import csv
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import compare
+import state_query
+import state_cache
+import metrics
 
 config = None
-conn = None
 
 # Load config.json
 configDir = os.path.dirname(__file__)
@@ -15,100 +17,189 @@ configDir = os.path.dirname(__file__)
 config_file_path = os.path.join(configDir, "config.json")
 with open(config_file_path, "r") as f:
     config = json.load(f)
-    db_username = config.get("database_username") or os.getenv('DB_USERNAME')
-    db_password = config.get("database_password") or os.getenv('DB_PASSWORD')
-
-def get_state_csv(year: int):
-    query = None
-    query_file_path = os.path.join(configDir, "query.sql")
-    with open(query_file_path, 'r') as f:
-        query = f.read()
-
-    cursor = conn.cursor()
-    cursor.execute(query, year)
-
-    # Return the queried data as a list of dicts
-    column_names = [col[0] for col in cursor.description]
-    state_content = cursor.fetchall()
-
-    id = str(uuid.uuid4())
-    state_save_to = os.path.join(configDir, f"{id}.csv")
-    with open(state_save_to, "w", newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(column_names)
-        writer.writerows(state_content)
-
-    return state_save_to
-    
-def main():
-    global conn
 
+# Columns of a batch's summary.csv, the totals are the sums of each report's stats.csv
+SUMMARY_COLUMNS = ['Name', 'Year', 'CDCFile', 'Status', 'TotalCases', 'TotalDuplicates', 'TotalMissingFromCDC',
+                   'TotalMissingFromState', 'TotalWrongAttributes', 'StateRows', 'Seconds', 'Error']
+# Columns of a report's results.csv. cli.py has always written these seven, without the CaseClassStatus column
+# compare.py and the server write, so the scripts reading its output keep working
+RESULT_COLUMNS = ['CaseID', 'EventCode', 'EventName', 'MMWRYear', 'MMWRWeek', 'Reason', 'ReasonID']
+STAT_TOTALS = ['totalCases', 'totalDuplicates', 'totalMissingCDC', 'totalMissingState', 'totalWrongAttributes']
+
+def main():
     parser = argparse.ArgumentParser(
         prog="AutoCompare", description='Auto Comparison')
-    parser.add_argument('-c', '--cdc', required=True, help='Local Path to CDC CSV file')
+    parser.add_argument('-c', '--cdc', help='Local Path to CDC CSV file')
     parser.add_argument('-o', '--output', required=True, help='Name of folder that should be created to store the report files')
-    parser.add_argument('-y', '--year', required=True, help='Year to compare')
+    parser.add_argument('-y', '--year', help='Year to compare')
     # defaulting to filtering by CDC event codes
     parser.add_argument('-nf', '--nofilter', default=False, action="store_true", help='Do not filter by CDC eventCodes')
     parser.add_argument('-a', '--attributes', nargs='*', help='Attributes to compare')
+    parser.add_argument('-r', '--refresh', default=False, action="store_true",
+                        help='Query the state database again even if the state cache has the data for this year')
+    parser.add_argument('-p', '--profile', default=False, action="store_true",
+                        help='Profile the query and comparison with cProfile, the stats go to profile.prof in the output folder')
+    parser.add_argument('-m', '--manifest',
+                        help='JSON file listing the CDC files and years of a batch of reports, each report gets a folder in the output folder')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='How many reports of a batch run at the same time (comparison_workers from config.json by default)')
+    parser.add_argument('--overwrite', default=False, action="store_true", help='Write into an output folder that already exists')
     args = parser.parse_args()
 
-    if (args.cdc is None or args.output is None or args.year is None):
+    if args.manifest is None and (args.cdc is None or args.output is None or args.year is None):
         print("Please provide the CDC CSV file, the output folder name, and the year to compare")
         return
 
-    # Connect to the SQL Server
-    connection_string_base = 'DRIVER={' + config["driver"] + \
-        '}' + \
-        f';SERVER={config["server"]};DATABASE={config["database"]};'
+    filterByCDC = not args.nofilter
+    normalizers = config.get("attribute_normalizers", {})
+    compare.resolve_normalizers(normalizers)
+    state_query.configure_pool(config)
 
-    if db_username and db_password:
-        connection_string_auth = f'UID={db_username};PWD={db_password};'
-    else:
-        connection_string_auth = 'Trusted_Connection=yes;'
+    # The CLI shares the server's state cache, if it is turned on in config.json
+    cache = None
+    if config.get("state_cache", False):
+        cache = state_cache.StateCache(os.path.join(configDir, "state_cache"),
+                                       config.get("state_cache_ttl_minutes", state_cache.DEFAULT_TTL_MINUTES),
+                                       config.get("state_cache_max_mb", state_cache.DEFAULT_MAX_SIZE_MB))
 
-    connection_string = connection_string_base + connection_string_auth
-    conn = pyodbc.connect(connection_string)
+    # Create output folder
+    output_folder = os.path.join(configDir, args.output)
 
-    # Get the state CSV
-    state_csv = get_state_csv(args.year)
+    if args.manifest is not None:
+        try:
+            reports = read_manifest(args.manifest, args.attributes, filterByCDC)
+        except (OSError, ValueError, KeyError) as e:
+            parser.error(f"Cannot use manifest {args.manifest}: {e}")
+        os.makedirs(output_folder, exist_ok=args.overwrite)
+        jobs = args.jobs or config.get("comparison_workers", 2)
+        failed = run_batch(reports, output_folder, jobs, cache, args.refresh, normalizers, args.profile)
+        if failed:
+            raise SystemExit(1)
+        return
 
-    filterByCDC = not args.nofilter
-    
-    cdc_dict, cdcEventCodes = compare.get_cdc_dict(args.cdc, filterByCDC)
-    state_dict = compare.get_state_dict(state_csv, cdcEventCodes)
-    
-    compare.comp(state_dict, cdc_dict, args.attributes)
+    # profile.prof is written into the output folder, so with -p the folder has to exist before the run
+    if args.profile:
+        os.makedirs(output_folder, exist_ok=args.overwrite)
 
-    os.remove(state_csv)
+    # Query the state database and compare the rows as they are fetched, without writing them to a csv first
+    with metrics.profiled(os.path.join(output_folder, "profile.prof") if args.profile else None):
+        run_results, run_stats, _ = state_query.reconcile_year(
+            state_query.build_connection_string(config), args.year, args.cdc, filterByCDC, args.attributes,
+            config.get("query_pushdown", True), config.get("query_arraysize", state_query.DEFAULT_ARRAYSIZE),
+            cache=cache, refresh=args.refresh, normalizers=normalizers)
 
-    # Create output folder
-    output_folder = os.path.join(configDir, args.output)
-    os.makedirs(output_folder)
+    # Otherwise it is only made once the comparison worked, so a failed query does not leave an empty folder behind
+    os.makedirs(output_folder, exist_ok=args.overwrite or args.profile)
 
     # Create Results CSV File and write the results to it
-    with open(os.path.join(output_folder, "results.csv"), 'w', newline='') as csvfile:
-        fieldnames = ['CaseID', 'EventCode', 'EventName', 'MMWRYear',
-                      'MMWRWeek', 'Reason', 'ReasonID']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-        writer.writeheader()
-        for result in compare.results:
-            writer.writerow({'CaseID': result.caseID, 'EventCode': result.eventCode, 'EventName': result.eventName,'MMWRYear': result.MMWRYear,
-                            'MMWRWeek': result.MMWRWeek, 'Reason': result.reason, 'ReasonID': result.reasonID})
-            
+    compare.write_results(run_results, os.path.join(output_folder, "results.csv"), RESULT_COLUMNS)
+
     # writing stats data to the csv
-    with open(os.path.join(output_folder, 'stats.csv'), 'w', newline='') as csvfile:
-        fieldNames = ['EventCode', 'EventName', 'TotalCases', 'TotalDuplicates',
-                      'TotalMissingFromCDC', 'TotalMissingFromState', 'TotalWrongAttributes']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldNames)
-        
-        writer.writeheader()
-        for eventCode, data in compare.stats.items():
-            writer.writerow({'EventCode': eventCode, 'EventName': data['eventName'], 'TotalCases': data['totalCases'],
-                             'TotalDuplicates': data['totalDuplicates'], 'TotalMissingFromCDC': data['totalMissingCDC'],
-                             'TotalMissingFromState': data['totalMissingState'], 'TotalWrongAttributes': data['totalWrongAttributes']})
-
-if __name__ == "__main__": 
+    compare.write_stats(run_stats, os.path.join(output_folder, "stats.csv"))
+
+def read_manifest(manifest_path, attributes, filterByCDC):
+    """
+    Reads the reports of a batch from a manifest like
+    {"attributes": [...], "filter": true, "reports": [{"cdc": "cdc_2023.csv", "year": 2023, "name": "2023"}, ...]}.
+    CDC paths are relative to the manifest. attributes and filter can be set per report, otherwise the manifest's
+    (or the command line's) are used. A report's name is its folder in the output folder, "<year>-<CDC file name>"
+    if it is not given.
+    """
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    attributes = manifest.get("attributes", attributes)
+    filterByCDC = manifest.get("filter", filterByCDC)
+
+    reports = []
+    for entry in manifest.get("reports", []):
+        cdc_file = os.path.join(manifest_dir, entry["cdc"])
+        if not os.path.isfile(cdc_file):
+            raise ValueError(f"CDC file {cdc_file} does not exist")
+        year = str(entry["year"])
+        reports.append({
+            "name": str(entry.get("name") or f"{year}-{os.path.splitext(os.path.basename(cdc_file))[0]}"),
+            "cdc": cdc_file,
+            "year": year,
+            "attributes": entry.get("attributes", attributes),
+            "filter": entry.get("filter", filterByCDC),
+        })
+
+    if not reports:
+        raise ValueError("it has no reports")
+    names = [report["name"] for report in reports]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"more than one report is named {', '.join(duplicates)}")
+    return reports
+
+def run_batch(reports, output_folder, jobs, cache, refresh, normalizers, profile):
+    """
+    Runs the reports of a batch in a pool of jobs worker processes and writes summary.csv. Every worker keeps its
+    state database connection between reports, and rows are compared while they are fetched, so the batch takes about
+    as long as its slowest report when there are enough workers. Returns how many reports failed.
+    """
+    # query.sql is read once, so every report of the batch runs the same query
+    query = state_query.read_query()
+    connection_string = state_query.build_connection_string(config)
+    start = time.perf_counter()
+
+    # The biggest CDC files are started first, so a long report does not end up running on its own at the end
+    order = sorted(reports, key=lambda report: os.path.getsize(report["cdc"]), reverse=True)
+    outcomes = {}
+    with ProcessPoolExecutor(max_workers=max(1, min(jobs, len(reports))),
+                             initializer=state_query.configure_pool, initargs=(config,)) as executor:
+        futures = {executor.submit(run_report, report, os.path.join(output_folder, report["name"]), connection_string,
+                                   query, cache, refresh, normalizers, profile): report["name"] for report in order}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                outcomes[name] = future.result()
+                print(f"{name}: done in {outcomes[name]['seconds']:.1f}s")
+            except Exception as e:
+                # One failed report does not stop the others
+                outcomes[name] = {"error": f"{type(e).__name__}: {e}"}
+                print(f"{name}: failed, {outcomes[name]['error']}")
+
+    elapsed = time.perf_counter() - start
+    write_summary(reports, outcomes, elapsed, os.path.join(output_folder, "summary.csv"))
+    failed = sum("error" in outcome for outcome in outcomes.values())
+    busy = sum(outcome.get("seconds", 0) for outcome in outcomes.values())
+    print(f"{len(reports) - failed} of {len(reports)} reports done in {elapsed:.1f}s ({busy:.1f}s added up), "
+          f"see {os.path.join(output_folder, 'summary.csv')}")
+    return failed
+
+def run_report(report, report_folder, connection_string, query, cache, refresh, normalizers, profile):
+    # One report of a batch, run in a worker process. Its files are written here, only the totals go back
+    start = time.perf_counter()
+    os.makedirs(report_folder, exist_ok=True)
+    with metrics.profiled(os.path.join(report_folder, "profile.prof") if profile else None):
+        run_results, run_stats, rows_read = state_query.reconcile_year(
+            connection_string, report["year"], report["cdc"], report["filter"], report["attributes"],
+            config.get("query_pushdown", True), config.get("query_arraysize", state_query.DEFAULT_ARRAYSIZE),
+            cache=cache, refresh=refresh, normalizers=normalizers, query=query)
+    compare.write_results(run_results, os.path.join(report_folder, "results.csv"), RESULT_COLUMNS)
+    compare.write_stats(run_stats, os.path.join(report_folder, "stats.csv"))
+
+    totals = {key: sum(data[key] for data in run_stats.values()) for key in STAT_TOTALS}
+    return dict(totals, stateRows=rows_read, seconds=time.perf_counter() - start)
+
+def write_summary(reports, outcomes, elapsed, summary_file):
+    # One row per report in the manifest's order, then the totals of the reports that finished
+    with open(summary_file, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(SUMMARY_COLUMNS)
+        for report in reports:
+            outcome = outcomes.get(report["name"], {"error": "did not run"})
+            if "error" in outcome:
+                writer.writerow([report["name"], report["year"], report["cdc"], "failed"] + [""] * 7 + [outcome["error"]])
+                continue
+            writer.writerow([report["name"], report["year"], report["cdc"], "done"] + [outcome[key] for key in STAT_TOTALS]
+                            + [outcome["stateRows"], round(outcome["seconds"], 3), ""])
+        done = [outcome for outcome in outcomes.values() if "error" not in outcome]
+        writer.writerow(["Total", "", "", f"{len(done)} of {len(reports)} done"]
+                        + [sum(outcome[key] for outcome in done) for key in STAT_TOTALS + ["stateRows"]]
+                        + [round(elapsed, 3), ""])
+
+if __name__ == "__main__":
     main()
-    
\ No newline at end of file
@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+
+from compare import CaseResult, is_parquet, read_header, resolve_normalizers
+
+# Reason strings and IDs, these need to stay the same as the ones used in compare.py
+DUPLICATE_REASON = "Duplicate CaseID found in CDC dataset"
+MISSING_CDC_REASON = "CaseID not found in CDC dataset"
+MISSING_STATE_REASON = "CaseID not found in State dataset"
+
+RESULT_COLUMNS = ['CaseID', 'EventCode', 'EventName', 'MMWRYear', 'MMWRWeek', 'Reason', 'ReasonID', 'CaseClassStatus']
+
+# Columns every result row needs from both files
+RESULT_SOURCE_COLUMNS = ['CaseID', 'EventCode', 'EventName', 'MMWRYear', 'MMWRWeek', 'CaseClassStatus']
+
+def read_csv(file_path, columns):
+    """
+    Reads only the given columns of a CSV file. Every column is read as a string and empty cells
+    stay empty strings, just like csv.DictReader. Parquet files (see parquet_archive) are read with pyarrow too.
+    """
+    if is_parquet(file_path):
+        import pyarrow.parquet as pq
+        return pq.read_table(file_path, columns=columns).to_pandas()
+    try:
+        import pyarrow.csv as pa_csv
+    except ImportError:
+        return pd.read_csv(file_path, dtype=object, keep_default_na=False, na_filter=False,
+                           encoding='utf-8-sig', usecols=columns)
+
+    # pyarrow parses the file on several threads and skips the utf-8 BOM itself
+    table = pa_csv.read_csv(file_path,
+                            parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+                            convert_options=pa_csv.ConvertOptions(include_columns=columns,
+                                                                  column_types={column: 'string' for column in columns},
+                                                                  strings_can_be_null=False))
+    return table.to_pandas()
+
+def dedup_state(state_df, eventCodes=None):
+    """
+    Vectorized version of compare.get_state_dict. Keeps the row with the latest add_time for every CaseID,
+    ordered by where the CaseID first shows up in the file.
+    """
+    # If the EventCode is not a number, skip the row (Getting rid of values like MAPPING and ZT_PP_Condition3)
+    keep = state_df['EventCode'].str.isnumeric()
+    # Here we are filtering out the rows of the database by the event code that they have
+    if eventCodes is not None:
+        keep &= state_df['EventCode'].isin(eventCodes)
+    state_df = state_df[keep.to_numpy()].reset_index(drop=True)
+
+    group = state_df.groupby('CaseID', sort=False).ngroup().to_numpy()
+    duplicated = state_df['CaseID'].duplicated(keep=False).to_numpy()
+
+    add_time = pd.to_datetime(state_df['add_time'], format='ISO8601', errors='coerce')
+    unparsed = duplicated & add_time.isna().to_numpy()
+    if unparsed.any():
+        # Like compare.index_state_records, rows with the same add_time string as the rest of their CaseID are not
+        # parsed (even empty or unreadable ones), a CaseID only fails if it also has another add_time to compare with
+        suspect = np.isin(group, group[unparsed])
+        distinct = state_df['add_time'][suspect].groupby(group[suspect]).nunique()
+        conflicting = unparsed & np.isin(group, distinct.index[distinct.to_numpy() > 1])
+        if conflicting.any():
+            bad_value = state_df['add_time'][conflicting].iloc[0]
+            raise ValueError(f"time data '{bad_value}' does not match the add_time format")
+
+    # Sorting is stable, so within a CaseID the first row with the latest add_time wins (a CaseID whose add_time
+    # could not be parsed has the same add_time string on every row, so its first row is kept)
+    order = pd.DataFrame({'group': group, 'add_time': add_time}).sort_values(
+        ['group', 'add_time'], ascending=[True, False], kind='stable', na_position='last')
+    latest = order.drop_duplicates('group', keep='first').index.to_numpy()
+
+    return state_df.take(latest).reset_index(drop=True)
+
+def mismatch_reasons(state_df, cdc_df, state_rows, cdc_rows, attributes, normalizers=None):
+    """
+    Compares every attribute column of the matched rows at once and returns the indexes of the mismatched rows
+    (positions in state_rows) together with their reason strings. Attributes with a normalizer
+    ({attribute: function}) have it applied to their non-empty values first.
+    """
+    differs = np.zeros((len(state_rows), len(attributes)), dtype=bool)
+    for i, attribute in enumerate(attributes):
+        state_values = state_df[attribute].to_numpy()[state_rows]
+        cdc_values = cdc_df[attribute].to_numpy()[cdc_rows]
+        normalize = (normalizers or {}).get(attribute)
+        if normalize is not None:
+            normalize_values = np.frompyfunc(lambda value: normalize(value) if value else value, 1, 1)
+            state_values, cdc_values = normalize_values(state_values), normalize_values(cdc_values)
+        # Empty cells count as NULL on both sides
+        state_values = np.where(state_values == "", "NULL", state_values)
+        cdc_values = np.where(cdc_values == "", "NULL", cdc_values)
+        differs[:, i] = state_values != cdc_values
+
+    mismatched = np.flatnonzero(differs.any(axis=1))
+    if len(attributes) <= 62:
+        # Every combination of differing attributes gets a bitmask, so each reason string is only built once
+        masks = differs[mismatched].astype(np.int64) @ (np.int64(1) << np.arange(len(attributes), dtype=np.int64))
+        unique_masks, inverse = np.unique(masks, return_inverse=True)
+        unique_reasons = [build_reason([a for bit, a in enumerate(attributes) if mask >> bit & 1]) for mask in unique_masks.tolist()]
+        reasons = np.array(unique_reasons, dtype=object)[inverse.reshape(-1)]
+    else:
+        reasons = np.array([build_reason([a for a, d in zip(attributes, row) if d]) for row in differs[mismatched]], dtype=object)
+
+    return mismatched, reasons
+
+def build_reason(att_list):
+    wrong_attribute_string = ", ".join(att_list)
+    return f"Case differs on {wrong_attribute_string} between State and CDC datasets"
+
+def result_frame(df, rows, reason, reasonID):
+    frame = df[['CaseID', 'EventCode', 'EventName', 'MMWRYear', 'MMWRWeek', 'CaseClassStatus']].take(rows)
+    frame.insert(5, 'Reason', reason)
+    frame.insert(6, 'ReasonID', reasonID)
+    return frame.reset_index(drop=True)
+
+def reconcile(cdc_file, state_file, filterCDC=False, compare_attributes=None, normalizers=None):
+    """
+    Columnar engine for compare.reconcile. Produces the same (results, stats) as the row by row engine
+    but does the join and attribute comparison as whole-column operations.
+    """
+    normalizers = resolve_normalizers(normalizers)
+    cdc_header = read_header(cdc_file)
+    state_header = read_header(state_file)
+
+    # Determine which attributes to compare: specified ones or all
+    attributes_to_compare = compare_attributes if compare_attributes is not None else state_header
+    attributes = [attribute for attribute in attributes_to_compare if attribute in cdc_header]
+
+    # Only the columns that end up in the results or get compared are loaded
+    cdc_all = read_csv(cdc_file, list(dict.fromkeys(RESULT_SOURCE_COLUMNS + attributes)))
+    cdcEventCodes = set(cdc_all['EventCode']) if filterCDC else None
+
+    duplicate_mask = cdc_all['CaseID'].duplicated(keep='first').to_numpy()
+    cdc_dups = cdc_all[duplicate_mask]
+    cdc_df = cdc_all[~duplicate_mask].reset_index(drop=True)
+
+    state_df = dedup_state(read_csv(state_file, list(dict.fromkeys(RESULT_SOURCE_COLUMNS + ['add_time'] + attributes))), cdcEventCodes)
+
+    # Outer join on CaseID: position of each State case in the CDC frame, -1 if it is missing
+    cdc_position = pd.Index(cdc_df['CaseID']).get_indexer(state_df['CaseID'])
+    matched = np.flatnonzero(cdc_position >= 0)
+    missing_cdc = np.flatnonzero(cdc_position < 0)
+    found_in_state = np.zeros(len(cdc_df), dtype=bool)
+    found_in_state[cdc_position[matched]] = True
+    missing_state = np.flatnonzero(~found_in_state)
+
+    if matched.size > 0 and attributes:
+        mismatched, reasons = mismatch_reasons(state_df, cdc_df, matched, cdc_position[matched], attributes, normalizers)
+        wrong = matched[mismatched]
+    else:
+        wrong = np.array([], dtype=np.int64)
+        reasons = np.array([], dtype=object)
+
+    # State side results are ordered the same way compare.comp walks the State cases
+    state_results = pd.concat([result_frame(state_df, missing_cdc, MISSING_CDC_REASON, "2"),
+                               result_frame(state_df, wrong, reasons, "3")])
+    state_results['order'] = np.concatenate([missing_cdc, wrong])
+    state_results = state_results.sort_values('order', kind='stable').drop(columns='order')
+
+    results_df = pd.concat([result_frame(cdc_dups, np.arange(len(cdc_dups)), DUPLICATE_REASON, "1"),
+                            state_results,
+                            result_frame(cdc_df, missing_state, MISSING_STATE_REASON, "4")])
+    results = list(map(CaseResult, *(results_df[column].tolist() for column in RESULT_COLUMNS)))
+
+    stats = build_stats(cdc_df, cdc_dups, state_df, missing_cdc, wrong, missing_state)
+
+    return results, stats
+
+def build_stats(cdc_df, cdc_dups, state_df, missing_cdc, wrong, missing_state):
+    # Event codes show up in the stats in the same order compare.Reconciler adds them
+    stats = {}
+    for frame in (cdc_df, state_df):
+        first_rows = frame.drop_duplicates('EventCode', keep='first')
+        for eventCode, eventName in zip(first_rows['EventCode'].tolist(), first_rows['EventName'].tolist()):
+            if eventCode not in stats:
+                stats[eventCode] = {'eventName': eventName, 'totalCases': 0, 'totalDuplicates': 0, 'totalMissingCDC': 0, 'totalMissingState': 0, 'totalWrongAttributes': 0}
+
+    def add_counts(codes, *keys):
+        for eventCode, count in codes.value_counts(sort=False).items():
+            for key in keys:
+                stats[eventCode][key] += int(count)
+
+    add_counts(cdc_dups['EventCode'], 'totalDuplicates')
+    add_counts(state_df['EventCode'], 'totalCases')
+    add_counts(state_df['EventCode'].take(missing_cdc), 'totalMissingCDC')
+    add_counts(state_df['EventCode'].take(wrong), 'totalWrongAttributes')
+    add_counts(cdc_df['EventCode'].take(missing_state), 'totalMissingState', 'totalCases')
+
+    return stats
@@ -2,8 +2,216 @@ import csv
 import argparse
 from datetime import datetime
 import os
+import time
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+from itertools import islice
+from operator import itemgetter
+from sys import intern
+
+# How many rows are processed between progress reports
+PROGRESS_INTERVAL = 10000
+
+# Columns every comparison needs from each file (the compared attributes come on top of these)
+CDC_REQUIRED_COLUMNS = ['CaseID', 'EventCode', 'EventName', 'MMWRYear', 'MMWRWeek', 'CaseClassStatus']
+STATE_REQUIRED_COLUMNS = CDC_REQUIRED_COLUMNS + ['add_time']
+
+# Positions of the required columns in the records the comparison keeps of every row, see RowLayout
+CASE_ID, EVENT_CODE, EVENT_NAME, MMWR_YEAR, MMWR_WEEK, CASE_CLASS_STATUS, ADD_TIME = range(7)
+
+# Date formats normalize_date understands besides ISO dates (e.g. 3/15/1987 in the CDC data)
+DATE_FORMATS = ['%m/%d/%Y', '%m/%d/%Y %H:%M:%S', '%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y %H:%M', '%Y%m%d']
+
+# Normalizers only see a few thousand distinct values per column (dates of birth, ages), so their results are cached
+@lru_cache(maxsize=65536)
+def normalize_date(value):
+    # Any date format above (with or without a time) becomes YYYY-MM-DD, values that are not a date stay as they are
+    text = value.strip()
+    try:
+        return datetime.fromisoformat(text).date().isoformat()
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date().isoformat()
+        except ValueError:
+            pass
+    return value
+
+@lru_cache(maxsize=65536)
+def normalize_number(value):
+    # 07, 7.0 and 7 are all 7 (and -0 is 0)
+    try:
+        number = Decimal(value.strip())
+    except InvalidOperation:
+        return value
+    if not number.is_finite():
+        return value
+    return format((number + 0).normalize(), 'f')
+
+# Normalizers that can be set for a compared attribute (attribute_normalizers in config.json, --normalize for compare.py)
+NORMALIZERS = {
+    'date': normalize_date,
+    'number': normalize_number,
+    'trim': str.strip,
+    'casefold': lambda value: value.strip().casefold(),
+}
+
+def resolve_normalizers(normalizers):
+    # {attribute: normalizer name} -> {attribute: function}, an unknown name is an error before anything is compared
+    resolved = {}
+    for attribute, name in (normalizers or {}).items():
+        if name not in NORMALIZERS:
+            raise ValueError(f"Unknown normalizer {name} for {attribute}, the normalizers are: {', '.join(NORMALIZERS)}")
+        resolved[attribute] = NORMALIZERS[name]
+    return resolved
+
+class RowLayout:
+    """
+    The columns the comparison keeps of one side's rows. Instead of a dictionary with every column of the file,
+    each row is kept as a tuple of the required columns (at the positions above) followed by the compared ones.
+    header is the file's full header, and the rows given to records are lists in that order (as csv.reader gives them).
+    normalizers ({attribute: function}) are applied to the compared attributes as the records are made. A required
+    column with a normalizer keeps its value as is for the results, the normalized copy goes at the end of the record.
+    """
+    __slots__ = ('header', 'columns', 'index', 'compare_index', 'positions', 'missing', 'normalized', 'copies')
+
+    def __init__(self, header, required, compared, normalizers=None) -> None:
+        self.header = list(header)
+        self.columns = list(dict.fromkeys(list(required) + [column for column in compared if column in self.header]))
+        # column name -> position in the record
+        self.index = {column: i for i, column in enumerate(self.columns)}
+        # Like csv.DictReader, the last of two columns with the same name wins
+        header_positions = {column: i for i, column in enumerate(self.header)}
+        self.positions = [header_positions.get(column) for column in self.columns]
+        # Required columns the header does not have, reading a row is an error then (as it is with a row dictionary)
+        self.missing = [column for column in self.columns if column not in header_positions]
+
+        # attribute -> position of the value it is compared on, which is the normalized copy for required columns
+        self.compare_index = dict(self.index)
+        # (position in the row, normalizer) of the values that are normalized in place, and of the required ones
+        # whose normalized copy is added to the record
+        self.normalized = []
+        self.copies = []
+        for attribute, normalize in (normalizers or {}).items():
+            if attribute not in compared or attribute not in header_positions:
+                continue
+            if attribute in required:
+                self.compare_index[attribute] = len(self.columns) + len(self.copies)
+                self.copies.append((header_positions[attribute], normalize))
+            else:
+                self.normalized.append((header_positions[attribute], normalize))
+
+    def records(self, rows):
+        """
+        Yields the record of every row. The required columns other than CaseID have few distinct values,
+        so they are interned and all records with the same EventCode, EventName, etc. share one string.
+        Blank lines are skipped and short rows get None for their missing columns, like csv.DictReader does.
+        """
+        if self.missing:
+            for row in rows:
+                if row:
+                    raise KeyError(self.missing[0])
+            return
+        project = itemgetter(*self.positions)
+        width = len(self.header)
+        code, name, year, week, status = self.positions[EVENT_CODE:CASE_CLASS_STATUS + 1]
+        normalized, copies = self.normalized, self.copies
+        for row in rows:
+            if len(row) < width:
+                if not row:
+                    continue
+                row = row + [None] * (width - len(row))
+                for position in (code, name, year, week, status):
+                    if row[position] is not None:
+                        row[position] = intern(row[position])
+            else:
+                row[code] = intern(row[code])
+                row[name] = intern(row[name])
+                row[year] = intern(row[year])
+                row[week] = intern(row[week])
+                row[status] = intern(row[status])
+            for position, normalize in normalized:
+                if row[position]:
+                    row[position] = normalize(row[position])
+            if copies:
+                yield project(row) + tuple(normalize(row[position]) if row[position] else row[position]
+                                           for position, normalize in copies)
+            else:
+                yield project(row)
+
+def row_layouts(cdc_header, state_header, compare_attributes=None, normalizers=None):
+    """
+    Returns the CDC and State RowLayout for a comparison: the required columns plus the attributes
+    Reconciler.comp compares (the compare_attributes, or every State column if there are none).
+    normalizers is {attribute: normalizer name}, see NORMALIZERS.
+    """
+    attributes = compare_attributes if compare_attributes is not None else state_header
+    compared = [attribute for attribute in attributes if attribute in cdc_header]
+    functions = resolve_normalizers(normalizers)
+    return (RowLayout(cdc_header, CDC_REQUIRED_COLUMNS, compared, functions),
+            RowLayout(state_header, STATE_REQUIRED_COLUMNS, compared, functions))
+
+def comparison_plan(state_layout, cdc_layout, compare_attributes=None):
+    """
+    Works out once per run what Reconciler.comp needs for every matched case. Returns (attribute, State position,
+    CDC position) of each attribute to compare (the specified ones or every State column) that the CDC data has too,
+    in the order they go into the reason, getters that pick all of their values out of a State / CDC record at once
+    (None if there is nothing to compare), and the first attribute that only the CDC data has, if any.
+    """
+    attributes_to_compare = compare_attributes if compare_attributes is not None else state_layout.header
+    plan = [(attribute, state_layout.compare_index.get(attribute), cdc_layout.compare_index[attribute])
+            for attribute in attributes_to_compare if attribute in cdc_layout.index]
+    missing_attribute = next((attribute for attribute, state_position, _ in plan if state_position is None), None)
+    if not plan or missing_attribute is not None:
+        return plan, None, None, missing_attribute
+    return (plan, itemgetter(*[state_position for _, state_position, _ in plan]),
+            itemgetter(*[cdc_position for _, _, cdc_position in plan]), None)
+
+def is_parquet(file_path):
+    # Parquet files (see parquet_archive) start with these magic bytes, a CSV file of CDC or State data never does
+    with open(file_path, 'rb') as f:
+        return f.read(4) == b'PAR1'
+
+def read_header(file_path):
+    if is_parquet(file_path):
+        import parquet_archive
+        return parquet_archive.read_header(file_path)
+    with open(file_path, newline='', encoding='utf-8-sig') as csvfile:
+        return next(csv.reader(csvfile), [])
+
+def read_records(file_path, layout, fast=True):
+    """
+    Yields the records (see RowLayout.records) of every row of a CSV file with layout's header.
+    With pyarrow installed (and fast set) the file is parsed by fast_csv, a lot quicker than csv.reader.
+    From the first row fast_csv cannot read exactly like csv.reader on, the file is read with csv.reader.
+    Parquet files written by parquet_archive (which needs pyarrow) are read as well, only the layout's columns of them.
+    """
+    if is_parquet(file_path):
+        import parquet_archive
+        yield from parquet_archive.read_records(file_path, layout)
+        return
+    records_read = 0
+    if fast:
+        try:
+            import fast_csv
+        except ImportError:
+            fast_csv = None
+        if fast_csv is not None:
+            try:
+                yield from fast_csv.read_records(file_path, layout)
+                return
+            except fast_csv.Unsupported as e:
+                records_read = e.records_read
+    with open(file_path, newline='', encoding='utf-8-sig') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader, None)
+        yield from islice(layout.records(reader), records_read, None)
 
 class CaseResult:
+    # Slots instead of a __dict__ per instance, a report can have millions of these
+    __slots__ = ('caseID', 'eventCode', 'eventName', 'MMWRYear', 'MMWRWeek', 'reason', 'reasonID', 'caseClassStatus')
+
     def __init__(self, caseID, eventCode, eventName, MMWRYear, MMWRWeek, reason, reasonID, caseClassStatus) -> None:
         self.caseID = caseID
         self.eventCode = eventCode
@@ -14,10 +222,60 @@ class CaseResult:
         self.reasonID = reasonID
         self.caseClassStatus = caseClassStatus
 
-# dictionary holding all stats for this report
-stats = {}
+    def as_tuple(self):
+        # Column order matches results.csv and the Cases table
+        return (self.caseID, self.eventCode, self.eventName, self.MMWRYear,
+                self.MMWRWeek, self.reason, self.reasonID, self.caseClassStatus)
+
+    def __reduce__(self):
+        # Pickled as its fields (results are sent back from the comparison workers), which is smaller and faster
+        # than the default pickling of a class with slots
+        return (CaseResult, self.as_tuple())
+
+class RunCancelled(Exception):
+    pass
+
+class ProgressReporter:
+    """
+    Progress callback for a comparison run, called as progress(phase, rows processed, total rows if known).
+    Forwards everything to a shared dictionary (e.g. a multiprocessing Manager dict, so the server can read it
+    while a worker process does the comparison) and raises RunCancelled once 'cancelled' is set in it.
+    The seconds spent in each phase add up in the shared 'phaseSeconds', and counters of the run in 'counters'.
+    """
+    def __init__(self, shared) -> None:
+        self.shared = shared
+        self.phase = None
+
+    def __call__(self, phase, rows, total=None):
+        if self.shared.get('cancelled'):
+            raise RunCancelled()
+        update = {'rowsProcessed': rows, 'rowsTotal': total}
+        if phase != self.phase:
+            self.phase = phase
+            now = time.time()
+            update.update(self.phase_ended(now))
+            update['phase'] = phase
+            update['phaseStartedAt'] = now
+        self.shared.update(update)
 
-results: list[CaseResult] = []
+    def phase_ended(self, now):
+        # The phase that is running may have been started by a copy of this reporter in another process
+        # (the worker compares, the server persists), so it is looked up in the shared dictionary
+        phase = self.shared.get('phase')
+        if phase is None:
+            return {}
+        seconds = dict(self.shared.get('phaseSeconds') or {})
+        seconds[phase] = seconds.get(phase, 0) + now - self.shared['phaseStartedAt']
+        return {'phaseSeconds': seconds}
+
+    def end_phase(self):
+        # Called when the run is done, so the last phase stops counting
+        update = self.phase_ended(time.time())
+        update['phase'] = self.phase = None
+        self.shared.update(update)
+
+    def record(self, **counters):
+        self.shared['counters'] = {**(self.shared.get('counters') or {}), **counters}
 
 def parse_time(time_string):
     try:
@@ -25,173 +283,373 @@ def parse_time(time_string):
     except ValueError:
         return datetime.strptime(time_string, "%Y-%m-%d %H:%M:%S")
 
-def get_state_dict(state_file, eventCodes=None):
+def parse_add_time(time_string):
+    # fromisoformat is much faster than strptime and handles the usual "2023-02-08 15:44:37.157" add_time values,
+    # anything it does not accept (or that has a timezone) goes through the strict strptime formats instead
+    try:
+        parsed = datetime.fromisoformat(time_string)
+        if parsed.tzinfo is None and len(time_string) >= 19 and time_string[10] == ' ':
+            return parsed
+    except ValueError:
+        pass
+    return parse_time(time_string)
+
+def get_state_dict(state_file, layout, eventCodes=None, counters=None, progress=None, fast=True):
+    # layout is the State RowLayout for the file's header (see row_layouts)
+    return index_state_records(read_records(state_file, layout, fast), eventCodes, counters, progress)
+
+def index_state_rows(rows, layout, eventCodes=None, counters=None, progress=None):
+    # rows are lists in the order of layout.header, the State case records are kept as layout.records makes them
+    return index_state_records(layout.records(rows), eventCodes, counters, progress)
+
+def index_state_records(records, eventCodes=None, counters=None, progress=None):
+    # Keeps the latest record of every State case. progress, if given, is called with the number of rows read so far
     state_dict = {}
-    # Open the state CSV file
-    with open(state_file, newline='', encoding='utf-8-sig') as csvfile:
-        # Create a CSV reader object
-        reader = csv.DictReader(csvfile)
-        # Loop through each row in the CSV file
-        for row in reader:
-            # If the EventCode is not a number, skip the row (Getting rid of values like MAPPING and ZT_PP_Condition3)
-            if row['EventCode'].isnumeric() == False:
-                continue
-            # Here we are filtering out the rows of the database by the event code that they have
-            if eventCodes is not None and row['EventCode'] not in eventCodes:
-                continue
-            if row['CaseID'] in state_dict:
-                # If the case ID already exists in the dictionary, check to see if the new row has a more recent add_time
+    # Parsed add_time of the row currently kept for a case, only filled in once the case has a duplicate
+    latest_times = {}
+    rows_read = 0
+    duplicates = 0
+    # Loop through each row of the state data
+    for row in records:
+        rows_read += 1
+        if progress is not None and rows_read % PROGRESS_INTERVAL == 0:
+            progress(rows_read)
+        # If the EventCode is not a number, skip the row (Getting rid of values like MAPPING and ZT_PP_Condition3)
+        if row[EVENT_CODE].isnumeric() == False:
+            continue
+        # Here we are filtering out the rows of the database by the event code that they have
+        if eventCodes is not None and row[EVENT_CODE] not in eventCodes:
+            continue
+        case_id = row[CASE_ID]
+        existing_row = state_dict.get(case_id)
+        if existing_row is not None:
+            # If the case ID already exists in the dictionary, check to see if the new row has a more recent add_time
+            duplicates += 1
+            new_date_string = row[ADD_TIME]
 
-                existing_date_string = state_dict[row['CaseID']]['add_time']
-                existing_datetime = parse_time(existing_date_string)
+            # Rows that only differ by race (from the Person_race join) share the same add_time, so skip parsing those
+            if new_date_string == existing_row[ADD_TIME]:
+                continue
 
-                new_date_string = row['add_time']
-                new_datetime = parse_time(new_date_string)
+            existing_datetime = latest_times.get(case_id)
+            if existing_datetime is None:
+                existing_datetime = parse_add_time(existing_row[ADD_TIME])
 
-                if new_datetime > existing_datetime:
-                    state_dict[row['CaseID']] = row
+            new_datetime = parse_add_time(new_date_string)
 
+            if new_datetime > existing_datetime:
+                state_dict[case_id] = row
+                latest_times[case_id] = new_datetime
             else:
-                # Add the row as a dictionary to the list
-                state_dict[row['CaseID']] = row
+                latest_times[case_id] = existing_datetime
+
+        else:
+            # Add the row's record to the dictionary
+            state_dict[case_id] = row
+
+    if counters is not None:
+        counters['stateRowsRead'] = counters.get('stateRowsRead', 0) + rows_read
+        counters['stateDuplicatesCollapsed'] = counters.get('stateDuplicatesCollapsed', 0) + duplicates
 
     return state_dict
 
-def get_cdc_dict(cdc_file, filterCDC = False):
-    cdc_dict = {}
-    # Open the cdc CSV file
-    cdcEventCodes = set() if filterCDC else None
+def get_cdc_event_codes(cdc_file):
+    # Only the EventCode column is needed, so this is a lot cheaper than building the whole CDC dictionary
+    if is_parquet(cdc_file):
+        import parquet_archive
+        return parquet_archive.column_set(cdc_file, 'EventCode')
     with open(cdc_file, newline='', encoding='utf-8-sig') as csvfile:
-        # Create a CSV reader object
-        reader = csv.DictReader(csvfile)
-        # Loop through each row in the CSV file
-        for row in reader:
-            # Add the row as a dictionary to the list
+        reader = csv.reader(csvfile)
+        code_index = next(reader, []).index('EventCode')
+        return {row[code_index] for row in reader if len(row) > code_index}
+
+class Reconciler:
+    """
+    Holds the results and stats of a single comparison run. Every run gets its own instance,
+    so several reconciliations can happen in the same process (one after another or in parallel threads).
+    """
+    def __init__(self, progress=None, normalizers=None, fast_ingest=True) -> None:
+        # optional progress callback, see ProgressReporter
+        self.progress = progress
+        # optional {attribute: normalizer name} for run / run_rows, see NORMALIZERS
+        self.normalizers = normalizers
+        # CSV files are read with fast_csv when it is available, see read_records
+        self.fast_ingest = fast_ingest
+        # dictionary holding all stats for this report
+        self.stats = {}
+        self.results: list[CaseResult] = []
+        # counts of how much work the run did, e.g. how many duplicate State rows were collapsed
+        self.counters = {}
+
+    def index_cdc_rows(self, rows, layout, filterCDC = False):
+        # rows are lists in the order of layout.header, the CDC case records are kept as layout.records makes them
+        return self.index_cdc_records(layout.records(rows), filterCDC)
+
+    def index_cdc_records(self, records, filterCDC = False):
+        cdc_dict = {}
+        cdcEventCodes = set() if filterCDC else None
+        rows_read = 0
+        if self.progress is not None:
+            self.progress('loading', 0)
+        # Loop through each row of the cdc data
+        for rows_read, row in enumerate(records, 1):
+            if self.progress is not None and rows_read % PROGRESS_INTERVAL == 0:
+                self.progress('loading', rows_read)
+            # Add the row's record to the dictionary
             if filterCDC:
-                cdcEventCodes.add(row['EventCode'])
-            if row['CaseID'] in cdc_dict:
-                results.append(CaseResult(row['CaseID'], row['EventCode'],
-                               row['EventName'], row['MMWRYear'], row['MMWRWeek'], "Duplicate CaseID found in CDC dataset", "1", row["CaseClassStatus"]))
-                
+                cdcEventCodes.add(row[EVENT_CODE])
+            if row[CASE_ID] in cdc_dict:
+                self.results.append(CaseResult(row[CASE_ID], row[EVENT_CODE],
+                               row[EVENT_NAME], row[MMWR_YEAR], row[MMWR_WEEK], "Duplicate CaseID found in CDC dataset", "1", row[CASE_CLASS_STATUS]))
+
                 # adding duplicates to duplicate count if needed
-                stats[row['EventCode']]['totalDuplicates'] += 1
-                
+                self.stats[row[EVENT_CODE]]['totalDuplicates'] += 1
+
             else:
-                cdc_dict[row['CaseID']] = row
-                if row['EventCode'] not in stats:
-                    stats[row['EventCode']] = {'eventName': row['EventName'], 'totalCases': 0, 'totalDuplicates': 0, 'totalMissingCDC': 0, 'totalMissingState': 0, 'totalWrongAttributes': 0}
-
-    return cdc_dict, cdcEventCodes
-
-# place the stats stuff here
-def comp(state_dict, cdc_dict, compare_attributes=None):
-    for state_case_id in state_dict:
-        state_row = state_dict[state_case_id]
-        
-        # checking if a given event code already exists in the stats dictionary
-        if state_row['EventCode'] in stats:
-            stats[state_row['EventCode']]['totalCases'] += 1
-        else:
-            stats[state_row['EventCode']] = {'eventName': state_row['EventName'], 'totalCases': 1, 'totalDuplicates': 0, 'totalMissingCDC': 0, 'totalMissingState': 0, 'totalWrongAttributes': 0}
-
-        # If a case ID is in the state DB but not the CDC DB, mark it as a missing case
-        if state_case_id not in cdc_dict:
-            results.append(CaseResult(
-                state_case_id, state_row['EventCode'], state_row['EventName'], state_row['MMWRYear'], state_row['MMWRWeek'], "CaseID not found in CDC dataset", "2", state_row["CaseClassStatus"]))
-            
-            # counting the missing case in totalMissingCDC for this eventCode
-            stats[state_row['EventCode']]['totalMissingCDC'] += 1
-            
-        else:
-            # Determine which attributes to compare: specified ones or all
-            attributes_to_compare = compare_attributes if compare_attributes is not None else state_row.keys()
-            att_list = []
-            for attribute in attributes_to_compare:
-                # Skip if the attribute is not in the CDC dict
-                if attribute not in cdc_dict[state_case_id]:
+                cdc_dict[row[CASE_ID]] = row
+                if row[EVENT_CODE] not in self.stats:
+                    self.stats[row[EVENT_CODE]] = {'eventName': row[EVENT_NAME], 'totalCases': 0, 'totalDuplicates': 0, 'totalMissingCDC': 0, 'totalMissingState': 0, 'totalWrongAttributes': 0}
+
+        self.counters['cdcRowsRead'] = self.counters.get('cdcRowsRead', 0) + rows_read
+        return cdc_dict, cdcEventCodes
+
+    def comp(self, state_dict, cdc_dict, state_layout, cdc_layout, compare_attributes=None):
+        plan, state_values, cdc_values, missing_attribute = comparison_plan(state_layout, cdc_layout, compare_attributes)
+
+        # Every State case and every CDC case that is left over gets looked at once
+        total_cases = len(state_dict) + len(cdc_dict) - len(state_dict.keys() & cdc_dict.keys()) if self.progress is not None else None
+        cases_done = 0
+        # Reported up front as well, so the phase timings have the comparison on its own even for small files
+        if self.progress is not None:
+            self.progress('comparing', 0, total_cases)
+        for state_case_id in state_dict:
+            cases_done += 1
+            if self.progress is not None and cases_done % PROGRESS_INTERVAL == 0:
+                self.progress('comparing', cases_done, total_cases)
+            state_row = state_dict[state_case_id]
+
+            # checking if a given event code already exists in the stats dictionary
+            if state_row[EVENT_CODE] in self.stats:
+                self.stats[state_row[EVENT_CODE]]['totalCases'] += 1
+            else:
+                self.stats[state_row[EVENT_CODE]] = {'eventName': state_row[EVENT_NAME], 'totalCases': 1, 'totalDuplicates': 0, 'totalMissingCDC': 0, 'totalMissingState': 0, 'totalWrongAttributes': 0}
+
+            # If a case ID is in the state DB but not the CDC DB, mark it as a missing case
+            if state_case_id not in cdc_dict:
+                self.results.append(CaseResult(
+                    state_case_id, state_row[EVENT_CODE], state_row[EVENT_NAME], state_row[MMWR_YEAR], state_row[MMWR_WEEK], "CaseID not found in CDC dataset", "2", state_row[CASE_CLASS_STATUS]))
+
+                # counting the missing case in totalMissingCDC for this eventCode
+                self.stats[state_row[EVENT_CODE]]['totalMissingCDC'] += 1
+
+            else:
+                # An attribute only the CDC data has cannot be compared, which is an error once there is a case to compare
+                if missing_attribute is not None:
+                    raise KeyError(missing_attribute)
+                # Remove the case from the CDC dict so we can track what cases are missing from the state side
+                cdc_row = cdc_dict.pop(state_case_id)
+
+                # Most cases match on every attribute, which a single comparison of all their values tells.
+                # Only the others are compared attribute by attribute, to find the ones that differ
+                if state_values is None or state_values(state_row) == cdc_values(cdc_row):
                     continue
+                att_list = []
+                for attribute, state_position, cdc_position in plan:
+                    state_attribute = state_row[state_position]
+                    cdc_attribute = cdc_row[cdc_position]
+
+                    if state_attribute == "":
+                        state_attribute = "NULL"
+
+                    if cdc_attribute == "":
+                        cdc_attribute = "NULL"
+
+                    # If a case has different attributes between state and CDC DBs, mark it as such
+                    if state_attribute != cdc_attribute:
+                        att_list.append(attribute)
+
+                if (att_list != []):
+                    wrong_attribute_string = ", ".join(att_list)
+                    reason_string = f"Case differs on {wrong_attribute_string} between State and CDC datasets"
+
+                    self.results.append(CaseResult(state_case_id, state_row[EVENT_CODE], state_row[EVENT_NAME], state_row[
+                                       MMWR_YEAR], state_row[MMWR_WEEK], reason_string, "3", state_row[CASE_CLASS_STATUS]))
+                    # making sure to also count this discrepancy in the stats.csv file
+                    self.stats[state_row[EVENT_CODE]]['totalWrongAttributes'] += 1
+
+        # If there exists cases in the CDC dictionary still, mark it as a missing case on the state side
+        for cdc_case_id in cdc_dict:
+            cases_done += 1
+            if self.progress is not None and cases_done % PROGRESS_INTERVAL == 0:
+                self.progress('comparing', cases_done, total_cases)
+            cdc_row = cdc_dict[cdc_case_id]
+            self.results.append(CaseResult(cdc_case_id, cdc_row[EVENT_CODE], cdc_row[EVENT_NAME],
+                           cdc_row[MMWR_YEAR], cdc_row[MMWR_WEEK], "CaseID not found in State dataset", "4", cdc_row[CASE_CLASS_STATUS]))
+
+            # adding in missing from state count, total case count, and caseID to the stats dict
+            # only counting cases that are not duplicates, otherwise counting as duplicate
+            if cdc_row[EVENT_CODE] in self.stats:
+                self.stats[cdc_row[EVENT_CODE]]['totalMissingState'] += 1
+                self.stats[cdc_row[EVENT_CODE]]['totalCases'] += 1
+            else:
+                self.stats[cdc_row[EVENT_CODE]] = {'eventName': cdc_row[EVENT_NAME], 'totalCases': 1, 'totalDuplicates': 0, 'totalMissingCDC': 0, 'totalMissingState': 1, 'totalWrongAttributes': 0}
+
+        self.counters['casesCompared'] = self.counters.get('casesCompared', 0) + cases_done
+        self.counters['discrepancies'] = len(self.results)
+
+    def run(self, cdc_file, state_file, filterCDC=False, compare_attributes=None):
+        cdc_layout, state_layout = row_layouts(read_header(cdc_file), read_header(state_file), compare_attributes, self.normalizers)
+        return self.run_records(read_records(cdc_file, cdc_layout, self.fast_ingest), read_records(state_file, state_layout, self.fast_ingest),
+                                cdc_layout, state_layout, filterCDC, compare_attributes)
 
-                state_attribute = state_row[attribute]
-                cdc_attribute = cdc_dict[state_case_id][attribute]
-
-                if state_attribute == "":
-                    state_attribute = "NULL"
-
-                if cdc_attribute == "":
-                    cdc_attribute = "NULL"
-
-                # If a case has different attributes between state and CDC DBs, mark it as such
-                if state_attribute != cdc_attribute:
-                    att_list.append(attribute)
-
-            if (att_list != []):
-                wrong_attribute_string = ", ".join(att_list)
-                reason_string = f"Case differs on {wrong_attribute_string} between State and CDC datasets"
-                
-                results.append(CaseResult(state_case_id, state_row['EventCode'], state_row['EventName'], state_row[
-                                   'MMWRYear'], state_row['MMWRWeek'], reason_string, "3", state_row["CaseClassStatus"]))
-                # making sure to also count this discrepancy in the stats.csv file
-                stats[state_row['EventCode']]['totalWrongAttributes'] += 1
-                
-            # Remove the case from the CDC dict so we can track what cases are missing from the state side
-            del cdc_dict[state_case_id]
-
-    # If there exists cases in the CDC dictionary still, mark it as a missing case on the state side
-    for cdc_case_id in cdc_dict:
-        cdc_row = cdc_dict[cdc_case_id]
-        results.append(CaseResult(cdc_case_id, cdc_row['EventCode'], cdc_row['EventName'],
-                       cdc_row['MMWRYear'], cdc_row['MMWRWeek'], "CaseID not found in State dataset", "4", cdc_row["CaseClassStatus"]))
-        
-        # adding in missing from state count, total case count, and caseID to the stats dict
-        # only counting cases that are not duplicates, otherwise counting as duplicate
-        if cdc_row['EventCode'] in stats:
-            stats[cdc_row['EventCode']]['totalMissingState'] += 1
-            stats[cdc_row['EventCode']]['totalCases'] += 1
+    def run_rows(self, cdc_file, state_header, state_rows, filterCDC=False, compare_attributes=None, state_phase='loading'):
+        # state_rows can be any iterable of rows in state_header's column order, e.g. rows streamed straight from
+        # the state database (in which case state_phase is reported as 'querying' while they come in)
+        cdc_layout, state_layout = row_layouts(read_header(cdc_file), state_header, compare_attributes, self.normalizers)
+        return self.run_records(read_records(cdc_file, cdc_layout, self.fast_ingest), state_layout.records(state_rows),
+                                cdc_layout, state_layout, filterCDC, compare_attributes, state_phase)
+
+    def run_records(self, cdc_records, state_records, cdc_layout, state_layout, filterCDC=False, compare_attributes=None,
+                    state_phase='loading'):
+        # The CDC file is read completely before the State records are
+        cdc_dict, cdcEventCodes = self.index_cdc_records(cdc_records, filterCDC)
+        state_progress = None
+        if self.progress is not None:
+            self.progress(state_phase, 0)
+            state_progress = lambda rows_read: self.progress(state_phase, rows_read)
+        state_dict = index_state_records(state_records, cdcEventCodes, self.counters, state_progress)
+        self.comp(state_dict, cdc_dict, state_layout, cdc_layout, compare_attributes)
+
+        # The reporter passes the counters on to whoever started the run (see ProgressReporter.record)
+        record = getattr(self.progress, 'record', None)
+        if record is not None:
+            record(**self.counters)
+        return self.results, self.stats
+
+# Comparison engines that can be picked with --engine
+ENGINES = ['python', 'columnar', 'streaming']
+
+def reconcile(cdc_file, state_file, filterCDC=False, compare_attributes=None, engine='python', workers=1, progress=None,
+              normalizers=None):
+    """
+    Runs a full comparison of a CDC and State CSV file and returns the (results, stats) for it.
+    With more than one worker, the python engine splits the cases over that many processes.
+    Only the single process python engine reports detailed progress, the others just report the 'comparing' phase.
+    normalizers ({attribute: normalizer name}, see NORMALIZERS) are used by every engine.
+    """
+    if progress is not None and (engine != 'python' or workers > 1):
+        progress('comparing', 0)
+    if engine == 'streaming' and (is_parquet(cdc_file) or is_parquet(state_file)):
+        raise ValueError("Parquet files can only be compared by the python or the columnar engine")
+    if workers > 1:
+        if engine != 'python':
+            raise ValueError(f"The {engine} engine does not support multiple workers")
+        import partitioned
+        return partitioned.reconcile(cdc_file, state_file, filterCDC, compare_attributes, workers, normalizers)
+    if engine == 'columnar':
+        # The columnar engine needs pandas, so only import it when it is asked for
+        import columnar
+        return columnar.reconcile(cdc_file, state_file, filterCDC, compare_attributes, normalizers)
+    if engine == 'streaming':
+        import streaming
+        run_results, run_stats = streaming.reconcile(cdc_file, state_file, filterCDC, compare_attributes,
+                                                     normalizers=normalizers)
+        return list(run_results), run_stats
+    if engine != 'python':
+        raise ValueError(f"Unknown comparison engine: {engine}")
+
+    return Reconciler(progress, normalizers).run(cdc_file, state_file, filterCDC, compare_attributes)
+
+RESULT_COLUMNS = ['CaseID', 'EventCode', 'EventName', 'MMWRYear', 'MMWRWeek', 'Reason', 'ReasonID', 'CaseClassStatus']
+
+def write_results(results, output_file, columns=RESULT_COLUMNS):
+    # Create Results CSV File and write the results to it. columns can leave off the last columns (cli.py does)
+    with open(output_file, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+
+        writer.writerow(columns)
+        if len(columns) < len(RESULT_COLUMNS):
+            writer.writerows(result.as_tuple()[:len(columns)] for result in results)
         else:
-            stats[cdc_row['EventCode']] = {'eventName': cdc_row['EventName'], 'totalCases': 1, 'totalDuplicates': 0, 'totalMissingCDC': 0, 'totalMissingState': 1, 'totalWrongAttributes': 0}
+            writer.writerows(result.as_tuple() for result in results)
+
+def stats_rows(stats):
+    # Flattens the stats dictionary into rows ordered like stats.csv and the Statistics table
+    for eventCode, data in stats.items():
+        yield (eventCode, data['eventName'], data['totalCases'], data['totalDuplicates'],
+               data['totalMissingCDC'], data['totalMissingState'], data['totalWrongAttributes'])
+
+def write_stats(stats, output_file):
+    # writing stats data to the csv
+    with open(output_file, 'w', newline='') as csvfile:
+        fieldNames = ['EventCode', 'EventName', 'TotalCases', 'TotalDuplicates',
+                      'TotalMissingFromCDC', 'TotalMissingFromState', 'TotalWrongAttributes']
+        writer = csv.writer(csvfile)
+
+        writer.writerow(fieldNames)
+        writer.writerows(stats_rows(stats))
 
 def main():
     parser = argparse.ArgumentParser(
         prog="CompareCDCAndState", description='Compare CDC and State CSV files')
-    parser.add_argument('-s', '--state', help='Local Path to State CSV file')
-    parser.add_argument('-c', '--cdc', help='Local Path to CDC CSV file')
+    parser.add_argument('-s', '--state', help='Local Path to State CSV (or Parquet) file')
+    parser.add_argument('-c', '--cdc', help='Local Path to CDC CSV (or Parquet) file')
     parser.add_argument('-o', '--output', help='Local Path to Output CSV file')
     # if the parameter below is specified the value stored is true
     parser.add_argument('-f', '--filter', action='store_true', help='Filter by CDC eventCodes')
     parser.add_argument('-a', '--attributes', nargs='*', help='Attributes to compare')
+    parser.add_argument('-e', '--engine', choices=ENGINES, default='python',
+                        help='Comparison engine, columnar needs pandas but is much faster on large files')
+    parser.add_argument('-m', '--memory-limit', type=int,
+                        help='Memory ceiling in MB for the streaming engine, rows over it are sorted on disk')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of processes to split the cases over (python engine only)')
+    parser.add_argument('-n', '--normalize', nargs='*', metavar='ATTRIBUTE=NORMALIZER', default=[],
+                        help=f'Normalize an attribute before comparing it, e.g. BirthDate=date (normalizers: {", ".join(NORMALIZERS)})')
+    parser.add_argument('--csv-reader', default=False, action='store_true',
+                        help='Read the files with csv.reader even if pyarrow is installed (python engine, single worker)')
+    parser.add_argument('-p', '--profile',
+                        help='Profile the run with cProfile and write the stats to this file (and a summary to FILE.txt)')
     args = parser.parse_args()
 
-    cdc_dict, cdcEventCodes = get_cdc_dict(args.cdc, args.filter)
-    state_dict = get_state_dict(args.state, cdcEventCodes)
-    comp(state_dict, cdc_dict, args.attributes)
-
-    # Create Results CSV File and write the results to it
-    with open(args.output, 'w', newline='') as csvfile:
-        fieldnames = ['CaseID', 'EventCode', 'EventName', 'MMWRYear',
-                      'MMWRWeek', 'Reason', 'ReasonID', 'CaseClassStatus']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-        writer.writeheader()
-        for result in results:
-            writer.writerow({'CaseID': result.caseID, 'EventCode': result.eventCode, 'EventName': result.eventName,'MMWRYear': result.MMWRYear,
-                            'MMWRWeek': result.MMWRWeek, 'Reason': result.reason, 'ReasonID': result.reasonID, 'CaseClassStatus':result.caseClassStatus})
-            
+    if args.workers > 1 and args.engine != 'python':
+        parser.error('--workers can only be used with the python engine')
+    normalizers = dict(spec.split('=', 1) for spec in args.normalize if '=' in spec)
+    if len(normalizers) != len(args.normalize):
+        parser.error('--normalize takes ATTRIBUTE=NORMALIZER pairs')
+    try:
+        resolve_normalizers(normalizers)
+    except ValueError as e:
+        parser.error(str(e))
+
     # writing to stats.csv but first grabbing the folder location of results.csv
     output_directory = os.path.dirname(args.output)
     if output_directory == '':
         output_directory = '.'
-    
-    # writing stats data to the csv
-    with open(os.path.join(output_directory, 'stats.csv'), 'w', newline='') as csvfile:
-        fieldNames = ['EventCode', 'EventName', 'TotalCases', 'TotalDuplicates',
-                      'TotalMissingFromCDC', 'TotalMissingFromState', 'TotalWrongAttributes']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldNames)
-        
-        writer.writeheader()
-        for eventCode, data in stats.items():
-            writer.writerow({'EventCode': eventCode, 'EventName': data['eventName'], 'TotalCases': data['totalCases'],
-                             'TotalDuplicates': data['totalDuplicates'], 'TotalMissingFromCDC': data['totalMissingCDC'],
-                             'TotalMissingFromState': data['totalMissingState'], 'TotalWrongAttributes': data['totalWrongAttributes']})
+
+    import metrics
+    with metrics.profiled(args.profile):
+        run_cli(args, output_directory, normalizers)
+
+def run_cli(args, output_directory, normalizers):
+    if args.engine == 'streaming':
+        # Results are written straight from the merge so memory stays flat no matter how big the files are
+        import streaming
+        run_results, run_stats = streaming.reconcile(args.cdc, args.state, args.filter, args.attributes,
+                                                     args.memory_limit or streaming.DEFAULT_MEMORY_LIMIT,
+                                                     normalizers=normalizers)
+    elif args.engine == 'python' and args.workers == 1:
+        reconciler = Reconciler(normalizers=normalizers, fast_ingest=not args.csv_reader)
+        run_results, run_stats = reconciler.run(args.cdc, args.state, args.filter, args.attributes)
+        print(f"Collapsed {reconciler.counters['stateDuplicatesCollapsed']} duplicate State rows "
+              f"out of {reconciler.counters['stateRowsRead']} rows read")
+    else:
+        run_results, run_stats = reconcile(args.cdc, args.state, args.filter, args.attributes, args.engine, args.workers,
+                                           normalizers=normalizers)
+
+    write_results(run_results, args.output)
+
+    write_stats(run_stats, os.path.join(output_directory, 'stats.csv'))
 
 if __name__ == "__main__":
     main()
@@ -1,39 +1,138 @@
+import argparse
 import csv
+import os
 import random
 import uuid
 
-def read_csv_to_dict(file_path):
-    data_dict = {}
-    with open(file_path, 'r') as file:
-        reader = csv.DictReader(file)
-        i = 0
-        for row in reader:
-            data_dict[i] = row
-            i += 1
-    return data_dict
-
-cdc_file_path = 'cdc.csv'
-cdc_data_dict = read_csv_to_dict(cdc_file_path)
-
-state_file_path = 'state.csv'
-state_data_dict = read_csv_to_dict(state_file_path)
-
-# Create two new files, cdc_bench.csv and state_bench.csv, each benchmark csv file should contain 1000000 rows of data
-# The CaseID column should be randomly generated and unique while the other columns should be taken from random rows in the original files
-def generate_benchmark_csv(file_path, data_dict, unique_ids):
-    with open(file_path, 'w', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=data_dict[0].keys())
-        writer.writeheader()
-        for id in unique_ids:
-            random_row = random.choice(list(data_dict.values()))
-            random_row['CaseID'] = id
-            writer.writerow(random_row)
-
-benchmark_num_rows = 1000000
-benchmark_ids = [str(uuid.uuid4()) for _ in range(benchmark_num_rows)]
-
-cdc_bench_file_path = 'cdc_bench.csv'
-generate_benchmark_csv(cdc_bench_file_path, cdc_data_dict, benchmark_ids)
-
-state_bench_file_path = 'state_bench.csv'
-generate_benchmark_csv(state_bench_file_path, state_data_dict, benchmark_ids)
+# Generates a CDC and a State CSV file for benchmarking. Every value is drawn from a seeded random generator, so the
+# same arguments always give the same files. The rows are built from the example data (for the columns and values),
+# with the rates below controlling how many discrepancies of each kind the comparison will find
+
+example_folder = os.path.join(os.path.dirname(__file__), "example-data")
+
+DEFAULTS = {
+    'cases': 1000000,
+    'duplicate_rate': 0.02,
+    'missing_cdc_rate': 0.02,
+    'missing_state_rate': 0.02,
+    'mismatch_rate': 0.05,
+    'event_codes': 18,
+    'max_races': 3,
+    'updated_rate': 0.05,
+    'seed': 0,
+}
+
+# Columns the State rows share with the CDC rows, their values are copied over from the case's CDC row
+SHARED_COLUMNS = ['CountyReporting', 'EventName', 'EventCode', 'MMWRYear', 'MMWRWeek', 'CaseClassStatus',
+                  'Sex', 'BirthDate', 'Age', 'AgeType', 'Race', 'Ethnicity']
+
+# Attributes that are changed on the State side of a mismatched case
+MISMATCH_COLUMNS = ['CaseClassStatus', 'MMWRWeek', 'Sex', 'BirthDate', 'Age', 'Ethnicity', 'CountyReporting']
+
+def read_rows(file_path):
+    with open(file_path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        return reader.fieldnames, list(reader)
+
+def event_code_pool(template_rows, count):
+    # The example event codes first, then made up ones if more are asked for
+    codes = sorted({(row['EventCode'], row['EventName']) for row in template_rows})
+    codes += [(str(900000 + i), f"Benchmark Condition {i}") for i in range(max(0, count - len(codes)))]
+    return codes[:count]
+
+def random_time(rng, year=2023):
+    return (f"{year}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02} "
+            f"{rng.randint(0, 23):02}:{rng.randint(0, 59):02}:{rng.randint(0, 59):02}.{rng.randint(0, 999):03}")
+
+def changed_value(rng, value):
+    # Any value that is not the original one
+    return value + "X" if rng.random() < 0.5 or not value.isdigit() else str(int(value) + rng.randint(1, 9))
+
+def generate(cdc_path, state_path, cases=DEFAULTS['cases'], duplicate_rate=DEFAULTS['duplicate_rate'],
+             missing_cdc_rate=DEFAULTS['missing_cdc_rate'], missing_state_rate=DEFAULTS['missing_state_rate'],
+             mismatch_rate=DEFAULTS['mismatch_rate'], event_codes=DEFAULTS['event_codes'], max_races=DEFAULTS['max_races'],
+             updated_rate=DEFAULTS['updated_rate'], seed=DEFAULTS['seed'], cdc_template=None, state_template=None):
+    """
+    Writes cases cases to the two files and returns the number of rows and discrepancies of each kind it generated.
+    missing_cdc_rate / missing_state_rate of the cases are only on the State / CDC side, duplicate_rate of the
+    CDC cases get a second row and mismatch_rate of the cases on both sides differ on one attribute.
+    Like query.sql's Person_race join, every State case has 1 to max_races rows, one per race, and updated_rate of
+    the extra rows have a later add_time (so they are the row the dedup has to keep).
+    """
+    rng = random.Random(seed)
+    cdc_header, cdc_templates = read_rows(cdc_template or os.path.join(example_folder, "cdc.csv"))
+    state_header, _ = read_rows(state_template or os.path.join(example_folder, "state.csv"))
+    codes = event_code_pool(cdc_templates, event_codes)
+
+    summary = {'cdcRows': 0, 'stateRows': 0, 'duplicates': 0, 'missingCDC': 0, 'missingState': 0, 'mismatched': 0}
+    with open(cdc_path, 'w', newline='', encoding='utf-8') as cdc_file, open(state_path, 'w', newline='', encoding='utf-8') as state_file:
+        cdc_writer = csv.DictWriter(cdc_file, fieldnames=cdc_header)
+        state_writer = csv.DictWriter(state_file, fieldnames=state_header)
+        cdc_writer.writeheader()
+        state_writer.writeheader()
+
+        for _ in range(cases):
+            row = dict(rng.choice(cdc_templates))
+            row['CaseID'] = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+            row['EventCode'], row['EventName'] = codes[rng.randrange(len(codes))]
+
+            side = rng.random()
+            in_cdc = side >= missing_cdc_rate
+            in_state = side < 1 - missing_state_rate
+
+            if in_cdc:
+                cdc_writer.writerow(row)
+                summary['cdcRows'] += 1
+                if rng.random() < duplicate_rate:
+                    cdc_writer.writerow(dict(row, TransactionID=str(rng.getrandbits(32))))
+                    summary['cdcRows'] += 1
+                    summary['duplicates'] += 1
+            if not in_state:
+                summary['missingState'] += 1
+                continue
+            if not in_cdc:
+                summary['missingCDC'] += 1
+
+            state_row = {column: row[column] for column in SHARED_COLUMNS}
+            state_row['CaseID'] = row['CaseID']
+            if in_cdc and rng.random() < mismatch_rate:
+                column = rng.choice(MISMATCH_COLUMNS)
+                state_row[column] = changed_value(rng, state_row[column])
+                summary['mismatched'] += 1
+
+            # The first row carries the CDC race, the extra rows are other races at the same add_time or later updates of the case
+            add_time = random_time(rng)
+            state_writer.writerow(dict(state_row, add_time=add_time))
+            summary['stateRows'] += 1
+            for race in range(rng.randint(1, max_races) - 1):
+                if rng.random() < updated_rate:
+                    # A later add_time makes this the row the dedup keeps, so it has to match the CDC data too
+                    state_writer.writerow(dict(state_row, add_time=random_time(rng, 2024)))
+                else:
+                    state_writer.writerow(dict(state_row, add_time=add_time, Race=str((race + 2) % 7)))
+                summary['stateRows'] += 1
+
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(prog="CreateBenchmarkData", description='Generate seeded CDC and State benchmark files')
+    parser.add_argument('-o', '--output', default='.', help='Folder to write cdc_bench.csv and state_bench.csv to')
+    parser.add_argument('-n', '--cases', type=int, default=DEFAULTS['cases'], help='Number of cases')
+    parser.add_argument('--duplicate-rate', type=float, default=DEFAULTS['duplicate_rate'], help='Rate of CDC cases with a duplicate row')
+    parser.add_argument('--missing-cdc-rate', type=float, default=DEFAULTS['missing_cdc_rate'], help='Rate of cases only in the State data')
+    parser.add_argument('--missing-state-rate', type=float, default=DEFAULTS['missing_state_rate'], help='Rate of cases only in the CDC data')
+    parser.add_argument('--mismatch-rate', type=float, default=DEFAULTS['mismatch_rate'], help='Rate of cases that differ on an attribute')
+    parser.add_argument('--event-codes', type=int, default=DEFAULTS['event_codes'], help='Number of different event codes')
+    parser.add_argument('--max-races', type=int, default=DEFAULTS['max_races'], help='Most State rows per case')
+    parser.add_argument('--updated-rate', type=float, default=DEFAULTS['updated_rate'], help='Rate of extra State rows with a later add_time')
+    parser.add_argument('--seed', type=int, default=DEFAULTS['seed'], help='Random seed')
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    summary = generate(os.path.join(args.output, 'cdc_bench.csv'), os.path.join(args.output, 'state_bench.csv'),
+                       args.cases, args.duplicate_rate, args.missing_cdc_rate, args.missing_state_rate, args.mismatch_rate,
+                       args.event_codes, args.max_races, args.updated_rate, args.seed)
+    print(", ".join(f"{key}: {value}" for key, value in summary.items()))
+
+if __name__ == "__main__":
+    main()
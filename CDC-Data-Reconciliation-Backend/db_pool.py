@@ -0,0 +1,143 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Pool of connections to the state database for state_query. Connections are only opened when a query needs one,
+# are checked before they are handed out, and a dead connection is replaced (with retries) instead of breaking
+# every automatic report until the server is restarted.
+
+DEFAULT_MAX_SIZE = 2
+DEFAULT_RETRIES = 3
+# Seconds to wait before the first retry, doubled for every retry after that
+DEFAULT_BACKOFF = 1.0
+LIVENESS_QUERY = "SELECT 1"
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    """
+    Lazily opened, size bounded pool of DB-API connections. connect() opens a new connection,
+    e.g. pyodbc.connect for the state database or sqlite3.connect to try the pool out locally.
+    query_timeout (seconds, 0 for none) is set on every connection that supports it (pyodbc does).
+    """
+    def __init__(self, connect, max_size=DEFAULT_MAX_SIZE, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 query_timeout=0, wait_timeout=None) -> None:
+        self.connect = connect
+        self.max_size = max_size
+        self.retries = retries
+        self.backoff = backoff
+        self.query_timeout = query_timeout
+        # How long acquire waits for a connection when all of them are in use, None waits as long as it takes
+        self.wait_timeout = wait_timeout
+        self.idle = []
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.lock = threading.Lock()
+        self.counters = {'opened': 0, 'reused': 0, 'replaced': 0, 'retries': 0}
+
+    def open(self):
+        # Opening a connection is retried with backoff, the database may be restarting or briefly unreachable
+        for attempt in range(self.retries + 1):
+            try:
+                conn = self.connect()
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                print(f"Could not connect to the state database ({e}), retrying")
+                self.wait(attempt)
+        if self.query_timeout:
+            try:
+                conn.timeout = self.query_timeout
+            except AttributeError:
+                pass
+        self.counters['opened'] += 1
+        return conn
+
+    def wait(self, attempt):
+        self.counters['retries'] += 1
+        time.sleep(self.backoff * 2 ** attempt)
+
+    def is_alive(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute(LIVENESS_QUERY)
+            cursor.fetchall()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """
+        Returns a live connection, reusing an idle one if there is one. Blocks while max_size connections are in use.
+        """
+        # A timeout of None blocks until a slot is free (a negative one would not wait at all)
+        if not self.slots.acquire(timeout=self.wait_timeout):
+            raise PoolTimeout(f"All {self.max_size} state database connections are in use")
+        try:
+            while True:
+                with self.lock:
+                    conn = self.idle.pop() if self.idle else None
+                if conn is None:
+                    return self.open()
+                if self.is_alive(conn):
+                    self.counters['reused'] += 1
+                    return conn
+                # Dropped while it was idle (e.g. the server restarted or a firewall timed it out)
+                self.counters['replaced'] += 1
+                self.discard(conn)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, conn, broken=False):
+        if broken:
+            self.discard(conn)
+        else:
+            with self.lock:
+                self.idle.append(conn)
+        self.slots.release()
+
+    @contextmanager
+    def query(self, run):
+        """
+        Calls run(connection) (e.g. to execute a query and return its cursor) and yields what it returns, keeping the
+        connection checked out until the block is done with it. If run fails because the connection died, it is tried
+        again on a new connection. Errors on a connection that is still alive (bad SQL, query timeouts) are raised as is.
+        """
+        attempt = 0
+        while True:
+            conn = self.acquire()
+            try:
+                result = run(conn)
+                break
+            except Exception:
+                alive = self.is_alive(conn)
+                self.release(conn, broken=not alive)
+                if alive or attempt == self.retries:
+                    raise
+                self.counters['replaced'] += 1
+                self.wait(attempt)
+                attempt += 1
+
+        broken = False
+        try:
+            yield result
+        except BaseException:
+            broken = not self.is_alive(conn)
+            raise
+        finally:
+            self.release(conn, broken)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            self.discard(conn)
@@ -0,0 +1,102 @@
+from sys import intern
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+from compare import EVENT_CODE, CASE_CLASS_STATUS
+
+# Fast path behind compare.read_records. pyarrow cuts the CSV file into blocks that end on a row boundary (quote
+# aware, so a newline inside a quoted value never splits a row) and parses the blocks ahead of time on its own threads,
+# keeping only the columns of the RowLayout. The records are then put together column by column, a block at a time.
+# The blocks are read one after the other, so memory mapping the file did not make this faster, it only added the
+# mapped file to the peak memory use.
+# Rows csv.reader reads differently (a different number of fields than the header, e.g. short rows that
+# RowLayout.records pads with None) are an error for pyarrow, the rest of the file is read with csv.reader then.
+
+# Bytes of the file in every block
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# Columns that are (nearly) unique per row. The others are read dictionary encoded, which is smaller and means
+# every distinct value only has to be turned into a Python string once per block
+UNIQUE_COLUMNS = {'CaseID', 'add_time'}
+
+class Unsupported(Exception):
+    """
+    pyarrow cannot read (the rest of) the file exactly like csv.reader. records_read is how many records
+    were read before that, the rows after them have to be read with csv.reader.
+    """
+    def __init__(self, records_read=0) -> None:
+        super().__init__(records_read)
+        self.records_read = records_read
+
+def read_records(file_path, layout):
+    """
+    Yields the records of every row of a CSV file, the same ones layout.records makes from csv.reader's rows.
+    Raises Unsupported once it gets to a row it cannot read like csv.reader.
+    """
+    positions = list(dict.fromkeys(layout.positions))
+    for batch in read_batches(file_path, layout):
+        yield from batch_records({position: batch.column(f"c{position}") for position in positions}, layout)
+    # Hand the memory of the parsed blocks back, the comparison needs it for the records
+    pa.default_memory_pool().release_unused()
+
+def batch_records(arrays, layout):
+    """
+    Returns the records made of a block of rows, arrays being {position in the header: Arrow array of the column}
+    for the columns of the layout.
+    """
+    interned = set(layout.positions[EVENT_CODE:CASE_CLASS_STATUS + 1])
+    normalizers = dict(layout.normalized)
+    columns = {position: column_values(array, position in interned, normalizers.get(position))
+               for position, array in arrays.items()}
+    copies = [column_values(arrays[position], position in interned, normalize) for position, normalize in layout.copies]
+    return zip(*[columns[position] for position in layout.positions], *copies)
+
+def read_batches(file_path, layout):
+    """
+    Yields the parsed blocks of a CSV file as Arrow record batches of the layout's columns, the column at position i
+    of the header named c{i}. Raises Unsupported once it gets to a row it cannot read like csv.reader.
+    """
+    if layout.missing or not layout.header:
+        raise Unsupported()
+    # The file's own header is skipped and the columns named by position, so duplicate column names work the same
+    # as in RowLayout (which uses the last one)
+    names = [f"c{position}" for position in range(len(layout.header))]
+    positions = list(dict.fromkeys(layout.positions))
+    column_types = {names[position]: pa.string() if layout.header[position] in UNIQUE_COLUMNS else pa.dictionary(pa.int32(), pa.string())
+                    for position in positions}
+
+    records_read = 0
+    with pa.OSFile(file_path, 'r') as source:
+        try:
+            reader = pa_csv.open_csv(source,
+                                     read_options=pa_csv.ReadOptions(column_names=names, skip_rows=1, block_size=BLOCK_SIZE),
+                                     parse_options=pa_csv.ParseOptions(newlines_in_values=True, ignore_empty_lines=True),
+                                     convert_options=pa_csv.ConvertOptions(include_columns=[names[position] for position in positions],
+                                                                           column_types=column_types, strings_can_be_null=False))
+        except pa.ArrowException as e:
+            raise Unsupported() from e
+        while True:
+            try:
+                batch = reader.read_next_batch()
+            except StopIteration:
+                break
+            except pa.ArrowException as e:
+                raise Unsupported(records_read) from e
+            yield batch
+            records_read += batch.num_rows
+
+def column_values(array, intern_values=False, normalize=None):
+    # The values of an Arrow array as a list of Python strings, normalized (the non-empty ones) if normalize is given
+    if pa.types.is_dictionary(array.type):
+        distinct = array.dictionary.to_pylist()
+        if intern_values:
+            distinct = [intern(value) for value in distinct]
+        if normalize is not None:
+            distinct = [normalize(value) if value else value for value in distinct]
+        return np.array(distinct, dtype=object)[array.indices.to_numpy()].tolist()
+    values = array.to_pylist()
+    if normalize is not None:
+        values = [normalize(value) if value else value for value in values]
+    return values
@@ -0,0 +1,130 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+from contextlib import contextmanager
+
+# Timings and counters of report runs. The server adds every finished job to a Metrics registry, which /metrics
+# shows in the Prometheus text format. The helpers below measure a comparison from inside the worker process.
+
+PREFIX = "cdc_reconciliation_"
+
+# Functions listed in the text summary written next to a profile
+PROFILE_SUMMARY_LINES = 40
+
+class Metrics:
+    """
+    In memory registry of counters and gauges, each one a number per set of labels.
+    Only lives as long as the server process, like the job list.
+    """
+    def __init__(self) -> None:
+        # name -> (type, help text), in the order they were declared
+        self.declared = {}
+        # name -> {sorted label pairs: value}
+        self.values = {}
+
+    def declare(self, name, kind, help_text):
+        self.declared[name] = (kind, help_text)
+        self.values.setdefault(name, {})
+
+    def labels_key(self, labels):
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        values = self.values[name]
+        key = self.labels_key(labels)
+        values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        self.values[name][self.labels_key(labels)] = value
+
+    def render(self, extra=()):
+        """
+        The registry in the Prometheus text exposition format. extra are (name, type, help text, {labels: value})
+        of values that are read when the metrics are scraped (e.g. jobs currently running).
+        """
+        families = [(name, kind, help_text, self.values[name]) for name, (kind, help_text) in self.declared.items()]
+        families += [(name, kind, help_text, {self.labels_key(labels): value for labels, value in samples})
+                     for name, kind, help_text, samples in extra]
+        lines = []
+        for name, kind, help_text, samples in families:
+            lines.append(f"# HELP {PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            for labels, value in samples.items():
+                label_text = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels)
+                sample_name = f"{PREFIX}{name}{{{label_text}}}" if label_text else f"{PREFIX}{name}"
+                lines.append(f"{sample_name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_value(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+def peak_rss_mb():
+    """
+    Highest resident set size of this process in MB, since it started or since reset_peak_rss.
+    None where neither /proc nor the resource module are there (Windows).
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def reset_peak_rss():
+    # Worker processes run many reports, on Linux the peak can be reset so it only covers the next one.
+    # Elsewhere the peak stays the worker's highest so far
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+@contextmanager
+def profiled(profile_to):
+    """
+    Runs the block under cProfile and writes the stats to profile_to (for pstats or snakeviz),
+    plus the functions that took the most time overall as text to profile_to + ".txt".
+    Does nothing if profile_to is None.
+    """
+    if profile_to is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(os.path.abspath(profile_to)), exist_ok=True)
+        profiler.dump_stats(profile_to)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(PROFILE_SUMMARY_LINES)
+        with open(profile_to + ".txt", "w") as f:
+            f.write(summary.getvalue())
+
+def run_measured(function, progress, profile_to, *args):
+    """
+    Runs function(*args) in a comparison worker and returns what it returns. The worker's peak memory during the
+    run is recorded through progress (a compare.ProgressReporter), and with profile_to set the run is profiled.
+    """
+    reset_peak_rss()
+    try:
+        with profiled(profile_to):
+            return function(*args)
+    finally:
+        if progress is not None:
+            progress.end_phase()
+            progress.record(workerPeakRSSMB=peak_rss_mb())
@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+from itertools import islice
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import compare
+import fast_csv
+
+# Parquet files for the report archive. The CDC and State files of a report are kept with every value as the string
+# csv.reader reads (None for the missing fields of short rows), so compare.py reads an archived file back into the same
+# records as the CSV file it came from and a report can be run again with other attributes or normalizers. Parquet
+# stores every column on its own, zstd compressed and dictionary encoded, so a new run only reads the columns it
+# compares and the files take a fraction of the CSV's disk space.
+
+# Key of the file metadata that holds the CSV file's header (it can have a column more than once, Parquet cannot)
+HEADER_KEY = b'cdc_reconciliation.header'
+
+RESULT_COLUMNS = ['CaseID', 'EventCode', 'EventName', 'MMWRYear', 'MMWRWeek', 'Reason', 'ReasonID', 'CaseClassStatus']
+STATS_COLUMNS = ['EventCode', 'EventName', 'TotalCases', 'TotalDuplicates', 'TotalMissingFromCDC', 'TotalMissingFromState',
+                 'TotalWrongAttributes']
+
+# Rows per row group when writing. Bigger row groups compress better
+ROW_GROUP_SIZE = 131072
+
+# Rows per batch when reading, smaller batches keep less decoded data in memory next to the records made of it
+READ_BATCH_SIZE = 32768
+
+def read_header(file_path):
+    schema = pq.read_schema(file_path)
+    header = (schema.metadata or {}).get(HEADER_KEY)
+    return json.loads(header) if header is not None else schema.names
+
+def read_records(file_path, layout):
+    """
+    Yields the records of every row of a Parquet file, like compare.read_records does for a CSV file.
+    Only the columns of the layout are read.
+    """
+    for arrays in read_arrays(file_path, layout):
+        yield from fast_csv.batch_records(arrays, layout)
+
+def read_arrays(file_path, layout):
+    # Yields the layout's columns a batch of rows at a time, as {position in the header: Arrow string array}
+    parquet_file = pq.ParquetFile(file_path)
+    if layout.missing:
+        # A required column the file does not have is an error as soon as there is a row, like with csv.reader
+        if parquet_file.metadata.num_rows:
+            raise KeyError(layout.missing[0])
+        return
+    positions = list(dict.fromkeys(layout.positions))
+    names = {position: layout.header[position] for position in positions}
+    # The columns with few distinct values are read as dictionaries, so each of those is only turned into a
+    # Python string once per batch
+    schema = parquet_file.schema_arrow
+    dictionary_columns = [name for name in names.values()
+                          if name not in fast_csv.UNIQUE_COLUMNS and pa.types.is_string(schema.field(name).type)]
+    parquet_file = pq.ParquetFile(file_path, read_dictionary=dictionary_columns)
+
+    for batch in parquet_file.iter_batches(batch_size=READ_BATCH_SIZE, columns=list(names.values())):
+        yield {position: string_array(batch.column(names[position])) for position in positions}
+
+def string_array(array):
+    # Files written by other tools can have typed columns or nulls in a dictionary column, those are read as strings
+    if pa.types.is_dictionary(array.type) and (array.null_count or not pa.types.is_string(array.type.value_type)):
+        array = array.dictionary_decode()
+    if not pa.types.is_dictionary(array.type) and not pa.types.is_string(array.type):
+        array = array.cast(pa.string())
+    return array
+
+def column_set(file_path, column):
+    # The distinct values of one column, e.g. the event codes of a CDC file
+    values = pq.read_table(file_path, columns=[column]).column(column).unique()
+    return {value for value in string_array(values).to_pylist() if value is not None}
+
+def write_input(csv_file, parquet_file, fast=True):
+    """
+    Writes a CDC or State CSV file as a Parquet file compare.py can read instead. Every column is kept (the last one,
+    if the header has a column twice) with the values compare.read_records reads from the CSV file. The blocks fast_csv
+    parses are written as they are, from the first row it cannot read like csv.reader on the file is read with csv.reader.
+    """
+    header = compare.read_header(csv_file)
+    required = compare.STATE_REQUIRED_COLUMNS if 'add_time' in header else compare.CDC_REQUIRED_COLUMNS
+    layout = compare.RowLayout(header, required, header)
+    if layout.missing:
+        raise ValueError(f"{csv_file} is not a CDC or State file, it has no {layout.missing[0]} column")
+
+    last_positions = {column: position for position, column in enumerate(header)}
+    columns = sorted(last_positions, key=last_positions.get)
+    schema = pa.schema([(column, pa.string()) for column in columns], metadata={HEADER_KEY: json.dumps(header)})
+    with pq.ParquetWriter(parquet_file, schema, compression='zstd') as writer:
+        records_written = write_blocks(writer, csv_file, layout, schema) if fast else 0
+        if records_written is None:
+            return
+
+        # csv.reader from the start, or from the row fast_csv stopped at
+        indexes = [layout.index[column] for column in columns]
+        records = islice(compare.read_records(csv_file, layout, fast=False), records_written, None)
+        while True:
+            batch = list(islice(records, ROW_GROUP_SIZE))
+            if not batch:
+                break
+            values = list(zip(*batch))
+            writer.write_table(pa.Table.from_arrays([pa.array(values[index], pa.string()) for index in indexes], schema=schema))
+
+def write_blocks(writer, csv_file, layout, schema):
+    # Writes the blocks fast_csv parses, collected into row groups of ROW_GROUP_SIZE rows (which compress better).
+    # Returns None once the whole file is written, or how many rows were if fast_csv cannot read the rest
+    last_positions = {column: position for position, column in enumerate(layout.header)}
+    pending = []
+    records_read = None
+    try:
+        for batch in fast_csv.read_batches(csv_file, layout):
+            pending.append(pa.record_batch([batch.column(f"c{last_positions[column]}").cast(pa.string()) for column in schema.names],
+                                           schema=schema))
+            if sum(block.num_rows for block in pending) >= ROW_GROUP_SIZE:
+                writer.write_table(pa.Table.from_batches(pending), row_group_size=ROW_GROUP_SIZE)
+                pending = []
+    except fast_csv.Unsupported as e:
+        records_read = e.records_read
+    if pending:
+        writer.write_table(pa.Table.from_batches(pending), row_group_size=ROW_GROUP_SIZE)
+    return records_read
+
+def write_results(results, output_file):
+    # Same columns as results.csv, with the same strings in them
+    schema = pa.schema([(column, pa.string()) for column in RESULT_COLUMNS])
+    results = iter(results)
+    with pq.ParquetWriter(output_file, schema, compression='zstd') as writer:
+        while True:
+            batch = [result.as_tuple() for result in islice(results, ROW_GROUP_SIZE)]
+            if not batch:
+                break
+            writer.write_table(pa.Table.from_arrays([pa.array(values, pa.string()) for values in zip(*batch)], schema=schema))
+
+def write_stats(stats, output_file):
+    # Same columns as stats.csv, the totals as integers
+    values = list(zip(*compare.stats_rows(stats))) or [()] * len(STATS_COLUMNS)
+    arrays = [pa.array(column, pa.string() if i < 2 else pa.int64()) for i, column in enumerate(values)]
+    pq.write_table(pa.Table.from_arrays(arrays, names=STATS_COLUMNS), output_file, compression='zstd')
+
+def main():
+    parser = argparse.ArgumentParser(prog="ParquetArchive", description='Convert CDC and State CSV files to Parquet files compare.py can read')
+    parser.add_argument('files', nargs='+', help='CSV files, each one is written next to itself as FILE.parquet')
+    args = parser.parse_args()
+
+    for csv_file in args.files:
+        parquet_file = os.path.splitext(csv_file)[0] + ".parquet"
+        write_input(csv_file, parquet_file)
+        print(f"{csv_file} ({os.path.getsize(csv_file) / 2**20:.1f} MB) -> {parquet_file} ({os.path.getsize(parquet_file) / 2**20:.1f} MB)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
+from operator import itemgetter
+
+from compare import (CaseResult, Reconciler, index_state_records, is_parquet, read_header, read_records, row_layouts, CASE_ID,
+                     EVENT_CODE, EVENT_NAME)
+
+# Results are merged back in the same order as compare.Reconciler: CDC duplicates first,
+# then the State cases in the order they appear, then the cases missing from the State side
+DUPLICATE_PHASE = 0
+STATE_PHASE = 1
+MISSING_STATE_PHASE = 2
+
+STAT_COUNTERS = ['totalCases', 'totalDuplicates', 'totalMissingCDC', 'totalMissingState', 'totalWrongAttributes']
+
+# 32 bit FNV-1a of a CaseID's UTF-8 bytes picks its partition. Unlike hash() it is the same in every process, and
+# partition_hashes can work it out with numpy for a whole Arrow array of CaseIDs at once
+FNV_OFFSET = 2166136261
+FNV_PRIME = 16777619
+
+def partition_of(caseID, partitions):
+    hashed = FNV_OFFSET
+    for byte in (caseID or '').encode('utf-8'):
+        hashed = ((hashed ^ byte) * FNV_PRIME) & 0xffffffff
+    return hashed % partitions
+
+def partition_hashes(array, partitions):
+    # partition_of of every value of an Arrow string array, one byte position of all the values at a time
+    import numpy as np
+    import pyarrow as pa
+    if pa.types.is_dictionary(array.type):
+        array = array.dictionary_decode()
+    _, offsets, data = array.buffers()
+    offsets = np.frombuffer(offsets, dtype=np.int32)[array.offset:array.offset + len(array) + 1]
+    data = np.frombuffer(data, dtype=np.uint8) if data is not None else np.zeros(0, dtype=np.uint8)
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    if array.null_count:
+        lengths[~array.is_valid().to_numpy(zero_copy_only=False)] = 0
+    hashed = np.full(len(array), FNV_OFFSET, dtype=np.uint32)
+    prime = np.uint32(FNV_PRIME)
+    # Every value has the bytes up to the shortest one's length, past that only the longer values are hashed on
+    shortest = lengths.min(initial=0)
+    for i in range(shortest):
+        hashed ^= data[starts + i]
+        hashed *= prime
+    for i in range(shortest, lengths.max(initial=0)):
+        rows = np.flatnonzero(lengths > i)
+        hashed[rows] = (hashed[rows] ^ data[starts[rows] + i]) * prime
+    return hashed % partitions
+
+def read_partition(file_path, layout, partitions, index, event_names=None):
+    """
+    Yields (position, record) for the rows of a file whose CaseID hashes to this partition, position being where the
+    record is among all of the file's records (read like compare.read_records reads them). event_names, if given, gets
+    every event code of the file with the event name it first shows up with, in the order they show up.
+    With pyarrow installed the CaseIDs are hashed a block of rows at a time and only this partition's rows are turned
+    into records, the rows fast_csv cannot read go through compare.read_records and are hashed one by one.
+    """
+    records_read = 0
+    try:
+        import fast_csv
+        import numpy as np
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        if is_parquet(file_path):
+            import parquet_archive
+            blocks = parquet_archive.read_arrays(file_path, layout)
+        else:
+            positions = list(dict.fromkeys(layout.positions))
+            blocks = ({position: batch.column(f"c{position}") for position in positions}
+                      for batch in fast_csv.read_batches(file_path, layout))
+        case_position, code_position, name_position = (layout.positions[CASE_ID], layout.positions[EVENT_CODE],
+                                                       layout.positions[EVENT_NAME])
+        for arrays in blocks:
+            if event_names is not None:
+                codes = arrays[code_position]
+                if not pa.types.is_dictionary(codes.type):
+                    codes = pc.dictionary_encode(codes, null_encoding='encode')
+                # The first row of every event code in the block, in the order they show up
+                used, first_rows = np.unique(codes.indices.to_numpy(zero_copy_only=False), return_index=True)
+                order = np.argsort(first_rows)
+                names = arrays[name_position]
+                for code, row in zip(codes.dictionary.take(used[order]).to_pylist(), first_rows[order].tolist()):
+                    if code not in event_names:
+                        event_names[code] = names[row].as_py()
+
+            rows = np.flatnonzero(partition_hashes(arrays[case_position], partitions) == index)
+            records = fast_csv.batch_records({position: array.take(rows) for position, array in arrays.items()}, layout)
+            yield from zip((rows + records_read).tolist(), records)
+            records_read += len(arrays[case_position])
+        return
+    except ImportError:
+        pass
+    except fast_csv.Unsupported as e:
+        records_read = e.records_read
+
+    for position, record in enumerate(islice(read_records(file_path, layout, fast=False), records_read, None), records_read):
+        if event_names is not None and record[EVENT_CODE] not in event_names:
+            event_names[record[EVENT_CODE]] = record[EVENT_NAME]
+        if partition_of(record[CASE_ID], partitions) == index:
+            yield position, record
+
+def reconcile_partition(cdc_file, state_file, filterCDC, compare_attributes, partitions, index, normalizers=None):
+    """
+    Runs the comparison for the cases whose CaseID hashes to this partition. Both files are read in full
+    (every partition needs all the CDC event codes), but only this partition's rows are made into records.
+    Returns the results keyed by their position in the serial output, the partial stats and what is needed to
+    order the stats the same way the serial path does.
+    """
+    reconciler = Reconciler()
+    cdc_layout, state_layout = row_layouts(read_header(cdc_file), read_header(state_file), compare_attributes, normalizers)
+
+    cdc_positions = {}
+    duplicate_positions = []
+    # Event codes (and their names) are tracked over the whole file, in the order they show up
+    cdc_event_names = {}
+
+    def cdc_records():
+        for position, record in read_partition(cdc_file, cdc_layout, partitions, index, cdc_event_names):
+            caseID = record[CASE_ID]
+            if caseID in cdc_positions:
+                duplicate_positions.append(position)
+            else:
+                cdc_positions[caseID] = position
+            yield record
+
+    cdc_dict, _ = reconciler.index_cdc_records(cdc_records())
+    cdcEventCodes = set(cdc_event_names) if filterCDC else None
+
+    state_positions = {}
+
+    def state_records():
+        for position, record in read_partition(state_file, state_layout, partitions, index):
+            # Records that index_state_records filters out do not count towards where a case first shows up
+            eventCode = record[EVENT_CODE]
+            if not eventCode.isnumeric() or (cdcEventCodes is not None and eventCode not in cdcEventCodes):
+                continue
+            state_positions.setdefault(record[CASE_ID], position)
+            yield record
+
+    state_dict = index_state_records(state_records(), cdcEventCodes)
+
+    # Where each event code is first reached while walking the State cases, for codes that are not in the CDC data
+    state_event_positions = {}
+    for caseID, state_row in state_dict.items():
+        eventCode = state_row[EVENT_CODE]
+        if eventCode not in cdc_event_names and eventCode not in state_event_positions:
+            state_event_positions[eventCode] = (state_positions[caseID], state_row[EVENT_NAME])
+
+    reconciler.comp(state_dict, cdc_dict, state_layout, cdc_layout, compare_attributes)
+
+    duplicates = iter(duplicate_positions)
+    keyed_results = []
+    for result in reconciler.results:
+        if result.reasonID == "1":
+            key = (DUPLICATE_PHASE, next(duplicates))
+        elif result.reasonID == "4":
+            key = (MISSING_STATE_PHASE, cdc_positions[result.caseID])
+        else:
+            key = (STATE_PHASE, state_positions[result.caseID])
+        keyed_results.append((key, result.as_tuple()))
+
+    return keyed_results, reconciler.stats, cdc_event_names, state_event_positions
+
+def reconcile(cdc_file, state_file, filterCDC=False, compare_attributes=None, workers=2, normalizers=None):
+    """
+    Multi-core version of compare.reconcile. Cases are hash-partitioned on CaseID (so a case and all of its
+    duplicates always land in the same partition), each partition is compared in its own process, and the
+    results and stats are merged back into exactly the order the serial path produces.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        partitions = list(pool.map(reconcile_partition, repeat(cdc_file), repeat(state_file), repeat(filterCDC),
+                                   repeat(compare_attributes), repeat(workers), range(workers), repeat(normalizers)))
+
+    # Every partition is already in serial order, so a k-way merge on the keys puts them back together
+    results = [CaseResult(*fields) for _, fields in heapq.merge(*(keyed for keyed, _, _, _ in partitions), key=itemgetter(0))]
+
+    # Stats are ordered like the serial path: CDC event codes first, then the State only codes
+    cdc_event_names = partitions[0][2]
+    state_event_positions = {}
+    for _, _, _, partition_positions in partitions:
+        for eventCode, first in partition_positions.items():
+            if eventCode not in state_event_positions or first < state_event_positions[eventCode]:
+                state_event_positions[eventCode] = first
+
+    stats = {}
+    for eventCode, eventName in cdc_event_names.items():
+        stats[eventCode] = {'eventName': eventName, **{counter: 0 for counter in STAT_COUNTERS}}
+    for eventCode, (_, eventName) in sorted(state_event_positions.items(), key=itemgetter(1)):
+        stats[eventCode] = {'eventName': eventName, **{counter: 0 for counter in STAT_COUNTERS}}
+
+    for _, partition_stats, _, _ in partitions:
+        for eventCode, data in partition_stats.items():
+            for counter in STAT_COUNTERS:
+                stats[eventCode][counter] += data[counter]
+
+    return results, stats
@@ -0,0 +1,432 @@
+import base64
+import json
+import sqlite3
+
+# Setup of the SQLite database (database.db) that holds the reports, their cases and statistics, and the config
+
+# Cases are inserted in batches of this many rows
+INSERT_BATCH_SIZE = 10000
+
+# Set on every connection. WAL lets the report list and report views keep reading while a report is being saved,
+# and with WAL a commit only has to sync at checkpoints (synchronous=NORMAL) instead of on every transaction
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    # 64 MB page cache and up to 256 MB of the file memory mapped
+    "PRAGMA cache_size = -65536",
+    "PRAGMA mmap_size = 268435456",
+]
+
+TABLES = [
+    # Reports table
+    '''
+    CREATE TABLE IF NOT EXISTS Reports(
+        ID INTEGER PRIMARY KEY NOT NULL, 
+        CreatedAtDate TEXT,
+        TimeOfCreation TEXT, 
+        NumberOfDiscrepancies INTEGER,
+        Name TEXT    
+)''',
+    # Cases table
+    '''
+    CREATE TABLE IF NOT EXISTS Cases(
+        ID INTEGER PRIMARY KEY NOT NULL,
+        ReportID INTEGER NOT NULL,
+        CaseID TEXT, 
+        EventCode TEXT,
+        EventName TEXT,
+        MMWRYear INTEGER, 
+        MMWRWeek INTEGER,
+        Reason TEXT, 
+        ReasonID INTEGER,
+        CaseClassStatus TEXT,
+        FOREIGN KEY (ReportID) REFERENCES Reports(ID)
+)''',
+    # Statistics table
+    '''
+    CREATE TABLE IF NOT EXISTS Statistics(
+        ID INTEGER PRIMARY KEY NOT NULL,
+        ReportID INTEGER NOT NULL,
+        EventCode TEXT NOT NULL,
+        EventName TEXT,
+        TotalCases INTEGER,
+        TotalDuplicates INTEGER,
+        TotalMissingFromCDC INTEGER,
+        TotalMissingFromState INTEGER,
+        TotalWrongAttributes INTEGER,
+        FOREIGN KEY (ReportID) REFERENCES Reports(ID)
+)''',
+    # Config table
+    '''
+    CREATE TABLE IF NOT EXISTS Config(
+        ID INTEGER PRIMARY KEY NOT NULL,
+        FieldName TEXT NOT NULL,
+        FieldValue TEXT NOT NULL
+)''',
+]
+
+# Schema changes, in order. The database's user_version is the number of migrations it has had,
+# so existing database.db files pick up whatever they are missing the next time the server starts
+MIGRATIONS = [
+    # 1: indexes for looking up a report's cases and statistics. Index entries are ordered by (key, rowid),
+    # so "WHERE ReportID = ? ORDER BY ID" reads the cases in the order they were inserted without sorting
+    [
+        "CREATE INDEX IF NOT EXISTS idx_cases_report ON Cases (ReportID)",
+        "CREATE INDEX IF NOT EXISTS idx_cases_report_reason ON Cases (ReportID, ReasonID)",
+        "CREATE INDEX IF NOT EXISTS idx_cases_report_event ON Cases (ReportID, EventCode)",
+        "CREATE INDEX IF NOT EXISTS idx_statistics_report ON Statistics (ReportID)",
+        "CREATE INDEX IF NOT EXISTS idx_config_field ON Config (FieldName)",
+    ],
+    # 2: indexes for the paged cases view, filtering on a reason and event code together (the statistics links)
+    # and on a CaseID prefix / sorting by CaseID
+    [
+        "CREATE INDEX IF NOT EXISTS idx_cases_report_reason_event ON Cases (ReportID, ReasonID, EventCode)",
+        "CREATE INDEX IF NOT EXISTS idx_cases_report_case ON Cases (ReportID, CaseID)",
+    ],
+    # 3: report deltas. Baselines has the latest report for each kind of run (year, filter, attributes), and
+    # ReportDeltas the report that was the latest of its kind when a report was saved, which its delta defaults to
+    [
+        """CREATE TABLE IF NOT EXISTS Baselines(
+            BaselineKey TEXT PRIMARY KEY NOT NULL,
+            ReportID INTEGER NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS ReportDeltas(
+            ReportID INTEGER PRIMARY KEY NOT NULL,
+            SinceReportID INTEGER NOT NULL
+        )""",
+    ],
+    # 4: per EventCode statistics of every report in time order, for the trends endpoint. It is kept up to date
+    # by insert_statistics and server.delete_report_rows, and is clustered on its key so one EventCode's (or a few
+    # EventCodes') history is a single range read. Existing reports are copied in (without a year)
+    [
+        """CREATE TABLE IF NOT EXISTS StatisticTrends(
+            EventCode TEXT NOT NULL,
+            CreatedAt TEXT NOT NULL,
+            ReportID INTEGER NOT NULL,
+            ReportYear INTEGER,
+            EventName TEXT,
+            TotalCases INTEGER,
+            TotalDuplicates INTEGER,
+            TotalMissingFromCDC INTEGER,
+            TotalMissingFromState INTEGER,
+            TotalWrongAttributes INTEGER,
+            PRIMARY KEY (EventCode, CreatedAt, ReportID)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_statistic_trends_report ON StatisticTrends (ReportID)",
+        """INSERT OR REPLACE INTO StatisticTrends (EventCode, CreatedAt, ReportID, ReportYear, EventName, TotalCases, TotalDuplicates,
+                                                  TotalMissingFromCDC, TotalMissingFromState, TotalWrongAttributes)
+           SELECT s.EventCode, r.CreatedAtDate || ' ' || r.TimeOfCreation, s.ReportID, NULL, s.EventName, s.TotalCases, s.TotalDuplicates,
+                  s.TotalMissingFromCDC, s.TotalMissingFromState, s.TotalWrongAttributes
+           FROM Statistics s JOIN Reports r ON r.ID = s.ReportID""",
+    ],
+    # 5: how long each report took and how much work it did. PhaseSeconds and Counters are JSON objects,
+    # as the phases and counters depend on the kind of report and the comparison engine
+    [
+        """CREATE TABLE IF NOT EXISTS ReportTimings(
+            ReportID INTEGER PRIMARY KEY NOT NULL,
+            Kind TEXT,
+            QueuedSeconds REAL,
+            RunSeconds REAL,
+            PhaseSeconds TEXT,
+            Counters TEXT,
+            PeakRSSMB REAL,
+            Profiled INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (ReportID) REFERENCES Reports(ID)
+        )""",
+    ],
+    # 6: fingerprint of each report's inputs (uploaded files, year, CDC filter and attributes), so submitting the same
+    # report again can be answered with the one that exists
+    [
+        "ALTER TABLE Reports ADD COLUMN InputHash TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_reports_input_hash ON Reports (InputHash)",
+    ],
+]
+
+# Columns the cases of a report can be sorted on, and the most cases one page can have
+CASE_SORT_COLUMNS = ['ID', 'CaseID', 'EventCode', 'EventName', 'CaseClassStatus', 'MMWRYear', 'MMWRWeek', 'Reason', 'ReasonID']
+MAX_CASE_PAGE_SIZE = 1000
+
+# Columns the search text is looked for in
+CASE_SEARCH_COLUMNS = ['CaseID', 'EventCode', 'EventName', 'CaseClassStatus', 'Reason']
+
+def connect(database_file_path, **kwargs):
+    conn = sqlite3.connect(database_file_path, timeout=30, **kwargs)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def setup(conn):
+    """
+    Creates any missing tables and brings the schema up to date.
+    """
+    cur = conn.cursor()
+    for table in TABLES:
+        cur.execute(table)
+    conn.commit()
+    migrate(conn)
+
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(MIGRATIONS[version:], version + 1):
+        print(f"Migrating database.db to version {number}")
+        try:
+            cur = conn.cursor()
+            for statement in statements:
+                cur.execute(statement)
+            # PRAGMA does not take parameters, number is always one of our own ints
+            cur.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise e
+    if version < len(MIGRATIONS):
+        # Gives the query planner statistics for the new indexes
+        conn.execute("ANALYZE")
+        conn.commit()
+
+def batches(rows, size=INSERT_BATCH_SIZE):
+    # Splits any iterable into lists of at most size rows, so a whole report never has to be turned into one list
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def insert_report(conn, noOfDiscrepancies, name="", input_hash=None):
+    # Adds a report's row and returns its ID, input_hash is the fingerprint of its inputs (see server.fingerprint_inputs)
+    try:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO Reports (CreatedAtDate, TimeOfCreation, NumberOfDiscrepancies, Name, InputHash)  VALUES (DATE('now'), TIME('now'), ?, ?, ?)",
+                    (noOfDiscrepancies, name, input_hash))
+        report_id = cur.lastrowid
+        # Set default name if none provided
+        if name == "":
+            cur.execute("UPDATE Reports SET Name = ? WHERE ID = ?", (f"Report {report_id}", report_id))
+        conn.commit()
+        return report_id
+    except Exception as e:
+        conn.rollback()
+        raise e
+
+def insert_statistics(conn, stats, year=None):
+    # year is the year an automatic report was run for, it is kept with the report's trends
+    try:
+        cur = conn.cursor()
+        cur.executemany("INSERT INTO Statistics (ReportID, EventCode, EventName, TotalCases, TotalDuplicates, TotalMissingFromCDC, TotalMissingFromState, TotalWrongAttributes) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", stats)
+        for report_id in dict.fromkeys(row[0] for row in stats):
+            add_statistic_trends(cur, report_id, year)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+
+def insert_cases(conn, rows, progress=None, total=None):
+    # rows can be any iterable of rows (e.g. a generator over the comparison results), it is inserted batch by batch
+    try:
+        cur = conn.cursor()
+        inserted = 0
+        # All batches go in one transaction, between batches progress is reported (and the job can be cancelled)
+        for batch in batches(rows):
+            cur.executemany("INSERT INTO Cases (ReportID, CaseID, EventCode, EventName, MMWRYear, MMWRWeek, Reason, ReasonID, CaseClassStatus) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+            inserted += len(batch)
+            if progress is not None:
+                progress('persisting', inserted, total)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+
+def encode_cursor(sort_value, case_id):
+    return base64.urlsafe_b64encode(json.dumps([sort_value, case_id]).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    # Raises ValueError if the cursor was not made by encode_cursor
+    try:
+        sort_value, case_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(case_id, int):
+        raise ValueError("Invalid cursor")
+    return sort_value, case_id
+
+def prefix_upper_bound(prefix):
+    # The smallest string that is bigger than every string starting with prefix, so a prefix match can use an index
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def fetch_case_page(conn, report_id, filters=None, sort='ID', descending=False, limit=100, cursor=None, search=None):
+    """
+    Returns one page of a report's cases as (total number of matching cases, cases, cursor for the next page).
+    The pages are keyset paginated on (sort column, ID), so any page is as fast to get as the first one.
+    filters can have ReasonID, EventCode, MMWRWeek, CaseClassStatus (exact matches) and CaseIDPrefix,
+    search matches part of the CaseID, EventCode, EventName, CaseClassStatus or Reason (ignoring case).
+    """
+    if sort not in CASE_SORT_COLUMNS:
+        raise ValueError(f"Cannot sort on {sort}")
+
+    conditions = ["ReportID = ?"]
+    params = [report_id]
+    for column, value in (filters or {}).items():
+        if value is None:
+            continue
+        if column == 'CaseIDPrefix':
+            if value != "":
+                conditions.append("CaseID >= ? AND CaseID < ?")
+                params += [value, prefix_upper_bound(value)]
+        elif column in ('ReasonID', 'EventCode', 'MMWRWeek', 'CaseClassStatus'):
+            conditions.append(f"{column} = ?")
+            params.append(value)
+        else:
+            raise ValueError(f"Cannot filter on {column}")
+    if search:
+        pattern = '%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        conditions.append('(' + ' OR '.join(f"{column} LIKE ? ESCAPE '\\'" for column in CASE_SEARCH_COLUMNS) + ')')
+        params += [pattern] * len(CASE_SEARCH_COLUMNS)
+
+    cur = conn.cursor()
+    cur.execute(f"SELECT COUNT(*) FROM Cases WHERE {' AND '.join(conditions)}", params)
+    total = cur.fetchone()[0]
+
+    direction = "DESC" if descending else "ASC"
+    if cursor is not None:
+        sort_value, last_id = decode_cursor(cursor)
+        after = "<" if descending else ">"
+        if sort == 'ID':
+            conditions.append(f"ID {after} ?")
+            params.append(last_id)
+        elif sort_value is None:
+            # NULLs come first going up and last going down
+            conditions.append(f"(({sort} IS NULL AND ID {after} ?)" + (")" if descending else f" OR {sort} IS NOT NULL)"))
+            params.append(last_id)
+        else:
+            conditions.append(f"({sort} {after} ? OR ({sort} = ? AND ID {after} ?)" + (f" OR {sort} IS NULL)" if descending else ")"))
+            params += [sort_value, sort_value, last_id]
+
+    order_by = f"ID {direction}" if sort == 'ID' else f"{sort} {direction}, ID {direction}"
+    # One extra row tells us whether there is a next page
+    cur.execute(f"SELECT * FROM Cases WHERE {' AND '.join(conditions)} ORDER BY {order_by} LIMIT ?", params + [limit + 1])
+    columns = [column[0] for column in cur.description]
+    cases = [dict(zip(columns, row)) for row in cur.fetchall()]
+
+    next_cursor = None
+    if len(cases) > limit:
+        cases = cases[:limit]
+        next_cursor = encode_cursor(cases[-1][sort], cases[-1]['ID'])
+    return total, cases, next_cursor
+
+# What identifies a discrepancy when two reports are compared
+DISCREPANCY_KEY = ['CaseID', 'ReasonID', 'Reason']
+
+def fetch_discrepancy_delta(conn, report_id, since_report_id, limit=100):
+    """
+    Compares the discrepancies of two reports. Returns (new, resolved) where each is (total, first limit cases):
+    new are the cases of report_id that since_report_id did not have (same CaseID, reason and reason string),
+    resolved the cases of since_report_id that are gone from report_id.
+    """
+    delta = []
+    for report, other in ((report_id, since_report_id), (since_report_id, report_id)):
+        # Every lookup of the other report's case goes through idx_cases_report_case
+        condition = "c.ReportID = ? AND NOT EXISTS (SELECT 1 FROM Cases o WHERE o.ReportID = ? AND " + \
+            " AND ".join(f"o.{column} IS c.{column}" for column in DISCREPANCY_KEY) + ")"
+        cur = conn.cursor()
+        cur.execute(f"SELECT COUNT(*) FROM Cases c WHERE {condition}", (report, other))
+        total = cur.fetchone()[0]
+        cur.execute(f"SELECT c.* FROM Cases c WHERE {condition} ORDER BY c.ID LIMIT ?", (report, other, limit))
+        columns = [column[0] for column in cur.description]
+        delta.append((total, [dict(zip(columns, row)) for row in cur.fetchall()]))
+    return delta[0], delta[1]
+
+def fetch_since_report(conn, report_id):
+    # The previous report of the same kind when report_id was saved (see server.save_baseline), or None
+    cur = conn.cursor()
+    cur.execute("SELECT SinceReportID FROM ReportDeltas WHERE ReportID = ?", (report_id,))
+    row = cur.fetchone()
+    return row[0] if row is not None else None
+
+def remove_from_deltas(cur, report_id):
+    # Takes a report that is being deleted out of the chain of reports of its kind, in the caller's transaction. The
+    # reports whose delta defaulted to it, and the next report of its kind, default to the report before it instead
+    cur.execute("SELECT SinceReportID FROM ReportDeltas WHERE ReportID = ?", (report_id,))
+    row = cur.fetchone()
+    if row is not None:
+        cur.execute("UPDATE ReportDeltas SET SinceReportID = ? WHERE SinceReportID = ?", (row[0], report_id))
+        cur.execute("UPDATE Baselines SET ReportID = ? WHERE ReportID = ?", (row[0], report_id))
+    else:
+        # It was the first report of its kind
+        cur.execute("DELETE FROM ReportDeltas WHERE SinceReportID = ?", (report_id,))
+        cur.execute("DELETE FROM Baselines WHERE ReportID = ?", (report_id,))
+    cur.execute("DELETE FROM ReportDeltas WHERE ReportID = ?", (report_id,))
+
+TREND_COLUMNS = ['ReportID', 'CreatedAt', 'ReportYear', 'TotalCases', 'TotalDuplicates', 'TotalMissingFromCDC',
+                 'TotalMissingFromState', 'TotalWrongAttributes']
+
+def add_statistic_trends(cur, report_id, year=None):
+    # Copies a report's statistics into StatisticTrends, in the caller's transaction
+    cur.execute("""INSERT OR REPLACE INTO StatisticTrends (EventCode, CreatedAt, ReportID, ReportYear, EventName, TotalCases, TotalDuplicates,
+                                                           TotalMissingFromCDC, TotalMissingFromState, TotalWrongAttributes)
+                   SELECT s.EventCode, r.CreatedAtDate || ' ' || r.TimeOfCreation, s.ReportID, ?, s.EventName, s.TotalCases, s.TotalDuplicates,
+                          s.TotalMissingFromCDC, s.TotalMissingFromState, s.TotalWrongAttributes
+                   FROM Statistics s JOIN Reports r ON r.ID = s.ReportID
+                   WHERE s.ReportID = ?""", (year, report_id))
+
+def fetch_trends(conn, event_codes=None, since=None, until=None, year=None):
+    """
+    Returns EventCode -> {"eventName", "points"} where points are the code's statistics in every report, oldest first.
+    event_codes limits it to those codes (all codes if None), since / until to reports created on or after / before
+    those dates (YYYY-MM-DD), and year to automatic reports for that year.
+    """
+    conditions = []
+    params = []
+    if event_codes:
+        conditions.append(f"EventCode IN ({', '.join('?' * len(event_codes))})")
+        params += event_codes
+    if since:
+        conditions.append("CreatedAt >= ?")
+        params.append(since)
+    if until:
+        conditions.append("CreatedAt < ?")
+        params.append(until)
+    if year is not None:
+        conditions.append("ReportYear = ?")
+        params.append(year)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    cur = conn.cursor()
+    cur.execute(f"SELECT EventCode, EventName, {', '.join(TREND_COLUMNS)} FROM StatisticTrends {where} ORDER BY EventCode, CreatedAt, ReportID", params)
+    trends = {}
+    for row in cur.fetchall():
+        # The most recent report's name for the code is the one shown
+        trend = trends.setdefault(row[0], {"eventName": row[1], "points": []})
+        trend["eventName"] = row[1]
+        trend["points"].append(dict(zip(TREND_COLUMNS, row[2:])))
+    return trends
+
+TIMING_COLUMNS = ['Kind', 'QueuedSeconds', 'RunSeconds', 'PhaseSeconds', 'Counters', 'PeakRSSMB', 'Profiled']
+
+def save_report_timing(conn, report_id, timing):
+    # timing has the TIMING_COLUMNS as keys, with PhaseSeconds and Counters as dictionaries
+    values = dict(timing, PhaseSeconds=json.dumps(timing['PhaseSeconds']), Counters=json.dumps(timing['Counters']),
+                  Profiled=int(bool(timing['Profiled'])))
+    try:
+        conn.execute(f"INSERT OR REPLACE INTO ReportTimings (ReportID, {', '.join(TIMING_COLUMNS)}) "
+                     f"VALUES (?, {', '.join('?' * len(TIMING_COLUMNS))})", [report_id] + [values[column] for column in TIMING_COLUMNS])
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+
+def fetch_report_timing(conn, report_id):
+    # The timing record of a report as saved by save_report_timing, None for reports saved before timings were kept
+    cur = conn.cursor()
+    cur.execute(f"SELECT {', '.join(TIMING_COLUMNS)} FROM ReportTimings WHERE ReportID = ?", (report_id,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    timing = dict(zip(TIMING_COLUMNS, row))
+    timing['PhaseSeconds'] = json.loads(timing['PhaseSeconds'] or '{}')
+    timing['Counters'] = json.loads(timing['Counters'] or '{}')
+    timing['Profiled'] = bool(timing['Profiled'])
+    return timing
@@ -0,0 +1,133 @@
+import csv
+import io
+import json
+import zlib
+
+import report_db
+
+# Streaming exports of a report's cases for server.py. Every format is a generator of byte chunks,
+# so an export only ever holds one batch of rows in memory no matter how big the report is
+
+# Same columns and order as results.csv
+EXPORT_COLUMNS = ['CaseID', 'EventCode', 'EventName', 'MMWRYear', 'MMWRWeek', 'Reason', 'ReasonID', 'CaseClassStatus']
+INTEGER_COLUMNS = {'MMWRYear', 'MMWRWeek', 'ReasonID'}
+
+# Rows fetched from SQLite per batch, and rows per Parquet row group
+EXPORT_BATCH_SIZE = 5000
+PARQUET_ROW_GROUP_SIZE = 65536
+
+# format: (file extension, media type)
+EXPORT_FORMATS = {
+    'csv': ('csv', 'text/csv'),
+    'ndjson': ('ndjson', 'application/x-ndjson'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet'),
+}
+
+def iter_case_batches(database_file_path, report_id, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yields the cases of a report in batches of row tuples, in the order they were inserted.
+    The export has its own connection since the response is generated on worker threads
+    (one at a time, so check_same_thread is not needed).
+    """
+    conn = report_db.connect(database_file_path, check_same_thread=False)
+    try:
+        cur = conn.execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM Cases WHERE ReportID = ? ORDER BY ID", (report_id,))
+        while True:
+            batch = cur.fetchmany(batch_size)
+            if not batch:
+                break
+            yield batch
+    finally:
+        conn.close()
+
+def csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    # Only the header if the report has no cases
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def ndjson_chunks(batches):
+    for batch in batches:
+        yield ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in batch).encode('utf-8')
+
+class ChunkSink(io.RawIOBase):
+    # File object for the Parquet writer that keeps what was written until it is taken out
+    def __init__(self) -> None:
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def as_int(value):
+    # The integer columns can hold text if the input files did, that becomes null in the Parquet file
+    return value if isinstance(value, int) else None
+
+def parquet_chunks(batches):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(column, pa.int64() if column in INTEGER_COLUMNS else pa.string()) for column in EXPORT_COLUMNS])
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+
+    def write_row_group(rows):
+        columns = list(zip(*rows))
+        arrays = [pa.array([as_int(value) for value in values] if column in INTEGER_COLUMNS else values, type=field.type)
+                  for column, values, field in zip(EXPORT_COLUMNS, columns, schema)]
+        writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+    rows = []
+    for batch in batches:
+        rows += batch
+        if len(rows) >= PARQUET_ROW_GROUP_SIZE:
+            write_row_group(rows)
+            rows = []
+            yield sink.take()
+    if rows:
+        write_row_group(rows)
+    writer.close()
+    yield sink.take()
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def export_chunks(database_file_path, report_id, format, gzip=False):
+    """
+    Returns a generator of the report's cases as a CSV, NDJSON or Parquet file, gzipped if asked.
+    """
+    batches = iter_case_batches(database_file_path, report_id)
+    if format == 'csv':
+        chunks = csv_chunks(batches)
+    elif format == 'ndjson':
+        chunks = ndjson_chunks(batches)
+    elif format == 'parquet':
+        chunks = parquet_chunks(batches)
+    else:
+        raise ValueError(f"Unknown export format {format}")
+    return gzip_chunks(chunks) if gzip else chunks
@@ -1,19 +1,28 @@
-import subprocess
 import uvicorn
 from fastapi import FastAPI, File, Form, Response, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 import asyncio
-import csv
 import os
-import sys
 import uuid
-import pyodbc
 import json
 import sqlite3
 import shutil
 import mimetypes
+import time
+import datetime
+import hashlib
+from multiprocessing import Manager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import compare
+import state_query
+import uploads
+import report_db
+import report_export
+import state_cache
+import metrics
 
 # Fix mimetypes for .js and .css files
 mimetypes.init()
@@ -39,276 +48,470 @@ app.dir = os.path.dirname(__file__)
 config_file_path = os.path.join(app.dir, "config.json")
 with open(config_file_path, "r") as f:
     app.config = json.load(f)
-    db_username = app.config.get("database_username") or os.getenv('DB_USERNAME')
-    db_password = app.config.get("database_password") or os.getenv('DB_PASSWORD')
 
-# Connect to the SQL Server
-connection_string_base = 'DRIVER={' + app.config["driver"] + \
-    '}' + \
-    f';SERVER={app.config["server"]};DATABASE={app.config["database"]};'
-
-if db_username and db_password:
-    connection_string_auth = f'UID={db_username};PWD={db_password};'
-else:
-    connection_string_auth = 'Trusted_Connection=yes;'
-
-connection_string = connection_string_base + connection_string_auth
-app.conn = pyodbc.connect(connection_string)
-
-# SQLite reports and cases tables setup
+# Attributes that are normalized before they are compared, e.g. {"BirthDate": "date"}. Checked here so a typo
+# in config.json stops the server instead of failing every report
+attribute_normalizers = app.config.get("attribute_normalizers", {})
+compare.resolve_normalizers(attribute_normalizers)
+
+# Reports (and the CDC / State data, if those are archived) go into the archive folder as CSV files or as
+# zstd compressed Parquet files, which take a lot less space and compare.py reads a lot faster (see parquet_archive)
+archive_format = app.config.get("archive_format", "csv")
+if archive_format not in ("csv", "parquet"):
+    raise ValueError(f"Unknown archive_format {archive_format}, it can be csv or parquet")
+if archive_format == "parquet":
+    # Needs pyarrow, which should stop the server rather than every report once it is done
+    import parquet_archive  # noqa: F401
+
+# The comparison workers connect to the SQL Server themselves when they run an automatic report
+connection_string = state_query.build_connection_string(app.config)
+
+# Local cache of the State data pulled for automatic reports, off unless state_cache is set in config.json
+app.state_cache = None
+if app.config.get("state_cache", False):
+    app.state_cache = state_cache.StateCache(os.path.join(app.dir, "state_cache"),
+                                             app.config.get("state_cache_ttl_minutes", state_cache.DEFAULT_TTL_MINUTES),
+                                             app.config.get("state_cache_max_mb", state_cache.DEFAULT_MAX_SIZE_MB))
+
+# SQLite reports and cases tables setup, existing databases get migrated to the current schema
 database_file_path = os.path.join(app.dir, "database.db")
-app.liteConn = sqlite3.connect(database_file_path)
-cur = app.liteConn.cursor()
-
-# Reports table
-cur.execute('''
-    CREATE TABLE IF NOT EXISTS Reports(
-        ID INTEGER PRIMARY KEY NOT NULL, 
-        CreatedAtDate TEXT,
-        TimeOfCreation TEXT, 
-        NumberOfDiscrepancies INTEGER,
-        Name TEXT    
-)''')
-
-# Cases table
-cur.execute('''
-    CREATE TABLE IF NOT EXISTS Cases(
-        ID INTEGER PRIMARY KEY NOT NULL,
-        ReportID INTEGER NOT NULL,
-        CaseID TEXT, 
-        EventCode TEXT,
-        EventName TEXT,
-        MMWRYear INTEGER, 
-        MMWRWeek INTEGER,
-        Reason TEXT, 
-        ReasonID INTEGER,
-        CaseClassStatus TEXT,
-        FOREIGN KEY (ReportID) REFERENCES Reports(ID)
-)''')
-
-# Statistics table
-cur.execute('''
-    CREATE TABLE IF NOT EXISTS Statistics(
-        ID INTEGER PRIMARY KEY NOT NULL,
-        ReportID INTEGER NOT NULL,
-        EventCode TEXT NOT NULL,
-        EventName TEXT,
-        TotalCases INTEGER,
-        TotalDuplicates INTEGER,
-        TotalMissingFromCDC INTEGER,
-        TotalMissingFromState INTEGER,
-        TotalWrongAttributes INTEGER,
-        FOREIGN KEY (ReportID) REFERENCES Reports(ID)
-)''')
-
-# Statistics table
-cur.execute('''
-    CREATE TABLE IF NOT EXISTS Config(
-        ID INTEGER PRIMARY KEY NOT NULL,
-        FieldName TEXT NOT NULL,
-        FieldValue TEXT NOT NULL
-)''')
-
-app.liteConn.commit()
-
-@app.post("/manual_report")
+app.liteConn = report_db.connect(database_file_path)
+report_db.setup(app.liteConn)
+
+# Comparisons run in a pool of worker processes that stays warm between reports
+app.compare_pool = None
+
+def create_compare_pool():
+    # Every worker sets up its own state database connection pool, connections are only opened once a report needs one
+    return ProcessPoolExecutor(max_workers=app.config.get("comparison_workers", 2),
+                               initializer=state_query.configure_pool, initargs=(app.config,))
+
+def warm_up():
+    # Importing compare happens when the worker unpickles this task, so there is nothing else to do
+    return None
+
+# Report jobs by ID. They only live in memory, so the list starts empty again after a restart
+app.jobs = {}
+
+# Finished jobs are forgotten after this many seconds
+JOB_RETENTION = 60 * 60
+
+# Shared dictionaries the comparison workers write their progress to, and the limit on reports running at once
+app.job_manager = None
+app.job_slots = None
+
+@app.on_event("startup")
+async def start_compare_pool():
+    app.compare_pool = create_compare_pool()
+    app.job_manager = Manager()
+    app.job_slots = asyncio.Semaphore(app.config.get("max_concurrent_reports", 2))
+    # Submit a no-op so the worker processes are spawned before the first report comes in
+    await asyncio.get_running_loop().run_in_executor(app.compare_pool, warm_up)
+
+@app.on_event("shutdown")
+async def stop_compare_pool():
+    if app.compare_pool is not None:
+        app.compare_pool.shutdown(cancel_futures=True)
+    if app.job_manager is not None:
+        app.job_manager.shutdown()
+
+# cProfile stats of the reports that were run with profile=true, named after the report ID
+profiles_path = os.path.join(app.dir, "profiles")
+
+# Timings and counters of the report jobs since the server started, shown by /metrics
+app.metrics = metrics.Metrics()
+app.metrics.declare("reports_total", "counter", "Report jobs that finished, by kind and status")
+app.metrics.declare("reports_coalesced_total", "counter", "Report submissions answered with a running job or an existing report of the same inputs")
+app.metrics.declare("report_run_seconds_total", "counter", "Seconds completed report jobs ran for (without waiting in the queue)")
+app.metrics.declare("report_queued_seconds_total", "counter", "Seconds completed report jobs waited for a free slot")
+app.metrics.declare("report_phase_seconds_total", "counter", "Seconds completed report jobs spent in each phase")
+app.metrics.declare("report_phase_runs_total", "counter", "Number of times each phase ran in completed report jobs")
+app.metrics.declare("rows_read_total", "counter", "CDC and State rows read by completed report jobs")
+app.metrics.declare("state_duplicates_collapsed_total", "counter", "State rows dropped for an older row of the same case")
+app.metrics.declare("discrepancies_total", "counter", "Discrepancies found by completed report jobs")
+app.metrics.declare("bytes_written_total", "counter", "Bytes of uploaded files and archived report files written")
+app.metrics.declare("last_report_peak_rss_megabytes", "gauge", "Peak memory of the comparison worker during the latest completed report")
+
+def make_temp_folder():
+    # Every report gets its own folder under temp for its uploaded / queried files
+    folder = os.path.join(app.dir, "temp", str(uuid.uuid4()))
+    os.makedirs(folder, mode=0o777)
+    return folder
+
+@app.post("/manual_report", status_code=202)
 async def manual_report(isCDCFilter: bool, reportName: str, state_file: UploadFile = File(None), 
-                        cdc_file:  UploadFile = File(None), attributes: str = Form("[]")):
-    folder_name = "temp"
-    if not os.path.exists(os.path.join(app.dir, "temp")):
-        os.makedirs(os.path.join(app.dir, "temp"))
-
+                        cdc_file:  UploadFile = File(None), attributes: str = Form("[]"), profile: bool = False,
+                        force: bool = False):
+    """
+    Saves the uploaded files and queues the comparison, returns the ID of the job to follow it with.
+    If the same files were submitted with the same filter and attributes before, the job is the one of that report
+    (coalesced is true then, and reportName / reportId say which report it is), unless force is set. See coalesced_job.
+    profile runs the comparison under cProfile, see /reports/{report_id}/profile.
+    """
+    folder = make_temp_folder()
     try:
-        id = str(uuid.uuid4())
-        os.makedirs(os.path.join(app.dir, folder_name, id), mode=0o777)
-        
-        # Fetching the archive_path for saving the Report
-        archive_path = await get_config_setting("archive_path")
-
-        cdc_content = await cdc_file.read()
-        cdc_save_to = os.path.join(app.dir, folder_name, id, "cdc.csv")
-        with open(cdc_save_to, "wb") as f:
-            f.write(cdc_content)
-
-        state_content = await state_file.read()
-        state_save_to = os.path.join(app.dir, folder_name, id, "state.csv")
-        with open(state_save_to, "wb") as f:
-            f.write(state_content)
-
-        res_file = os.path.join(app.dir, folder_name, id, "results.csv")
-        
-        # Creating argument list for running compare.py
-        subprocess_args = [sys.executable,
-                        os.path.join(app.dir, "compare.py"),
-                        '-c', cdc_save_to,
-                        '-s', state_save_to,
-                        '-o', res_file]
-        
-        if isCDCFilter:
-            subprocess_args.append('-f')
-        
-        attributes_list = json.loads(attributes)
-        subprocess_args.extend(['-a', *attributes_list])
-        
-        try:
-            process = await asyncio.create_subprocess_exec(*subprocess_args,
-                                                            stderr=subprocess.PIPE)
-            _, stderr = await process.communicate()  # Wait for subprocess to finish and get stderr
-            if process.returncode != 0:  # Non-zero return code indicates an error
-                error_message = stderr.decode().strip()  # Decode error message from bytes to string
-                raise RuntimeError(f"Subprocess failed with error: {error_message}")
-        except Exception as e:
-            print(f"Error running comparison: {e}")
-            raise HTTPException(status_code=500, detail="Error running comparison")
-
-        res = []
-        with open(res_file, newline='') as csvfile:
-            # Create a CSV reader object
-            reader = csv.DictReader(csvfile)
-            # Loop through each row in the CSV file
-            for row in reader:
-                # Add the row as a dictionary to the list
-                res.append(tuple(row.values()))
-
-        numDiscrepancies = len(res)
-        reportId = insert_report(numDiscrepancies, reportName)
-
-        stats_file = os.path.join(app.dir, folder_name, id, "stats.csv")
-        stats_list = []
-
-        with open(stats_file, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                tup = (reportId,) + tuple(row.values())
-                stats_list.append(tup)
-
-        if archive_path:
-            # Making a folder for the specific reportId
-            archive_save_to = os.path.join(archive_path, str(reportId))
-            os.makedirs(archive_save_to, exist_ok=True)
-
-            # writing the newly created results file to the archive folder too
-            shutil.copy2(res_file, archive_save_to)
-            shutil.copy2(stats_file, archive_save_to)
-
-        # Add reportId to each row
-        new_res = [(reportId,) + row for row in res]
-
-        insert_cases(new_res)
-        insert_statistics(stats_list)
-
-        # remove temp files / folder
-        shutil.rmtree(os.path.join(app.dir, folder_name, id))
+        cdc_save_to = os.path.join(folder, "cdc.csv")
+        state_save_to = os.path.join(folder, "state.csv")
+        files = {
+            "cdc": await save_upload(cdc_file, cdc_save_to, compare.CDC_REQUIRED_COLUMNS, "CDC"),
+            "state": await save_upload(state_file, state_save_to, compare.STATE_REQUIRED_COLUMNS, "State"),
+        }
 
-        return Response(status_code=200)
+        attributes_list = json.loads(attributes)
     except Exception as e:
         # remove temp files / folder
-        shutil.rmtree(os.path.join(app.dir, folder_name, id))
+        shutil.rmtree(folder)
         raise e
 
-@app.post("/automatic_report")
+    inputHash = fingerprint_inputs(files, None, isCDCFilter, attributes_list)
+    job = None if force or profile else coalesced_job(reportName, "manual", files, inputHash)
+    if job is not None:
+        shutil.rmtree(folder, ignore_errors=True)
+        return coalesced_response(job)
+
+    job = start_job(reportName, folder, files, "manual", profile, inputHash, manual_report_job, reportName, cdc_save_to,
+                    state_save_to, isCDCFilter, attributes_list)
+    return {"jobId": job["id"], "coalesced": False}
+
+async def manual_report_job(progress, reportName, cdc_save_to, state_save_to, isCDCFilter, attributes_list, profile_to=None,
+                            input_hash=None):
+    # Fetching the archive_path for saving the Report
+    archive_path = await get_config_setting("archive_path")
+
+    key = baseline_key(None, isCDCFilter, attributes_list)
+    since_report_id = previous_report(key)
+    run_results, run_stats = await run_comparison(cdc_save_to, state_save_to, isCDCFilter, attributes_list, progress, profile_to)
+
+    archive_files = archived_inputs(cdc_save_to, state_save_to)
+    return await save_report_in_thread(reportName, run_results, run_stats, archive_path, archive_files, progress=progress,
+                                       baseline=(key, since_report_id), input_hash=input_hash)
+
+def archived_inputs(cdc_file, state_file):
+    # The uploaded / queried files that are kept in a report's archive folder, see archive_cdc_data and archive_state_data
+    archive_files = []
+    if app.config.get("archive_cdc_data", False):
+        archive_files.append(cdc_file)
+    if state_file and app.config.get("archive_state_data", False):
+        archive_files.append(state_file)
+    return archive_files
+
+@app.post("/automatic_report", status_code=202)
 async def automatic_report(year: int, isCDCFilter: bool, reportName: str,
-                           cdc_file:  UploadFile = File(None), attributes: str = Form("[]")):
-    # Run query to retrieve data from NBS ODSE database
-    (column_names, state_content) = run_query(year)
-    if not len(state_content) > 0:
-        raise HTTPException(status_code=400, detail="Query resulted in no data")
-
-    # Create temp file structure
-    folder_name = "temp"
-    if not os.path.exists(os.path.join(app.dir, folder_name)):
-        os.makedirs(os.path.join(app.dir, folder_name))
+                           cdc_file:  UploadFile = File(None), attributes: str = Form("[]"), refresh: bool = False,
+                           profile: bool = False, force: bool = False):
+    """
+    Saves the uploaded CDC file and queues the query and comparison, returns the ID of the job to follow it with.
+    If a report for the same CDC file, year, filter and attributes is queued or running, the job is that one
+    (coalesced is true then, and reportName is that job's), unless force is set. See coalesced_job.
+    refresh skips the cached State data for the year (if the state cache is on) and queries it again.
+    profile runs the query and comparison under cProfile, see /reports/{report_id}/profile.
+    """
+    folder = make_temp_folder()
     try:
-        # Fetching the archive_path for saving the Report
-        archive_path = await get_config_setting("archive_path")
-        
-        id = str(uuid.uuid4())
-        os.makedirs(os.path.join(app.dir, folder_name, id), mode=0o777)
-
-        # Write queried state data to csv
-        state_save_to = os.path.join(app.dir, folder_name, id, "state.csv")
-        with open(state_save_to, "w", newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(column_names)
-            writer.writerows(state_content)
-
         # Write user-uploaded CDC data to local csv
-        cdc_content = await cdc_file.read()
-        cdc_save_to = os.path.join(app.dir, folder_name, id, "cdc.csv")
-        with open(cdc_save_to, "wb") as f:
-            f.write(cdc_content)
-
-        # Do comparison
-        res_file = os.path.join(app.dir, folder_name, id, "results.csv")
-        # Creating argument list for running compare.py
-        subprocess_args = [sys.executable,
-                        os.path.join(app.dir, "compare.py"),
-                        '-c', cdc_save_to,
-                        '-s', state_save_to,
-                        '-o', res_file]
-        
-        if isCDCFilter:
-            subprocess_args.append('-f')
-        
+        cdc_save_to = os.path.join(folder, "cdc.csv")
+        files = {"cdc": await save_upload(cdc_file, cdc_save_to, compare.CDC_REQUIRED_COLUMNS, "CDC")}
+
         attributes_list = json.loads(attributes)
-        subprocess_args.extend(['-a', *attributes_list])
-        
-        try:
-            process = await asyncio.create_subprocess_exec(*subprocess_args,
-                                                            stderr=subprocess.PIPE)
-            _, stderr = await process.communicate()  # Wait for subprocess to finish and get stderr
-            if process.returncode != 0:  # Non-zero return code indicates an error
-                error_message = stderr.decode().strip()  # Decode error message from bytes to string
-                raise RuntimeError(f"Subprocess failed with error: {error_message}")
-        except Exception as e:
-            print(f"Error running comparison: {e}")
-            raise HTTPException(status_code=500, detail="Error running comparison")
-        
-        # Add results to the response
-        res = []
-        with open(res_file, newline='') as csvfile:
-            # Create a CSV reader object
-            reader = csv.DictReader(csvfile)
-            # Loop through each row in the CSV file
-            for row in reader:
-                # Add the row as a dictionary to the list
-                res.append(tuple(row.values()))
-
-        numDiscrepancies = len(res)
-        reportId = insert_report(numDiscrepancies, reportName)
-
-        stats_file = os.path.join(app.dir, folder_name, id, "stats.csv")
-        stats_list = []
-
-        with open(stats_file, newline='') as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                tup = (reportId,) + tuple(row.values())
-                stats_list.append(tup)
-        
-        if archive_path:
-            # Making a folder for the specific reportId
-            archive_save_to = os.path.join(archive_path, str(reportId))
-            os.makedirs(archive_save_to, exist_ok=True)
+    except Exception as e:
+        # remove temp files / folder
+        shutil.rmtree(folder)
+        raise e
 
-            # writing the newly created results file to the archive folder too
-            shutil.copy2(res_file, archive_save_to)
-            shutil.copy2(stats_file, archive_save_to)
+    inputHash = fingerprint_inputs(files, year, isCDCFilter, attributes_list)
+    job = None if force or profile else coalesced_job(reportName, "automatic", files, inputHash)
+    if job is not None:
+        shutil.rmtree(folder, ignore_errors=True)
+        return coalesced_response(job)
+
+    job = start_job(reportName, folder, files, "automatic", profile, inputHash, automatic_report_job, reportName, year, folder,
+                    cdc_save_to, isCDCFilter, attributes_list, refresh)
+    return {"jobId": job["id"], "coalesced": False}
+
+async def automatic_report_job(progress, reportName, year, folder, cdc_save_to, isCDCFilter, attributes_list, refresh=False,
+                               profile_to=None, input_hash=None):
+    # Fetching the archive_path for saving the Report
+    archive_path = await get_config_setting("archive_path")
+
+    # The State data only gets written to a csv if it should be archived with the report
+    state_save_to = None
+    if archive_path and app.config.get("archive_state_data", False):
+        state_save_to = os.path.join(folder, "state.csv")
+
+    # Query the NBS ODSE database and compare the rows as they are fetched
+    engine = app.config.get("comparison_engine", "python")
+    if engine != "python" and state_save_to is None:
+        # Only the python engine can compare rows straight from the database, the others need a file
+        state_save_to = os.path.join(folder, "state.csv")
+    key = baseline_key(year, isCDCFilter, attributes_list)
+    since_report_id = previous_report(key)
+    pushdown = app.config.get("query_pushdown", True)
+    run_results, run_stats, rows_read = await run_in_compare_pool(
+        metrics.run_measured, state_query.reconcile_year, progress, profile_to, connection_string, year, cdc_save_to, isCDCFilter, attributes_list,
+        pushdown, app.config.get("query_arraysize", state_query.DEFAULT_ARRAYSIZE),
+        engine, state_save_to, progress, app.state_cache, refresh, attribute_normalizers)
+    # With the CDC event codes filtered in the query, no rows means every CDC case is missing from the State data,
+    # which the comparison has reported
+    if rows_read == 0 and not state_query.filters_event_codes(isCDCFilter, pushdown, app.state_cache):
+        raise HTTPException(status_code=400, detail="Query resulted in no data")
 
-        # Add reportId to each row
-        new_res = [(reportId,) + row for row in res]
+    archive_files = archived_inputs(cdc_save_to, state_save_to)
+    return await save_report_in_thread(reportName, run_results, run_stats, archive_path, archive_files, progress=progress,
+                                       baseline=(key, since_report_id), year=year, input_hash=input_hash)
+
+def baseline_key(year, isCDCFilter, attributes_list):
+    # A report is only compared against an earlier report of the same kind: same year (or manual), filter and attributes.
+    # Normalized values are what gets compared, so they are part of the kind too (if any are configured)
+    key = ["manual" if year is None else year, isCDCFilter, sorted(attributes_list)]
+    if attribute_normalizers:
+        key.append(sorted(attribute_normalizers.items()))
+    return json.dumps(key)
+
+def previous_report(key):
+    # ID of the latest report of this kind, which a new report's delta defaults to, or None for the first of its kind
+    cur = app.liteConn.cursor()
+    cur.execute("SELECT b.ReportID FROM Baselines b JOIN Reports r ON r.ID = b.ReportID WHERE b.BaselineKey = ?", (key,))
+    row = cur.fetchone()
+    return row[0] if row is not None else None
+
+async def save_upload(upload, save_to, required_columns, name):
+    """
+    Saves an uploaded (optionally gzipped) CSV file and returns its sha256, row count, size on disk and how long
+    saving it took. A file without the required columns is rejected as soon as its header is read.
+    """
+    start = time.perf_counter()
+    try:
+        sha256, rows = await uploads.save_upload(upload, save_to, required_columns, name)
+    except uploads.UploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"sha256": sha256, "rows": rows, "bytes": os.path.getsize(save_to), "seconds": round(time.perf_counter() - start, 3)}
 
-        insert_cases(new_res)
-        insert_statistics(stats_list)
-        
-        # remove temp files / folder
-        shutil.rmtree(os.path.join(app.dir, folder_name, id))
+def start_job(reportName, folder, files, kind, profile, inputHash, work, *args):
+    """
+    Queues a report job. work is a coroutine function that gets a compare.ProgressReporter followed by args,
+    plus profile_to (where to write the cProfile stats, None unless profile is set) and input_hash, and returns
+    the ID of the report it created. files describes the uploaded files (their sha256 and row count).
+    kind ("manual" or "automatic") is what the job's metrics and timing record are filed under.
+    inputHash is the fingerprint of the report's inputs, see fingerprint_inputs.
+    The job's temp folder is removed once it is done.
+    """
+    job = new_job(reportName, kind, files, inputHash)
+    job["profileTo"] = os.path.join(folder, "profile.prof") if profile else None
+    job["task"] = asyncio.create_task(run_job(job, folder, work, *args))
+    return job
+
+def new_job(reportName, kind, files, inputHash):
+    # A job that is queued, and added to the job list
+    forget_finished_jobs()
+    job = {
+        "id": str(uuid.uuid4()),
+        "reportName": reportName,
+        "kind": kind,
+        "files": files,
+        "inputHash": inputHash,
+        "coalesced": False,
+        # How many submissions are waiting for this job, see coalesced_job and cancel_job
+        "submitters": 1,
+        "profileTo": None,
+        "status": "queued",
+        "createdAt": time.time(),
+        "startedAt": None,
+        "finishedAt": None,
+        "reportId": None,
+        "error": None,
+        "progress": app.job_manager.dict(phase=None, rowsProcessed=0, rowsTotal=None, phaseStartedAt=None, cancelled=False,
+                                         phaseSeconds={}, counters={}),
+    }
+    app.jobs[job["id"]] = job
+    return job
+
+def fingerprint_inputs(files, year, isCDCFilter, attributes_list):
+    """
+    Fingerprint of a report's inputs: the sha256 of every uploaded file, the year (None for a manual report), the CDC
+    filter and the sorted attributes. The normalizers change the results as well, so they are part of it if any are set.
+    """
+    key = [year, {name: file["sha256"] for name, file in sorted(files.items())}, isCDCFilter, sorted(attributes_list)]
+    if attribute_normalizers:
+        key.append(sorted(attribute_normalizers.items()))
+    return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
 
-        return Response(status_code=200)
+def coalesced_job(reportName, kind, files, inputHash):
+    """
+    Returns the job a submission with these inputs can follow instead of running the report again, or None.
+    That is a queued or running job with the same inputs, or for a manual report (where the State data is an uploaded
+    file, so part of the fingerprint) a job that is already completed for the newest existing report with the same
+    inputs. An automatic report queries the State data when it runs, which can have changed since an earlier report.
+    Must be called without awaiting anything between it and start_job, so two submissions cannot both miss each other.
+    """
+    for job in app.jobs.values():
+        if job["inputHash"] == inputHash and job["status"] in ("queued", "running"):
+            app.metrics.inc("reports_coalesced_total", kind=kind, onto="job")
+            job["submitters"] += 1
+            return job
+    if kind != "manual":
+        return None
+
+    cur = app.liteConn.cursor()
+    cur.execute("SELECT ID, Name FROM Reports WHERE InputHash = ? ORDER BY ID DESC LIMIT 1", (inputHash,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    app.metrics.inc("reports_coalesced_total", kind=kind, onto="report")
+    # The job is for the existing report, so it has that report's name instead of the one submitted
+    job = new_job(row[1], kind, files, inputHash)
+    now = time.time()
+    job.update(status="completed", coalesced=True, startedAt=now, finishedAt=now, reportId=row[0])
+    return job
+
+def coalesced_response(job):
+    # The reportName submitted is not used, the response says which report (or queued / running job) it got instead.
+    # reportId is None until the job it joined is completed
+    return {"jobId": job["id"], "coalesced": True, "reportName": job["reportName"], "reportId": job["reportId"]}
+
+async def run_job(job, folder, work, *args):
+    progress = compare.ProgressReporter(job["progress"])
+    try:
+        # Wait for one of the max_concurrent_reports slots
+        async with app.job_slots:
+            job["status"] = "running"
+            job["startedAt"] = time.time()
+            job["reportId"] = await work(progress, *args, profile_to=job["profileTo"], input_hash=job["inputHash"])
+            progress.end_phase()
+        job["status"] = "completed"
+    except (asyncio.CancelledError, compare.RunCancelled):
+        job["status"] = "cancelled"
+    except HTTPException as e:
+        job["status"] = "failed"
+        job["error"] = e.detail
     except Exception as e:
+        print(f"Error running report job: {e}")
+        job["status"] = "failed"
+        job["error"] = "Internal Server Error"
+    finally:
+        job["finishedAt"] = time.time()
+        try:
+            record_job(job)
+        except Exception as e:
+            print(f"Error recording report job metrics: {e}")
         # remove temp files / folder
-        shutil.rmtree(os.path.join(app.dir, folder_name, id))
-        raise e
+        shutil.rmtree(folder, ignore_errors=True)
+
+def job_timing(job):
+    """
+    The timing record of a finished job: seconds spent waiting and running, seconds per phase (uploading is the time
+    the uploaded files took to save), the counters of the run and the comparison worker's peak memory.
+    """
+    progress = dict(job["progress"])
+    phases = {"uploading": round(sum(file["seconds"] for file in job["files"].values()), 3)}
+    phases.update((phase, round(seconds, 3)) for phase, seconds in (progress.get("phaseSeconds") or {}).items())
+    counters = dict(progress.get("counters") or {})
+    peak = counters.pop("workerPeakRSSMB", None)
+    counters["uploadBytes"] = sum(file["bytes"] for file in job["files"].values())
+    return {
+        "Kind": job["kind"],
+        "QueuedSeconds": round(job["startedAt"] - job["createdAt"], 3) if job["startedAt"] else None,
+        "RunSeconds": round(job["finishedAt"] - job["startedAt"], 3) if job["startedAt"] else None,
+        "PhaseSeconds": phases,
+        "Counters": counters,
+        "PeakRSSMB": round(peak, 1) if peak is not None else None,
+        "Profiled": job["profileTo"] is not None,
+    }
+
+def record_job(job):
+    # Adds a finished job to the metrics, and for a completed job stores its timing record (and profile) with the report
+    app.metrics.inc("reports_total", kind=job["kind"], status=job["status"])
+    if job["status"] != "completed":
+        return
+
+    timing = job_timing(job)
+    counters = timing["Counters"]
+    app.metrics.inc("report_run_seconds_total", timing["RunSeconds"], kind=job["kind"])
+    app.metrics.inc("report_queued_seconds_total", timing["QueuedSeconds"], kind=job["kind"])
+    for phase, seconds in timing["PhaseSeconds"].items():
+        app.metrics.inc("report_phase_seconds_total", seconds, kind=job["kind"], phase=phase)
+        app.metrics.inc("report_phase_runs_total", kind=job["kind"], phase=phase)
+    app.metrics.inc("rows_read_total", counters.get("cdcRowsRead", 0), side="cdc")
+    app.metrics.inc("rows_read_total", counters.get("stateRowsRead", 0), side="state")
+    app.metrics.inc("state_duplicates_collapsed_total", counters.get("stateDuplicatesCollapsed", 0))
+    app.metrics.inc("discrepancies_total", counters.get("discrepancies", 0))
+    app.metrics.inc("bytes_written_total", counters["uploadBytes"], target="upload")
+    app.metrics.inc("bytes_written_total", counters.get("archiveBytes", 0), target="archive")
+    if timing["PeakRSSMB"] is not None:
+        app.metrics.set("last_report_peak_rss_megabytes", timing["PeakRSSMB"])
+
+    report_db.save_report_timing(app.liteConn, job["reportId"], timing)
+    if timing["Profiled"] and os.path.exists(job["profileTo"]):
+        os.makedirs(profiles_path, exist_ok=True)
+        for suffix in ("", ".txt"):
+            os.replace(job["profileTo"] + suffix, profile_file(job["reportId"]) + suffix)
+
+def profile_file(report_id):
+    return os.path.join(profiles_path, f"{report_id}.prof")
+
+def forget_finished_jobs():
+    now = time.time()
+    for job_id in [job_id for job_id, job in app.jobs.items() if job["finishedAt"] is not None and now - job["finishedAt"] > JOB_RETENTION]:
+        del app.jobs[job_id]
+
+def job_status(job):
+    """
+    The JSON view of a job. etaSeconds is an estimate for the current phase, it is only there while
+    the phase knows how many rows it has to go through (comparing and persisting).
+    """
+    progress = dict(job["progress"])
+    eta = None
+    if job["status"] in ("running", "cancelling") and progress["rowsTotal"] and progress["rowsProcessed"]:
+        elapsed = time.time() - progress["phaseStartedAt"]
+        eta = round(elapsed * (progress["rowsTotal"] - progress["rowsProcessed"]) / progress["rowsProcessed"], 1)
+
+    return {
+        "id": job["id"],
+        "reportName": job["reportName"],
+        "files": job["files"],
+        "status": job["status"],
+        "phase": progress["phase"],
+        "rowsProcessed": progress["rowsProcessed"],
+        "rowsTotal": progress["rowsTotal"],
+        "etaSeconds": eta,
+        "phaseSeconds": {phase: round(seconds, 3) for phase, seconds in progress["phaseSeconds"].items()},
+        "createdAt": job["createdAt"],
+        "startedAt": job["startedAt"],
+        "finishedAt": job["finishedAt"],
+        "reportId": job["reportId"],
+        "coalesced": job["coalesced"],
+        "submitters": job["submitters"],
+        "error": job["error"],
+    }
+
+@app.get("/jobs")
+async def get_jobs():
+    # Newest jobs at the top
+    return [job_status(job) for job in sorted(app.jobs.values(), key=lambda job: job["createdAt"], reverse=True)]
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = app.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job_status(job)
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    """
+    Cancels a job. A queued job is dropped right away, a running one stops the next time it reports progress.
+    A job other submissions were coalesced onto is only cancelled once all of them have cancelled it.
+    """
+    job = app.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] in ("queued", "running") and job["submitters"] > 1:
+        job["submitters"] -= 1
+    elif job["status"] == "queued":
+        job["task"].cancel()
+    elif job["status"] == "running":
+        job["status"] = "cancelling"
+        job["progress"]["cancelled"] = True
+    return Response(status_code=200)
 
 @app.get("/reports")
 async def get_report_summaries():
@@ -334,12 +537,100 @@ async def get_report_cases(report_id: int):
         raise HTTPException(status_code=404, detail="Report not found")
     return report
 
+@app.get("/reports/{report_id}/cases")
+async def get_report_cases_page(report_id: int, limit: int = 100, cursor: str = None, sort: str = "ID", order: str = "asc",
+                                reasonId: int = None, eventCode: str = None, mmwrWeek: int = None,
+                                caseClassStatus: str = None, caseIdPrefix: str = None, search: str = None):
+    """
+    Endpoint to fetch one page of a report's cases, filtered and sorted on the server.
+    Returns the total number of matching cases, the cases, and the cursor to pass in for the next page (null on the last page).
+    """
+    if limit < 1 or limit > report_db.MAX_CASE_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit has to be between 1 and {report_db.MAX_CASE_PAGE_SIZE}")
+    if sort not in report_db.CASE_SORT_COLUMNS:
+        raise HTTPException(status_code=400, detail=f"sort has to be one of {', '.join(report_db.CASE_SORT_COLUMNS)}")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order has to be asc or desc")
+
+    filters = {"ReasonID": reasonId, "EventCode": eventCode, "MMWRWeek": mmwrWeek,
+               "CaseClassStatus": caseClassStatus, "CaseIDPrefix": caseIdPrefix}
+    try:
+        total, cases, next_cursor = report_db.fetch_case_page(app.liteConn, report_id, filters, sort, order == "desc",
+                                                              limit, cursor, search)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        raise HTTPException(status_code = 500, detail = "Internal Server Error")
+    return {"total": total, "cases": cases, "nextCursor": next_cursor}
+
+@app.get("/reports/{report_id}/export")
+async def export_report(report_id: int, format: str = "csv", gzip: bool = False):
+    """
+    Streams all of a report's cases as a CSV, NDJSON or Parquet file download, optionally gzipped (CSV and NDJSON).
+    """
+    if format not in report_export.EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format has to be one of {', '.join(report_export.EXPORT_FORMATS)}")
+    if format == "parquet":
+        if gzip:
+            raise HTTPException(status_code=400, detail="Parquet exports are already compressed, gzip is only for csv and ndjson")
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise HTTPException(status_code=400, detail="Parquet exports need pyarrow to be installed on the server")
+
+    cur = app.liteConn.cursor()
+    cur.execute("SELECT ID FROM Reports WHERE ID = ?", (report_id,))
+    if cur.fetchone() is None:
+        raise HTTPException(status_code=404, detail="Report not found")
+
+    extension, media_type = report_export.EXPORT_FORMATS[format]
+    filename = f"report-{report_id}.{extension}"
+    if gzip:
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(report_export.export_chunks(database_file_path, report_id, format, gzip), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.get("/reports/{report_id}/delta")
+async def get_report_delta(report_id: int, since: int = None, limit: int = 100):
+    """
+    Endpoint to see what changed since an earlier report: the discrepancies that are new and the ones that were resolved.
+    since defaults to the previous report of the same kind (year or manual, filter and attributes) when the report was
+    saved. Each list has at most limit cases.
+    """
+    if limit < 0 or limit > report_db.MAX_CASE_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit has to be between 0 and {report_db.MAX_CASE_PAGE_SIZE}")
+    try:
+        if since is None:
+            since = report_db.fetch_since_report(app.liteConn, report_id)
+            if since is None:
+                raise HTTPException(status_code=400, detail="The report has no earlier report of its kind, pass since")
+
+        cur = app.liteConn.cursor()
+        for id in (report_id, since):
+            cur.execute("SELECT ID FROM Reports WHERE ID = ?", (id,))
+            if cur.fetchone() is None:
+                raise HTTPException(status_code=404, detail=f"Report {id} not found")
+
+        (new_total, new_cases), (resolved_total, resolved_cases) = report_db.fetch_discrepancy_delta(app.liteConn, report_id, since, limit)
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        raise HTTPException(status_code = 500, detail = "Internal Server Error")
+
+    return {
+        "reportId": report_id,
+        "since": since,
+        "newDiscrepancies": {"total": new_total, "cases": new_cases},
+        "resolvedDiscrepancies": {"total": resolved_total, "cases": resolved_cases},
+    }
+
 @app.get("/report_statistics/{report_id}")
 async def get_report_statistics(report_id: int):
     try:
         cur = app.liteConn.cursor()
         cur.execute(
-            "SELECT * FROM Statistics WHERE ReportID = ?", (report_id,))
+            "SELECT * FROM Statistics WHERE ReportID = ? ORDER BY ID", (report_id,))
         results = cur.fetchall()
         if not results:
             raise HTTPException(status_code = 404, detail = "Report Not Found")
@@ -349,6 +640,26 @@ async def get_report_statistics(report_id: int):
         print(f"Database error: {e}")
         raise HTTPException(status_code = 500, detail = "Internal Server Error")
     
+@app.get("/trends")
+async def get_trends(eventCodes: str = None, since: str = None, until: str = None, year: int = None):
+    """
+    Endpoint to get how the statistics of one or more EventCodes (comma separated, all codes if left out) changed
+    over the reports, oldest report first. since / until (YYYY-MM-DD) limit the reports by the date they were created,
+    year to automatic reports for that year.
+    """
+    for name, value in (("since", since), ("until", until)):
+        if value is not None:
+            try:
+                datetime.date.fromisoformat(value)
+            except ValueError:
+                raise HTTPException(status_code=400, detail=f"{name} has to be a date like 2024-01-31")
+    codes = [code.strip() for code in eventCodes.split(",") if code.strip()] if eventCodes else None
+    try:
+        return report_db.fetch_trends(app.liteConn, codes, since, until, year)
+    except sqlite3.Error as e:
+        print(f"Database error: {e}")
+        raise HTTPException(status_code = 500, detail = "Internal Server Error")
+
 @app.post("/reports")
 async def rename_report(report_id: int, new_name: str):
     try:
@@ -364,77 +675,210 @@ async def rename_report(report_id: int, new_name: str):
 @app.delete("/reports/{report_id}")
 async def delete_report(report_id: int):
     """
-    Deletes a report from all 3 tables.
+    Deletes a report: its cases, statistics, trend points and timings, and its profile files. Reports whose delta
+    defaulted to it default to the previous report of the same kind instead (see report_db.remove_from_deltas).
     """
     try:
-        cur = app.liteConn.cursor()
-        cur.execute("DELETE FROM Reports WHERE ID = ?", (report_id,))
-        cur.execute("DELETE FROM Cases WHERE ReportID = ?", (report_id,))
-        cur.execute("DELETE FROM Statistics WHERE ReportID = ?", (report_id,))
-        app.liteConn.commit()
+        delete_report_rows(report_id)
         return Response(status_code=200)
     except sqlite3.Error as e:
         print(f"Database error: {e}")
-        app.liteConn.rollback()
         return HTTPException(status_code = 500, detail = "Internal Server Error")
 
+async def run_comparison(cdc_file, state_file, isCDCFilter, attributes_list, progress=None, profile_to=None):
+    """
+    Runs compare.reconcile in the worker pool and returns its (results, stats).
+    The run is profiled into profile_to if it is given.
+    """
+    return await run_in_compare_pool(metrics.run_measured, compare.reconcile, progress, profile_to, cdc_file, state_file,
+                                     isCDCFilter, attributes_list, app.config.get("comparison_engine", "python"), 1,
+                                     progress, attribute_normalizers)
+
+async def run_in_compare_pool(function, *args):
+    loop = asyncio.get_running_loop()
+    try:
+        try:
+            return await loop.run_in_executor(app.compare_pool, function, *args)
+        except BrokenProcessPool:
+            # A worker died (e.g. ran out of memory), so replace the pool before reporting the error
+            app.compare_pool = create_compare_pool()
+            raise
+    except compare.RunCancelled:
+        raise
+    except Exception as e:
+        print(f"Error running comparison: {e}")
+        raise HTTPException(status_code=500, detail="Error running comparison")
+
+def save_report(reportName, run_results, run_stats, archive_path=None, archive_files=(), conn=None, progress=None,
+                baseline=None, year=None, input_hash=None):
+    """
+    Stores the results and stats of a comparison as a new report and returns its ID.
+    year is the year an automatic report was run for, input_hash the fingerprint of its inputs (see fingerprint_inputs).
+    Any archive_files (e.g. the State data) are copied into the report's archive folder, or written there as Parquet
+    files if archive_format is parquet.
+    baseline is (baseline key, ID of the previous report of the same kind or None), see save_baseline.
+    If the run is cancelled while the cases are inserted, the report is removed again.
+    """
+    conn = conn or app.liteConn
+    if progress is not None:
+        progress('persisting', 0, len(run_results))
+    reportId = report_db.insert_report(conn, len(run_results), reportName, input_hash)
+
+    archive_save_to = None
+    try:
+        if archive_path:
+            # Making a folder for the specific reportId
+            archive_save_to = os.path.join(archive_path, str(reportId))
+            os.makedirs(archive_save_to, exist_ok=True)
+
+            # writing the results and stats files to the archive folder
+            if archive_format == "parquet":
+                import parquet_archive
+                parquet_archive.write_results(run_results, os.path.join(archive_save_to, "results.parquet"))
+                parquet_archive.write_stats(run_stats, os.path.join(archive_save_to, "stats.parquet"))
+                for archive_file in archive_files:
+                    file_name = os.path.splitext(os.path.basename(archive_file))[0] + ".parquet"
+                    parquet_archive.write_input(archive_file, os.path.join(archive_save_to, file_name))
+            else:
+                compare.write_results(run_results, os.path.join(archive_save_to, "results.csv"))
+                compare.write_stats(run_stats, os.path.join(archive_save_to, "stats.csv"))
+                for archive_file in archive_files:
+                    shutil.copy2(archive_file, archive_save_to)
+            if hasattr(progress, 'record'):
+                progress.record(archiveBytes=sum(entry.stat().st_size for entry in os.scandir(archive_save_to) if entry.is_file()))
+
+        # Add reportId to each row
+        report_db.insert_cases(conn, ((reportId,) + result.as_tuple() for result in run_results), progress, len(run_results))
+        report_db.insert_statistics(conn, [(reportId,) + row for row in compare.stats_rows(run_stats)], year)
+    except compare.RunCancelled:
+        delete_report_rows(reportId, conn)
+        if archive_save_to is not None:
+            shutil.rmtree(archive_save_to, ignore_errors=True)
+        raise
+
+    if baseline is not None:
+        save_baseline(reportId, *baseline, conn)
+    return reportId
+
+def save_baseline(report_id, key, since_report_id, conn=None):
+    """
+    Records the report the new report's delta defaults to, and makes the new report the one the delta of the next
+    report of its kind defaults to.
+    """
+    conn = conn or app.liteConn
+    try:
+        cur = conn.cursor()
+        if since_report_id is not None:
+            cur.execute("INSERT INTO ReportDeltas (ReportID, SinceReportID) VALUES (?, ?)", (report_id, since_report_id))
+        cur.execute("INSERT OR REPLACE INTO Baselines (BaselineKey, ReportID) VALUES (?, ?)", (key, report_id))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+
+async def save_report_in_thread(*args, **kwargs):
+    """
+    Runs save_report in a thread so the inserts do not hold up other requests.
+    sqlite connections can only be used from the thread that opened them, so the thread opens its own.
+    """
+    def save():
+        conn = report_db.connect(database_file_path)
+        try:
+            return save_report(*args, conn=conn, **kwargs)
+        finally:
+            conn.close()
+    return await asyncio.to_thread(save)
+
 def fetch_reports_from_db(report_id: int):
     """
     Function to fetch a report from the SQLite database.
     """
     try:
         cur = app.liteConn.cursor()
-        cur.execute("SELECT * FROM Cases WHERE ReportID = ?", (report_id,))
+        cur.execute("SELECT * FROM Cases WHERE ReportID = ? ORDER BY ID", (report_id,))
         return [dict(zip([column[0] for column in cur.description], row)) for row in cur.fetchall()]
     except sqlite3.Error as e:
         print(f"Database error: {e}")
         return None
 
-def insert_report(noOfDiscrepancies, name = ""):
-    try:
-        cur = app.liteConn.cursor()
-        cur.execute("INSERT INTO Reports (CreatedAtDate, TimeOfCreation, NumberOfDiscrepancies, Name)  VALUES (DATE('now'), TIME('now'), ?, ?)", (noOfDiscrepancies, name))
-        report_id = cur.lastrowid
-        # Set default name if none provided
-        if name == "":
-            cur.execute("UPDATE Reports SET Name = ? WHERE ID = ?", (f"Report {report_id}", report_id))
-        app.liteConn.commit()
-        return report_id
-    except Exception as e:
-        app.liteConn.rollback()
-        raise e  
-
-def insert_statistics(stats):
+def delete_report_rows(report_id, conn=None):
+    conn = conn or app.liteConn
     try:
-        cur = app.liteConn.cursor()
-        cur.executemany("INSERT INTO Statistics (ReportID, EventCode, EventName, TotalCases, TotalDuplicates, TotalMissingFromCDC, TotalMissingFromState, TotalWrongAttributes) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", stats)
-        app.liteConn.commit()
+        cur = conn.cursor()
+        cur.execute("DELETE FROM Reports WHERE ID = ?", (report_id,))
+        cur.execute("DELETE FROM Cases WHERE ReportID = ?", (report_id,))
+        cur.execute("DELETE FROM Statistics WHERE ReportID = ?", (report_id,))
+        cur.execute("DELETE FROM StatisticTrends WHERE ReportID = ?", (report_id,))
+        report_db.remove_from_deltas(cur, report_id)
+        cur.execute("DELETE FROM ReportTimings WHERE ReportID = ?", (report_id,))
+        conn.commit()
     except Exception as e:
-        app.liteConn.rollback()
+        conn.rollback()
         raise e
+    for suffix in ("", ".txt"):
+        if os.path.exists(profile_file(report_id) + suffix):
+            os.remove(profile_file(report_id) + suffix)
 
-def insert_cases(res):
-    try:
-        cur = app.liteConn.cursor()
-        cur.executemany("INSERT INTO Cases (ReportID, CaseID, EventCode, EventName, MMWRYear, MMWRWeek, Reason, ReasonID, CaseClassStatus) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", res)
-        app.liteConn.commit()
-    except Exception as e:
-        app.liteConn.rollback()
-        raise e
+@app.get("/state_cache")
+async def get_state_cache():
+    """
+    Endpoint to see the cached State data (per year) and the cache's hit / miss counters.
+    """
+    if app.state_cache is None:
+        return {"enabled": False}
+    status = await asyncio.to_thread(app.state_cache.status)
+    return {"enabled": True, **status}
 
-def run_query(year: int):
-    query = None
-    query_file_path = os.path.join(app.dir, "query.sql")
-    with open(query_file_path, 'r') as f:
-        query = f.read()
+@app.delete("/state_cache")
+async def clear_state_cache():
+    """
+    Removes all cached State data, the next automatic report for any year queries the state database again.
+    """
+    if app.state_cache is not None:
+        await asyncio.to_thread(app.state_cache.clear)
+    return Response(status_code=200)
 
-    cursor = app.conn.cursor()
-    cursor.execute(query, year)
-    # Return the queried data as a list of dicts
-    column_names = [col[0] for col in cursor.description]
-    data = cursor.fetchall()
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Endpoint for Prometheus to scrape: report job counts and timings, rows read, bytes written,
+    the jobs queued / running right now and the state cache counters.
+    """
+    statuses = ["queued", "running", "cancelling"]
+    extra = [("jobs", "gauge", "Report jobs by status right now",
+              [({"status": status}, sum(job["status"] == status for job in app.jobs.values())) for status in statuses])]
+    if app.state_cache is not None:
+        status = await asyncio.to_thread(app.state_cache.status)
+        extra.append(("state_cache_lookups_total", "counter", "State cache lookups by outcome, and evicted entries",
+                      [({"event": name}, value) for name, value in status["counters"].items()]))
+        extra.append(("state_cache_bytes", "gauge", "Size of the cached State data",
+                      [({}, sum(entry["bytes"] for entry in status["entries"]))]))
+    return PlainTextResponse(app.metrics.render(extra), media_type="text/plain; version=0.0.4")
+
+@app.get("/reports/{report_id}/timings")
+async def get_report_timings(report_id: int):
+    """
+    Endpoint to see how long a report took in each phase and how many rows it went through.
+    """
+    timing = report_db.fetch_report_timing(app.liteConn, report_id)
+    if timing is None:
+        raise HTTPException(status_code=404, detail="No timings for this report")
+    return timing
 
-    return (column_names, data)
+@app.get("/reports/{report_id}/profile")
+async def get_report_profile(report_id: int, format: str = "prof"):
+    """
+    Endpoint to download the cProfile stats of a report that was run with profile=true.
+    format=prof gives the stats file (for pstats or snakeviz), format=text the slowest functions as text.
+    """
+    if format not in ("prof", "text"):
+        raise HTTPException(status_code=400, detail="format has to be prof or text")
+    path = profile_file(report_id) + (".txt" if format == "text" else "")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="This report was not profiled")
+    if format == "text":
+        return FileResponse(path, media_type="text/plain")
+    return FileResponse(path, media_type="application/octet-stream", filename=f"report-{report_id}.prof")
 
 @app.get("/config/{field_name}")
 async def get_config_setting(field_name: str):
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import time
+import uuid
+
+# Local cache of the State data query.sql returns for a year, so reports for the same year run minutes apart
+# (with different CDC files or attributes) do not all have to run the query against the state database again.
+# Every cached extract is its own SQLite file in the cache folder, cache.db keeps track of them and of the counters.
+
+DEFAULT_TTL_MINUTES = 60
+DEFAULT_MAX_SIZE_MB = 1024
+
+INDEX_FILE = "cache.db"
+
+COUNTERS = ['hits', 'misses', 'expired', 'refreshes', 'evictions']
+
+INDEX_TABLES = [
+    '''
+    CREATE TABLE IF NOT EXISTS Entries(
+        CacheKey TEXT PRIMARY KEY NOT NULL,
+        Year TEXT,
+        QueryHash TEXT,
+        Target TEXT,
+        Pushdown INTEGER,
+        FileName TEXT NOT NULL,
+        Rows INTEGER,
+        Bytes INTEGER,
+        CreatedAt REAL,
+        LastUsedAt REAL
+)''',
+    '''
+    CREATE TABLE IF NOT EXISTS Counters(
+        Name TEXT PRIMARY KEY NOT NULL,
+        Value INTEGER NOT NULL
+)''',
+]
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def write_extract(cursor, path, arraysize, progress=None):
+    """
+    Fetches all rows of a state database cursor into a new SQLite file, with the values as the strings
+    state_query.iter_state_rows would turn them into. Returns the number of rows written.
+    """
+    column_names = [col[0] for col in cursor.description]
+    rows_written = 0
+    conn = sqlite3.connect(path)
+    try:
+        # The columns are left without a type so the strings are stored as they are
+        conn.execute(f"CREATE TABLE State ({', '.join(quote(name) for name in column_names)})")
+        insert = f"INSERT INTO State VALUES ({', '.join('?' * len(column_names))})"
+        while True:
+            batch = cursor.fetchmany(arraysize)
+            if not batch:
+                break
+            conn.executemany(insert, [['' if value is None else str(value) for value in row] for row in batch])
+            rows_written += len(batch)
+            if progress is not None:
+                progress('querying', rows_written)
+        conn.commit()
+    finally:
+        conn.close()
+    return rows_written
+
+def open_extract(path, arraysize):
+    # A cursor with the same description / fetchmany interface as the state database cursor.
+    # Opened read only, so an extract that was evicted in the meantime is an error instead of a new empty file
+    cursor = sqlite3.connect(pathlib.Path(os.path.abspath(path)).as_uri() + "?mode=ro", uri=True).execute("SELECT * FROM State ORDER BY rowid")
+    cursor.arraysize = arraysize
+    return cursor
+
+class StateCache:
+    """
+    Cache of State query results keyed by year, query.sql, pushdown and the database they came from.
+    Entries older than ttl_minutes are queried again, and once the extracts take up more than max_size_mb
+    the least recently used ones are removed. Safe to use from several processes at once.
+    """
+    def __init__(self, folder, ttl_minutes=DEFAULT_TTL_MINUTES, max_size_mb=DEFAULT_MAX_SIZE_MB) -> None:
+        self.folder = folder
+        self.ttl = ttl_minutes * 60
+        self.max_size = max_size_mb * 1024 * 1024
+
+    def connect(self):
+        os.makedirs(self.folder, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(self.folder, INDEX_FILE), timeout=30)
+        conn.execute("PRAGMA journal_mode = WAL")
+        for table in INDEX_TABLES:
+            conn.execute(table)
+        conn.commit()
+        return conn
+
+    def count(self, conn, name):
+        conn.execute("INSERT INTO Counters (Name, Value) VALUES (?, 1) ON CONFLICT(Name) DO UPDATE SET Value = Value + 1", (name,))
+
+    def cursor(self, target, year, query, pushdown, fetch, refresh=False, progress=None, arraysize=5000):
+        """
+        Returns a cursor over the State data for a year. If there is no fresh cached copy (or refresh is set),
+        the rows of the state database cursor fetch() gives (as a context manager, like db_pool.ConnectionPool.query)
+        are cached first.
+        target identifies the state database, without the login.
+        """
+        query_hash = hashlib.sha256(query.encode('utf-8')).hexdigest()
+        key = hashlib.sha256(json.dumps([target, str(year), query_hash, bool(pushdown)]).encode('utf-8')).hexdigest()
+        now = time.time()
+
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT FileName, CreatedAt FROM Entries WHERE CacheKey = ?", (key,))
+            entry = cur.fetchone()
+            if entry is not None and not os.path.exists(os.path.join(self.folder, entry[0])):
+                entry = None
+
+            if entry is not None and not refresh and now - entry[1] < self.ttl:
+                cur.execute("UPDATE Entries SET LastUsedAt = ? WHERE CacheKey = ?", (now, key))
+                self.count(conn, 'hits')
+                conn.commit()
+                return open_extract(os.path.join(self.folder, entry[0]), arraysize)
+
+            self.count(conn, 'refreshes' if refresh else 'expired' if entry is not None else 'misses')
+            conn.commit()
+        finally:
+            conn.close()
+
+        # Filled into a file of its own, so a failed or cancelled query never leaves a partial extract behind
+        file_name = f"{key[:16]}-{uuid.uuid4().hex}.sqlite"
+        path = os.path.join(self.folder, file_name)
+        try:
+            with fetch() as cursor:
+                rows = write_extract(cursor, path, arraysize, progress)
+        except BaseException:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT FileName FROM Entries WHERE CacheKey = ?", (key,))
+            replaced = cur.fetchone()
+            cur.execute("INSERT OR REPLACE INTO Entries (CacheKey, Year, QueryHash, Target, Pushdown, FileName, Rows, Bytes, CreatedAt, LastUsedAt) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (key, str(year), query_hash, target, int(bool(pushdown)), file_name, rows, os.path.getsize(path), now, now))
+            conn.commit()
+            if replaced is not None:
+                self.remove_file(replaced[0])
+            self.evict(conn, keep=key)
+        finally:
+            conn.close()
+
+        return open_extract(path, arraysize)
+
+    def remove_file(self, file_name):
+        # On Windows a file that is still being read cannot be removed, it is left for the next eviction
+        try:
+            os.remove(os.path.join(self.folder, file_name))
+            return True
+        except FileNotFoundError:
+            return True
+        except OSError:
+            return False
+
+    def evict(self, conn, keep=None):
+        """
+        Removes the expired entries, then the least recently used ones until the extracts fit in max_size_mb.
+        The keep entry (the one just written) is never removed.
+        """
+        cur = conn.cursor()
+        cur.execute("SELECT CacheKey, FileName, Bytes, CreatedAt FROM Entries ORDER BY LastUsedAt DESC")
+        entries = cur.fetchall()
+        now = time.time()
+        total = 0
+        for key, file_name, size, created_at in entries:
+            if key != keep and (now - created_at >= self.ttl or total + size > self.max_size) and self.remove_file(file_name):
+                cur.execute("DELETE FROM Entries WHERE CacheKey = ?", (key,))
+                self.count(conn, 'evictions')
+            else:
+                total += size
+        conn.commit()
+
+    def clear(self):
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT CacheKey, FileName FROM Entries")
+            for key, file_name in cur.fetchall():
+                if self.remove_file(file_name):
+                    cur.execute("DELETE FROM Entries WHERE CacheKey = ?", (key,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def status(self):
+        # The cached extracts (most recently used first) and the hit / miss counters
+        conn = self.connect()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT Year, Pushdown, Rows, Bytes, CreatedAt, LastUsedAt FROM Entries ORDER BY LastUsedAt DESC")
+            now = time.time()
+            entries = [{"year": year, "pushdown": bool(pushdown), "rows": rows, "bytes": size,
+                        "ageSeconds": round(now - created_at), "expired": now - created_at >= self.ttl,
+                        "lastUsedAt": last_used_at}
+                       for year, pushdown, rows, size, created_at, last_used_at in cur.fetchall()]
+            counters = {name: 0 for name in COUNTERS}
+            cur.execute("SELECT Name, Value FROM Counters")
+            counters.update(dict(cur.fetchall()))
+        finally:
+            conn.close()
+        return {"entries": entries, "counters": counters, "ttlMinutes": self.ttl / 60, "maxSizeMB": self.max_size / (1024 * 1024)}
@@ -0,0 +1,205 @@
+import csv
+import os
+import compare
+import db_pool
+
+# Shared by server.py and cli.py for pulling the State data out of the state database (NBS ODSE for the default query.sql)
+
+query_file_path = os.path.join(os.path.dirname(__file__), "query.sql")
+
+# Rows fetched per round trip when the query results are streamed
+DEFAULT_ARRAYSIZE = 5000
+
+# Each comparison worker process keeps its own pool of connections to the state database, see configure_pool
+_pools = {}
+_pool_options = {}
+
+# Seconds pyodbc waits for the login to the state database
+DEFAULT_LOGIN_TIMEOUT = 30
+
+# Temp table the CDC event codes are loaded into, it only lives as long as the connection's session
+EVENT_CODES_TABLE = "#cdc_event_codes"
+
+def build_connection_string(config):
+    db_username = config.get("database_username") or os.getenv('DB_USERNAME')
+    db_password = config.get("database_password") or os.getenv('DB_PASSWORD')
+
+    connection_string_base = 'DRIVER={' + config["driver"] + \
+        '}' + \
+        f';SERVER={config["server"]};DATABASE={config["database"]};'
+
+    if db_username and db_password:
+        connection_string_auth = f'UID={db_username};PWD={db_password};'
+    else:
+        connection_string_auth = 'Trusted_Connection=yes;'
+
+    return connection_string_base + connection_string_auth
+
+def connection_target(connection_string):
+    # The driver, server and database of a connection string without the login, e.g. to tell cached State data apart
+    return ';'.join(part for part in connection_string.split(';') if part and not part.upper().startswith(('UID=', 'PWD=')))
+
+def read_query():
+    with open(query_file_path, 'r') as f:
+        return f.read()
+
+def pushdown_query(query, filter_event_codes=False):
+    """
+    Wraps query.sql so SQL Server does the work compare.index_state_rows would otherwise do in Python:
+    dropping non-numeric EventCodes, optionally keeping only the CDC event codes, and keeping the row with
+    the latest add_time per CaseID. query.sql has to be usable as a derived table for this (no ORDER BY or CTEs).
+    """
+    query = query.strip().rstrip(';')
+    conditions = ["state.EventCode NOT LIKE '%[^0-9]%'", "state.EventCode <> ''"]
+    if filter_event_codes:
+        conditions.append(f"state.EventCode IN (SELECT EventCode FROM {EVENT_CODES_TABLE})")
+
+    # TOP 1 WITH TIES on the row number keeps exactly one row per CaseID without adding a column to the output
+    return f"""SELECT TOP 1 WITH TIES state.*
+FROM (
+{query}
+) AS state
+WHERE {' AND '.join(conditions)}
+ORDER BY ROW_NUMBER() OVER (PARTITION BY state.CaseID ORDER BY state.add_time DESC)"""
+
+def load_event_codes(cursor, eventCodes):
+    # A temp table instead of a table-valued parameter, so no user-defined table type has to exist on the server
+    cursor.execute(f"IF OBJECT_ID('tempdb..{EVENT_CODES_TABLE}') IS NOT NULL DROP TABLE {EVENT_CODES_TABLE}")
+    # Temp tables take tempdb's collation unless told otherwise, and comparing against a column of another
+    # collation fails (error 468), so the column gets the state database's collation
+    cursor.execute(f"CREATE TABLE {EVENT_CODES_TABLE} (EventCode VARCHAR(50) COLLATE DATABASE_DEFAULT NOT NULL PRIMARY KEY)")
+    if eventCodes:
+        cursor.fast_executemany = True
+        cursor.executemany(f"INSERT INTO {EVENT_CODES_TABLE} (EventCode) VALUES (?)", [(code,) for code in sorted(eventCodes)])
+
+def execute_state_query(conn, year, eventCodes=None, pushdown=True, query=None):
+    """
+    Runs query.sql (or the query text given) for a year and returns the cursor, ready to be fetched from.
+    With pushdown, the dedup and event code filtering happen in the database.
+    """
+    cursor = conn.cursor()
+    if query is None:
+        query = read_query()
+    if pushdown:
+        if eventCodes is not None:
+            load_event_codes(cursor, eventCodes)
+        query = pushdown_query(query, eventCodes is not None)
+    cursor.execute(query, year)
+    return cursor
+
+def configure_pool(config):
+    """
+    Sets up the state database pool settings from config.json for this process (the server runs this in every
+    comparison worker). Pools that were already made keep their settings.
+    """
+    _pool_options.update(
+        max_size=config.get("database_pool_size", db_pool.DEFAULT_MAX_SIZE),
+        retries=config.get("database_retries", db_pool.DEFAULT_RETRIES),
+        backoff=config.get("database_retry_backoff", db_pool.DEFAULT_BACKOFF),
+        query_timeout=config.get("database_query_timeout", 0),
+        login_timeout=config.get("database_login_timeout", DEFAULT_LOGIN_TIMEOUT),
+    )
+
+def get_pool(connection_string):
+    if connection_string not in _pools:
+        options = dict(_pool_options)
+        login_timeout = options.pop('login_timeout', DEFAULT_LOGIN_TIMEOUT)
+
+        def connect():
+            import pyodbc
+            return pyodbc.connect(connection_string, timeout=login_timeout)
+        _pools[connection_string] = db_pool.ConnectionPool(connect, **options)
+    return _pools[connection_string]
+
+def iter_state_rows(cursor, arraysize=DEFAULT_ARRAYSIZE, csv_writer=None):
+    """
+    Streams the query results in fetchmany batches as lists in the order of the cursor's columns, with the values
+    turned into strings the same way they would be after a round trip through state.csv. If a csv_writer is given,
+    the rows are also written to it (e.g. to archive the State data).
+    """
+    column_names = [col[0] for col in cursor.description]
+    if csv_writer is not None:
+        csv_writer.writerow(column_names)
+
+    while True:
+        batch = cursor.fetchmany(arraysize)
+        if not batch:
+            break
+        if csv_writer is not None:
+            csv_writer.writerows(batch)
+        for row in batch:
+            yield ['' if value is None else str(value) for value in row]
+
+def write_state_csv(cursor, state_csv, arraysize=DEFAULT_ARRAYSIZE):
+    # Writes the query results to a CSV file batch by batch and returns how many rows were written
+    rows_written = 0
+    with open(state_csv, "w", newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow([col[0] for col in cursor.description])
+        while True:
+            batch = cursor.fetchmany(arraysize)
+            if not batch:
+                break
+            writer.writerows(batch)
+            rows_written += len(batch)
+    return rows_written
+
+def reconcile_year(connection_string, year, cdc_file, filterCDC=False, compare_attributes=None, pushdown=True,
+                   arraysize=DEFAULT_ARRAYSIZE, engine='python', state_csv=None, progress=None, cache=None, refresh=False,
+                   normalizers=None, query=None):
+    """
+    Queries the State data for a year and compares it against a CDC file. With the python engine the rows go
+    straight from the cursor into the comparison, state.csv is only written if a state_csv path is given.
+    The other engines read files, so for them the rows are written to state_csv first.
+    Returns (results, stats, number of State rows the query returned).
+    progress is an optional callback like compare.ProgressReporter. With a state_cache.StateCache the State data comes
+    from the cache when it has a fresh copy for the year (unless refresh is set), otherwise the query result is cached
+    on the way.
+    normalizers are the {attribute: normalizer name} of compare.reconcile. query is the text of query.sql,
+    read from the file if it is not given (a batch of reports reads it once).
+    """
+    if progress is not None:
+        progress('querying', 0)
+    pool = get_pool(connection_string)
+    if query is None:
+        query = read_query()
+    if cache is None:
+        eventCodes = compare.get_cdc_event_codes(cdc_file) if filterCDC else None
+        # The connection stays checked out of the pool until all rows are fetched
+        with pool.query(lambda conn: execute_state_query(conn, year, eventCodes, pushdown, query)) as cursor:
+            cursor.arraysize = arraysize
+            return compare_state_cursor(cursor, cdc_file, filterCDC, compare_attributes, arraysize, engine, state_csv,
+                                        progress, 'querying', normalizers)
+
+    # The cached State data is not filtered on the CDC event codes, so it can be used with any CDC file.
+    # The comparison filters on them in Python instead
+    cursor = cache.cursor(connection_target(connection_string), year, query, pushdown,
+                          lambda: pool.query(lambda conn: execute_state_query(conn, year, None, pushdown, query)),
+                          refresh, progress, arraysize)
+    return compare_state_cursor(cursor, cdc_file, filterCDC, compare_attributes, arraysize, engine, state_csv,
+                                progress, 'loading', normalizers)
+
+def filters_event_codes(filterCDC, pushdown=True, cache=None):
+    # Whether reconcile_year has the database filter the State rows on the CDC event codes (the cached State data
+    # never is). If so, a query that returns no rows just means the State data has none of the CDC file's event codes
+    return filterCDC and pushdown and cache is None
+
+def compare_state_cursor(cursor, cdc_file, filterCDC, compare_attributes, arraysize, engine, state_csv, progress, state_phase,
+                         normalizers=None):
+    # The comparison half of reconcile_year, for State rows coming from the state database or the state cache
+    if engine != 'python':
+        rows_read = write_state_csv(cursor, state_csv, arraysize)
+        run_results, run_stats = compare.reconcile(cdc_file, state_csv, filterCDC, compare_attributes, engine, progress=progress,
+                                                     normalizers=normalizers)
+        return run_results, run_stats, rows_read
+
+    reconciler = compare.Reconciler(progress, normalizers)
+    column_names = [col[0] for col in cursor.description]
+    if state_csv is None:
+        reconciler.run_rows(cdc_file, column_names, iter_state_rows(cursor, arraysize), filterCDC, compare_attributes, state_phase)
+    else:
+        with open(state_csv, "w", newline='') as f:
+            reconciler.run_rows(cdc_file, column_names, iter_state_rows(cursor, arraysize, csv.writer(f)), filterCDC,
+                                compare_attributes, state_phase)
+
+    return reconciler.results, reconciler.stats, reconciler.counters['stateRowsRead']
@@ -0,0 +1,280 @@
+import csv
+import heapq
+import itertools
+import os
+import tempfile
+
+from compare import CaseResult, parse_add_time, resolve_normalizers
+
+# Default memory ceiling (in MB) for the rows that are held before they are sorted and spilled to disk
+DEFAULT_MEMORY_LIMIT = 256
+
+# Rough per-row overhead of a Python list of strings, used to estimate how much memory a chunk takes up
+ROW_OVERHEAD = 64
+FIELD_OVERHEAD = 56
+
+# Results are written out in the same order as compare.Reconciler: CDC duplicates first,
+# then the State cases in the order they appear, then the cases missing from the State side
+DUPLICATE_PHASE = 0
+STATE_PHASE = 1
+MISSING_STATE_PHASE = 2
+
+def estimate_size(row):
+    return ROW_OVERHEAD + sum(map(len, row)) + FIELD_OVERHEAD * len(row)
+
+class ExternalSorter:
+    """
+    Sorts rows that do not fit in memory. Rows are collected until the memory limit is hit, then the chunk
+    is sorted and spilled to a temporary CSV file. Iterating the sorter merges all chunks back together.
+    """
+    def __init__(self, temp_dir, name, memory_limit, key):
+        self.temp_dir = temp_dir
+        self.name = name
+        self.memory_limit = memory_limit
+        self.key = key
+        self.chunk = []
+        self.chunk_size = 0
+        self.chunk_files = []
+
+    def add(self, row):
+        self.chunk.append(row)
+        self.chunk_size += estimate_size(row)
+        if self.chunk_size >= self.memory_limit:
+            self.spill()
+
+    def spill(self):
+        if not self.chunk:
+            return
+        self.chunk.sort(key=self.key)
+        chunk_file = os.path.join(self.temp_dir, f"{self.name}-{len(self.chunk_files)}.csv")
+        with open(chunk_file, 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerows(self.chunk)
+        self.chunk_files.append(chunk_file)
+        self.chunk = []
+        self.chunk_size = 0
+
+    def read_chunk(self, chunk_file):
+        with open(chunk_file, newline='', encoding='utf-8') as f:
+            for row in csv.reader(f):
+                yield row
+
+    def __iter__(self):
+        # Everything fit in memory, so there is no need to go through the disk
+        if not self.chunk_files:
+            self.chunk.sort(key=self.key)
+            return iter(self.chunk)
+
+        self.spill()
+        return heapq.merge(*(self.read_chunk(chunk_file) for chunk_file in self.chunk_files), key=self.key)
+
+def case_key(row):
+    # Spilled rows are [CaseID, position, ...columns]
+    return (row[0], int(row[1]))
+
+def result_key(row):
+    # Spilled results are [phase, position, ...CaseResult fields]
+    return (int(row[0]), int(row[1]))
+
+def sorted_rows(file_path, sorter, keep_row=None):
+    """
+    Feeds every row of a CSV file into the sorter as [CaseID, position, ...columns] and returns the header.
+    """
+    with open(file_path, newline='', encoding='utf-8-sig') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, [])
+        case_index = header.index('CaseID')
+        # Blank lines are skipped like csv.DictReader (and compare.read_records) skips them
+        for position, row in enumerate(row for row in reader if row):
+            # Short rows are padded with empty values so every column can be looked up
+            if len(row) < len(header):
+                row += [""] * (len(header) - len(row))
+            if keep_row is not None and not keep_row(row):
+                continue
+            sorter.add([row[case_index], str(position)] + row)
+    return header
+
+def group_by_case(rows):
+    # Rows come in sorted by (CaseID, position), so every case is one consecutive group
+    return itertools.groupby(rows, key=lambda row: row[0])
+
+def reconcile(cdc_file, state_file, filterCDC=False, compare_attributes=None, memory_limit=DEFAULT_MEMORY_LIMIT, temp_dir=None,
+              normalizers=None):
+    """
+    Bounded memory engine for compare.reconcile. Both files are sorted on CaseID in chunks that are spilled to disk,
+    then merge-joined in a single pass. Returns an iterator over the results (in the same order as the other engines)
+    and the stats dictionary. The results iterator has to be consumed to clean up the temporary files.
+    """
+    memory_limit = memory_limit * 1024 * 1024
+    work_dir = tempfile.mkdtemp(prefix="reconcile-", dir=temp_dir)
+    try:
+        stats, results_sorter = merge_join(cdc_file, state_file, filterCDC, compare_attributes, memory_limit, work_dir,
+                                            resolve_normalizers(normalizers))
+    except BaseException:
+        remove_dir(work_dir)
+        raise
+
+    def iterate_results():
+        try:
+            for row in results_sorter:
+                yield CaseResult(*row[2:])
+        finally:
+            remove_dir(work_dir)
+
+    return iterate_results(), stats
+
+def remove_dir(work_dir):
+    for name in os.listdir(work_dir):
+        os.remove(os.path.join(work_dir, name))
+    os.rmdir(work_dir)
+
+def new_stats(eventName):
+    return {'eventName': eventName, 'totalCases': 0, 'totalDuplicates': 0, 'totalMissingCDC': 0, 'totalMissingState': 0, 'totalWrongAttributes': 0}
+
+def column_indexes(header, columns):
+    # Spilled rows start with [CaseID, position], so every column is shifted by two
+    return [header.index(column) + 2 for column in columns]
+
+def merge_join(cdc_file, state_file, filterCDC, compare_attributes, memory_limit, work_dir, normalizers):
+    # The CDC, State and results sorters can all hold a chunk at the same time, so they split the memory limit
+    memory_limit = memory_limit // 3
+
+    with open(cdc_file, newline='', encoding='utf-8-sig') as csvfile:
+        cdc_header = next(csv.reader(csvfile), [])
+    with open(state_file, newline='', encoding='utf-8-sig') as csvfile:
+        state_header = next(csv.reader(csvfile), [])
+
+    result_columns = ['EventCode', 'EventName', 'MMWRYear', 'MMWRWeek', 'CaseClassStatus']
+    cdc_columns = column_indexes(cdc_header, result_columns)
+    state_columns = column_indexes(state_header, result_columns + ['add_time'])
+    state_add_time = state_columns.pop()
+    cdc_code, cdc_name = cdc_columns[0] - 2, cdc_columns[1] - 2
+    state_code = state_columns[0] - 2
+
+    # Determine which attributes to compare: specified ones or all, and where they are in each row
+    attributes_to_compare = compare_attributes if compare_attributes is not None else state_header
+    compare_plan = [(attribute, state_header.index(attribute) + 2, cdc_header.index(attribute) + 2, normalizers.get(attribute))
+                    for attribute in attributes_to_compare if attribute in cdc_header]
+
+    # The CDC side is sorted first, it also tells us which event codes to keep on the State side
+    cdc_stats = {}
+    cdcEventCodes = set() if filterCDC else None
+
+    def track_cdc_row(row):
+        # Stats for the CDC event codes are created in the order the codes first show up in the file
+        if row[cdc_code] not in cdc_stats:
+            cdc_stats[row[cdc_code]] = new_stats(row[cdc_name])
+        if filterCDC:
+            cdcEventCodes.add(row[cdc_code])
+        return True
+
+    def keep_state_row(row):
+        # If the EventCode is not a number, skip the row (Getting rid of values like MAPPING and ZT_PP_Condition3)
+        if not row[state_code].isnumeric():
+            return False
+        # Here we are filtering out the rows of the database by the event code that they have
+        return cdcEventCodes is None or row[state_code] in cdcEventCodes
+
+    cdc_sorter = ExternalSorter(work_dir, "cdc", memory_limit, case_key)
+    sorted_rows(cdc_file, cdc_sorter, track_cdc_row)
+    state_sorter = ExternalSorter(work_dir, "state", memory_limit, case_key)
+    sorted_rows(state_file, state_sorter, keep_state_row)
+
+    results_sorter = ExternalSorter(work_dir, "results", memory_limit, result_key)
+
+    def add_result(phase, position, caseID, columns, row, reason, reasonID):
+        eventCode, eventName, MMWRYear, MMWRWeek, caseClassStatus = (row[i] for i in columns[:5])
+        results_sorter.add([str(phase), position, caseID, eventCode, eventName, MMWRYear, MMWRWeek, reason, reasonID, caseClassStatus])
+
+    # State only event codes go after the CDC ones, in the order compare.comp would first reach them
+    state_stats = {}
+    state_code_position = {}
+
+    def get_stats(eventCode, eventName, position):
+        if eventCode in cdc_stats:
+            return cdc_stats[eventCode]
+        if eventCode not in state_stats:
+            state_stats[eventCode] = new_stats(eventName)
+            state_code_position[eventCode] = position
+        elif position < state_code_position[eventCode]:
+            state_stats[eventCode]['eventName'] = eventName
+            state_code_position[eventCode] = position
+        return state_stats[eventCode]
+
+    for caseID, cdc_rows, state_rows in join_cases(group_by_case(cdc_sorter), group_by_case(state_sorter)):
+        if cdc_rows:
+            cdc_row = cdc_rows[0]
+            for duplicate_row in cdc_rows[1:]:
+                add_result(DUPLICATE_PHASE, duplicate_row[1], caseID, cdc_columns, duplicate_row, "Duplicate CaseID found in CDC dataset", "1")
+                # adding duplicates to duplicate count if needed
+                cdc_stats[duplicate_row[cdc_columns[0]]]['totalDuplicates'] += 1
+
+        if not state_rows:
+            # The case is only in the CDC dataset, mark it as a missing case on the state side
+            add_result(MISSING_STATE_PHASE, cdc_row[1], caseID, cdc_columns, cdc_row, "CaseID not found in State dataset", "4")
+            cdc_stats[cdc_row[cdc_columns[0]]]['totalMissingState'] += 1
+            cdc_stats[cdc_row[cdc_columns[0]]]['totalCases'] += 1
+            continue
+
+        # Keep the State row with the most recent add_time, the first one wins if there is a tie
+        state_row = state_rows[0]
+        latest_time = None
+        for row in state_rows[1:]:
+            # Rows from the Person_race join share the same add_time, so only parse when it differs
+            if row[state_add_time] == state_row[state_add_time]:
+                continue
+            if latest_time is None:
+                latest_time = parse_add_time(state_row[state_add_time])
+            new_time = parse_add_time(row[state_add_time])
+            if new_time > latest_time:
+                state_row, latest_time = row, new_time
+
+        # The case is ordered by where its CaseID first shows up, not by the row that was kept
+        position = state_rows[0][1]
+        case_stats = get_stats(state_row[state_columns[0]], state_row[state_columns[1]], int(position))
+        case_stats['totalCases'] += 1
+
+        if not cdc_rows:
+            add_result(STATE_PHASE, position, caseID, state_columns, state_row, "CaseID not found in CDC dataset", "2")
+            case_stats['totalMissingCDC'] += 1
+            continue
+
+        att_list = []
+        for attribute, state_index, cdc_index, normalize in compare_plan:
+            state_value, cdc_value = state_row[state_index], cdc_row[cdc_index]
+            if normalize is not None:
+                state_value = normalize(state_value) if state_value else state_value
+                cdc_value = normalize(cdc_value) if cdc_value else cdc_value
+            # Empty values count as NULL on both sides
+            if (state_value or "NULL") != (cdc_value or "NULL"):
+                att_list.append(attribute)
+
+        if att_list:
+            wrong_attribute_string = ", ".join(att_list)
+            reason_string = f"Case differs on {wrong_attribute_string} between State and CDC datasets"
+            add_result(STATE_PHASE, position, caseID, state_columns, state_row, reason_string, "3")
+            case_stats['totalWrongAttributes'] += 1
+
+    stats = dict(cdc_stats)
+    for eventCode in sorted(state_stats, key=state_code_position.get):
+        stats[eventCode] = state_stats[eventCode]
+
+    return stats, results_sorter
+
+def join_cases(cdc_groups, state_groups):
+    """
+    Full outer merge join of two CaseID sorted group streams. Yields (CaseID, cdc_rows, state_rows)
+    where either list is empty if the case is missing from that side.
+    """
+    cdc_case = next(cdc_groups, None)
+    state_case = next(state_groups, None)
+    while cdc_case is not None or state_case is not None:
+        if state_case is None or (cdc_case is not None and cdc_case[0] < state_case[0]):
+            yield cdc_case[0], list(cdc_case[1]), []
+            cdc_case = next(cdc_groups, None)
+        elif cdc_case is None or state_case[0] < cdc_case[0]:
+            yield state_case[0], [], list(state_case[1])
+            state_case = next(state_groups, None)
+        else:
+            yield cdc_case[0], list(cdc_case[1]), list(state_case[1])
+            cdc_case = next(cdc_groups, None)
+            state_case = next(state_groups, None)
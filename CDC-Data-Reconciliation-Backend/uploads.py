@@ -0,0 +1,108 @@
+import csv
+import hashlib
+import zlib
+
+# Saving uploaded CSV files to disk for server.py, without ever holding a whole file in memory
+
+# Uploads are read and written in chunks of this many bytes
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# The header row has to end within this many bytes, anything longer is not a CSV file we can use
+MAX_HEADER_SIZE = 64 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+class UploadError(Exception):
+    pass
+
+class GzipStream:
+    """
+    Decompresses a gzip file chunk by chunk, including files made of several gzip members (e.g. concatenated .gz files).
+    """
+    def __init__(self) -> None:
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def decompress(self, data):
+        output = []
+        while data:
+            output.append(self.decompressor.decompress(data))
+            data = self.decompressor.unused_data
+            if data:
+                # The member ended inside this chunk, the rest belongs to the next member
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return b''.join(output)
+
+    def finished(self):
+        return self.decompressor.eof
+
+def check_header(header_line, required_columns, name):
+    try:
+        text = header_line.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise UploadError(f"The {name} file is not a UTF-8 CSV file")
+    header = next(csv.reader([text]), [])
+    missing = [column for column in required_columns if column not in header]
+    if missing:
+        raise UploadError(f"The {name} file is missing the column(s): {', '.join(missing)}")
+
+async def save_upload(upload, save_to, required_columns, name):
+    """
+    Streams an uploaded CSV file to save_to, unzipping it on the way if it is gzip compressed. The header is checked
+    for the required columns as soon as it has come in, so a wrong file fails before the rest of it is copied.
+    Returns the sha256 of the (uncompressed) contents and the number of rows after the header.
+    Raises UploadError if the file is missing, empty, not valid gzip or does not have the required columns.
+    """
+    if upload is None:
+        raise UploadError(f"The {name} file was not uploaded")
+
+    digest = hashlib.sha256()
+    gzip_stream = None
+    header = b''
+    header_checked = False
+    lines = 0
+    size = 0
+    last_byte = b''
+
+    with open(save_to, 'wb') as f:
+        while True:
+            chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            if size == 0 and gzip_stream is None and chunk.startswith(GZIP_MAGIC):
+                gzip_stream = GzipStream()
+            if gzip_stream is not None:
+                try:
+                    chunk = gzip_stream.decompress(chunk)
+                except zlib.error:
+                    raise UploadError(f"The {name} file is not a valid gzip file")
+                if not chunk:
+                    continue
+
+            if not header_checked:
+                header += chunk
+                end = header.find(b'\n')
+                if end >= 0:
+                    check_header(header[:end].rstrip(b'\r'), required_columns, name)
+                    header_checked = True
+                    header = b''
+                elif len(header) > MAX_HEADER_SIZE:
+                    raise UploadError(f"The {name} file does not start with a CSV header")
+
+            f.write(chunk)
+            digest.update(chunk)
+            lines += chunk.count(b'\n')
+            size += len(chunk)
+            last_byte = chunk[-1:]
+
+    if gzip_stream is not None and not gzip_stream.finished():
+        raise UploadError(f"The {name} file is a truncated gzip file")
+    if size == 0:
+        raise UploadError(f"The {name} file is empty")
+    if not header_checked:
+        # The file is only a header without a line break
+        check_header(header.rstrip(b'\r'), required_columns, name)
+
+    # The last row does not always end with a line break
+    if last_byte != b'\n':
+        lines += 1
+    return digest.hexdigest(), lines - 1
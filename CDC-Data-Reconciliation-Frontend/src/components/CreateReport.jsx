@@ -15,6 +15,7 @@ export default function CreateReport({ onDone }) {
     "Sex", "BirthDate", "Age", "AgeType", "Race", "Ethnicity"
   ])
   const [reportName, setReportName] = useState('')
+  const [job, setJob] = useState(null)
 
   const currYear = 2023
   const yearList = Array.from({ length: 101}, (_, index) => currYear + index)
@@ -59,6 +60,42 @@ export default function CreateReport({ onDone }) {
     ).join(errors.length > 2 ? ", " : ", ").replace(/, (?=[^,]*$)/, ", and ") + "."
   }
 
+  // Reports are created in the background, so follow the job until it is done
+  const waitForJob = async (jobId) => {
+    while (true) {
+      const response = await fetch(config.API_URL + `/jobs/${jobId}`)
+      const status = await response.json()
+      if (!response.ok) {
+        throw new Error(status.detail)
+      }
+      setJob(status)
+      if (status.status === "completed" || status.status === "failed" || status.status === "cancelled") {
+        setJob(null)
+        return status
+      }
+      await new Promise(resolve => setTimeout(resolve, 1000))
+    }
+  }
+
+  const handleCancelJob = async () => {
+    try {
+      await fetch(config.API_URL + `/jobs/${job.id}`, { method: "DELETE" })
+    } catch (e) {
+      console.error("Error cancelling report - " + e)
+    }
+  }
+
+  const handleJobDone = (status) => {
+    if (status.status === "completed") {
+      console.log("Report created successfully!")
+      onDone()
+    } else if (status.status === "failed") {
+      console.error("Failed to create report!")
+      setShowError(true)
+      setErrorMessage(status.error)
+    }
+  }
+
   const handleSubmit = async (e) => {
     e.preventDefault()
 
@@ -105,8 +142,9 @@ export default function CreateReport({ onDone }) {
         })
 
         if (response.ok) {
-          console.log("Automatic report fetched successfully!")
-          onDone()
+          console.log("Automatic report queued successfully!")
+          const res = await response.json()
+          handleJobDone(await waitForJob(res.jobId))
         } else {
           console.error("Failed to fetch automatic report!")
           setShowError(true)
@@ -157,7 +195,8 @@ export default function CreateReport({ onDone }) {
 
         if (response.ok) {
           console.log("Files uploaded successfully!")
-          onDone()
+          const res = await response.json()
+          handleJobDone(await waitForJob(res.jobId))
         } else {
           console.error("Files failed to upload!")
           setShowError(true)
@@ -175,8 +214,30 @@ export default function CreateReport({ onDone }) {
         }
       }
     }
+    setJob(null)
   }
 
+  const JobProgress = ({ job }) => (
+    <div className="mt-4 text-center">
+      <p className="font-bold">
+        {job.status === "queued" ? "Waiting for other reports to finish..." :
+         job.status === "cancelling" ? "Cancelling..." :
+         `${job.phase ? job.phase.charAt(0).toUpperCase() + job.phase.slice(1) : "Starting"}...`}
+      </p>
+      {job.rowsProcessed > 0 && (
+        <p>
+          {job.rowsProcessed.toLocaleString()}{job.rowsTotal ? ` / ${job.rowsTotal.toLocaleString()}` : ""} rows
+          {job.etaSeconds !== null && `, about ${Math.ceil(job.etaSeconds)}s left`}
+        </p>
+      )}
+      <Button
+        text='Cancel'
+        className='px-4 py-2 mt-2'
+        onClick={handleCancelJob}>
+      </Button>
+    </div>
+  )
+
   const Error = ({ message }) => (
     <>
       {/* Overlay div */}
@@ -316,6 +377,7 @@ export default function CreateReport({ onDone }) {
                 onClick={() => {}}
                 className='px-4 py-2 w-20'>
               </Button>
+              {job && <JobProgress job={job} />}
             </div>
           </div>
         </form>
@@ -1,4 +1,4 @@
-import { useState, useEffect, useMemo } from "react"
+import { useState, useEffect, useMemo, useRef } from "react"
 import DebouncedInput from "./DebouncedInput"
 import Button from "../components/Button"
 import Filter from "./Filter"
@@ -25,14 +25,39 @@ import {
   flexRender,
 } from "@tanstack/react-table"
 
+// The discrepancies are fetched from the server a page at a time as the table is scrolled,
+// and only the rows in view (plus a few on either side) are rendered
+const CASE_PAGE_SIZE = 200
+const CASE_ROW_HEIGHT = 33
+const CASE_TABLE_HEIGHT = 500
+const CASE_OVERSCAN = 10
+
+// Query parameter of the cases endpoint for each filterable column
+const CASE_FILTER_PARAMS = {
+  CaseID: "caseIdPrefix",
+  EventCode: "eventCode",
+  CaseClassStatus: "caseClassStatus",
+  MMWRWeek: "mmwrWeek",
+  ReasonID: "reasonId",
+}
+
 export default function Report({ reportID }) {
-  const [results, setResults] = useState(null)
+  const [caseCount, setCaseCount] = useState(null)
+  const [delta, setDelta] = useState(null)
+  const [cases, setCases] = useState([])
+  const [casesTotal, setCasesTotal] = useState(0)
+  const [nextCursor, setNextCursor] = useState(null)
+  const [loadingCases, setLoadingCases] = useState(false)
+  const [scrollTop, setScrollTop] = useState(0)
+  const casesRequest = useRef(0)
+  const casesScroll = useRef(null)
   const [statistics, setStatistics] = useState(null)
   const [totalStatistics, setTotalStatistics] = useState({})
   const [showDiseaseStats, setShowDiseaseStats] = useState(false)
 
   const [discColumnFilters, setDiscColumnFilters] = useState([])
   const [discGlobalFilter, setDiscGlobalFilter] = useState("")
+  const [discSorting, setDiscSorting] = useState([])
 
   const [statColumnFilters, setStatColumnFilters] = useState([])
   const [statGlobalFilter, setStatGlobalFilter] = useState("")
@@ -55,6 +80,7 @@ export default function Report({ reportID }) {
     {
       header: "EventName",
       accessorKey: "EventName",
+      enableColumnFilter: false,
       footer: (props) => props.column.id,
     },
     {
@@ -67,6 +93,7 @@ export default function Report({ reportID }) {
       header: "MMWRYear",
       accessorFn: (row) => row.MMWRYear.toString(),
       id: "MMWRYear",
+      enableColumnFilter: false,
       footer: (props) => props.column.id,
     },
     {
@@ -78,6 +105,7 @@ export default function Report({ reportID }) {
     {
       header: "Reason",
       accessorKey: "Reason",
+      enableColumnFilter: false,
       footer: (props) => props.column.id,
     },
     {
@@ -163,18 +191,19 @@ export default function Report({ reportID }) {
     },
   ])
 
+  // Filtering and sorting happen on the server, the table only shows the rows that have been fetched
   const discTable = useReactTable({
-    data: results,
+    data: cases,
     columns: discColumns,
     state: {
       columnFilters: discColumnFilters,
       globalFilter: discGlobalFilter,
+      sorting: discSorting,
     },
-    initialState: {
-      pagination: {
-        pageSize: 5,
-      },
-    },
+    manualFiltering: true,
+    manualSorting: true,
+    enableMultiSort: false,
+    onSortingChange: setDiscSorting,
     onColumnFiltersChange: (columnFilters) => {
       if (diseaseStatClicked) {
         setDiseaseStatClicked(false)
@@ -194,11 +223,6 @@ export default function Report({ reportID }) {
       setDiscGlobalFilter(filter)
     },
     getCoreRowModel: getCoreRowModel(),
-    getFilteredRowModel: getFilteredRowModel(),
-    getSortedRowModel: getSortedRowModel(),
-    getPaginationRowModel: getPaginationRowModel(),
-    getFacetedRowModel: getFacetedRowModel(),
-    getFacetedUniqueValues: getFacetedUniqueValues(),
   })
 
   const statTable = useReactTable({
@@ -225,7 +249,8 @@ export default function Report({ reportID }) {
 
   useEffect(() => {
     setStatistics(null)
-    setResults(null)
+    setCaseCount(null)
+    setDelta(null)
     setTotalStatistics(null)
     const fetchReportStatistics = async () => {
       try {
@@ -262,43 +287,117 @@ export default function Report({ reportID }) {
       }
     }
 
+    // Asking for a single case is enough to get the total number of cases in the report
+    const fetchCaseCount = async () => {
+      try {
+        const response = await fetch(config.API_URL + `/reports/${reportID}/cases?limit=1`)
+        if (response.ok) {
+          const data = await response.json()
+          setCaseCount(data.total)
+        } else {
+          console.error("Failed to fetch report!")
+        }
+      } catch (e) {
+        console.error("Error fetching report - " + e)
+      }
+    }
+
+    // Only the counts of what changed since the previous report of the same kind, if there was one
+    const fetchDelta = async () => {
+      try {
+        const response = await fetch(config.API_URL + `/reports/${reportID}/delta?limit=0`)
+        if (response.ok) {
+          setDelta(await response.json())
+        }
+      } catch (e) {
+        console.error("Error fetching report changes - " + e)
+      }
+    }
+
     if (reportID) {
       fetchReportStatistics()
-      fetchReport(reportID)
+      fetchCaseCount()
+      fetchDelta()
     }
   }, [reportID])
 
-  const fetchReport = async (reportID) => {
+  // Start over from the first page whenever the report, filters or sorting change
+  useEffect(() => {
+    setCases([])
+    setNextCursor(null)
+    setScrollTop(0)
+    if (casesScroll.current) {
+      casesScroll.current.scrollTop = 0
+    }
+    if (reportID) {
+      fetchCases(null)
+    }
+  }, [reportID, discColumnFilters, discGlobalFilter, discSorting])
+
+  const casesQuery = (cursor) => {
+    const params = new URLSearchParams({ limit: CASE_PAGE_SIZE })
+    discColumnFilters.forEach((filter) => {
+      if (filter.value !== "") {
+        params.append(CASE_FILTER_PARAMS[filter.id], filter.value)
+      }
+    })
+    if (discGlobalFilter) {
+      params.append("search", discGlobalFilter)
+    }
+    if (discSorting.length > 0) {
+      params.append("sort", discSorting[0].id)
+      params.append("order", discSorting[0].desc ? "desc" : "asc")
+    }
+    if (cursor) {
+      params.append("cursor", cursor)
+    }
+    return params.toString()
+  }
+
+  const fetchCases = async (cursor) => {
+    // Responses for an older set of filters are dropped
+    const request = cursor ? casesRequest.current : ++casesRequest.current
+    setLoadingCases(true)
     try {
-      const response = await fetch(config.API_URL + "/reports/" + reportID)
-      if (response.ok) {
-        const data = await response.json()
-        setResults(data)
-      } else {
-        console.error("Failed to fetch report!")
+      const response = await fetch(config.API_URL + `/reports/${reportID}/cases?` + casesQuery(cursor))
+      if (!response.ok) {
+        console.error("Failed to fetch report cases!")
+        return
       }
+      const data = await response.json()
+      if (request !== casesRequest.current) return
+      setCases((previous) => (cursor ? previous.concat(data.cases) : data.cases))
+      setCasesTotal(data.total)
+      setNextCursor(data.nextCursor)
     } catch (e) {
-      console.error("Error fetching report - " + e)
+      console.error("Error fetching report cases - " + e)
+    } finally {
+      if (request === casesRequest.current) {
+        setLoadingCases(false)
+      }
+    }
+  }
+
+  const handleCasesScroll = (e) => {
+    setScrollTop(e.currentTarget.scrollTop)
+    // Fetch the next page once the user gets within a screen of the end of the fetched rows
+    const scrolledTo = e.currentTarget.scrollTop + 2 * CASE_TABLE_HEIGHT
+    if (nextCursor && !loadingCases && scrolledTo >= cases.length * CASE_ROW_HEIGHT) {
+      fetchCases(nextCursor)
     }
   }
 
+  const firstVisibleCase = Math.max(0, Math.floor(scrollTop / CASE_ROW_HEIGHT) - CASE_OVERSCAN)
+  const lastVisibleCase = Math.min(cases.length, Math.ceil((scrollTop + CASE_TABLE_HEIGHT) / CASE_ROW_HEIGHT) + CASE_OVERSCAN)
+
   const toggleDiseaseStats = () => {
     setShowDiseaseStats(!showDiseaseStats)
   }
 
   const handleResultsDownload = (e) => {
-    const csvData =
-      "CaseID,EventCode,EventName,CaseClassStatus,MMWRYear,MMWRWeek,Reason,ReasonID\n" +
-      results
-        .map(
-          (result) =>
-            `${result.CaseID},${result.EventCode},"${result.EventName}","${result.CaseClassStatus}",${result.MMWRYear},${result.MMWRWeek},"${result.Reason}",${result.ReasonID}`
-        )
-        .join("\n")
-    const blob = new Blob([csvData], { type: "text/csv;charset=utf-8," })
-    const linkURL = URL.createObjectURL(blob)
+    // The server streams the whole report as results.csv, so it never has to be loaded into the page
     const linking = document.createElement("a")
-    linking.setAttribute("href", linkURL)
+    linking.setAttribute("href", config.API_URL + `/reports/${reportID}/export?format=csv`)
     linking.setAttribute("download", "Results.csv")
     linking.textContent = "Download"
 
@@ -419,11 +518,16 @@ export default function Report({ reportID }) {
 
   return (
     <div className='mt-5 py-5 px-12 mx-auto w-full max-w-[1400px] min-w-[1020px] flex flex-col items-center gap-6'>
-      {results && (
+      {caseCount !== null && (
         <>
           <div className='flex flex-col items-center mb-5'>
             <h2 className='text-2xl font-bold'>Results</h2>
-            <h3>Number of Cases Different: {results.length}</h3>
+            <h3>Number of Cases Different: {caseCount}</h3>
+            {delta && (
+              <h3>
+                Since Report {delta.since}: {delta.newDiscrepancies.total} new, {delta.resolvedDiscrepancies.total} resolved
+              </h3>
+            )}
           </div>
 
           {statistics && (
@@ -649,9 +753,14 @@ export default function Report({ reportID }) {
                 <MdFileDownload size={23} />
               </Button>
             </div>
-            <div className='border border-slate-400 rounded-xl shadow-md my-3 overflow-hidden'>
-              <table className='table-auto'>
-                <thead className='bg-[#d4e1ec]'>
+            <div
+              ref={casesScroll}
+              className='border border-slate-400 rounded-xl shadow-md my-3 overflow-y-auto'
+              style={{ height: CASE_TABLE_HEIGHT }}
+              onScroll={handleCasesScroll}
+            >
+              <table className='table-auto w-full'>
+                <thead className='bg-[#d4e1ec] sticky top-0'>
                   <tr>
                     <th colSpan={8} className="text-2xl p-2">
                       {diseaseStatClicked ? `${currentDisease} ${currentDiscType}` : 'Report Discrepancies'}
@@ -661,7 +770,7 @@ export default function Report({ reportID }) {
                     <tr key={headerGroup.id} className='border-b border-slate-400'>
                       {headerGroup.headers.map((header) => {
                         return (
-                          <th className='p-2' key={header.id} colSpan={header.colSpan}>
+                          <th className='p-2 align-top' key={header.id} colSpan={header.colSpan}>
                             {header.isPlaceholder ? null : (
                               <>
                                 <div
@@ -680,7 +789,16 @@ export default function Report({ reportID }) {
                                 </div>
                                 {header.column.getCanFilter() ? (
                                   <div>
-                                    <Filter column={header.column} table={discTable} />
+                                    <DebouncedInput
+                                      type='text'
+                                      value={header.column.getFilterValue() ?? ""}
+                                      onChange={(value) => {
+                                        if (header.column.getFilterValue() === value) return
+                                        header.column.setFilterValue(String(value))
+                                      }}
+                                      placeholder={header.column.id === "CaseID" ? "Starts with..." : "Equals..."}
+                                      className='border shadow rounded w-full px-2 font-normal'
+                                    />
                                   </div>
                                 ) : null}
                               </>
@@ -692,17 +810,13 @@ export default function Report({ reportID }) {
                   ))}
                 </thead>
                 <tbody>
-                  {discTable.getRowModel().rows.map((row, index) => {
+                  <tr style={{ height: firstVisibleCase * CASE_ROW_HEIGHT }} />
+                  {discTable.getRowModel().rows.slice(firstVisibleCase, lastVisibleCase).map((row) => {
                     return (
-                      <tr
-                        {...{
-                          className: index < discTable.getRowModel().rows.length - 1 ? "border-b border-slate-400" : "",
-                        }}
-                        key={row.id}
-                      >
+                      <tr className='border-b border-slate-400' style={{ height: CASE_ROW_HEIGHT }} key={row.id}>
                         {row.getVisibleCells().map((cell) => {
                           return (
-                            <td className='p-1' key={cell.id}>
+                            <td className='p-1 whitespace-nowrap' key={cell.id}>
                               {flexRender(cell.column.columnDef.cell, cell.getContext())}
                             </td>
                           )
@@ -710,69 +824,12 @@ export default function Report({ reportID }) {
                       </tr>
                     )
                   })}
+                  <tr style={{ height: (cases.length - lastVisibleCase) * CASE_ROW_HEIGHT }} />
                 </tbody>
               </table>
             </div>
             <div className='flex items-center gap-2 justify-center'>
-              <button
-                className='border rounded p-1 border-slate-400'
-                onClick={() => discTable.setPageIndex(0)}
-                disabled={!discTable.getCanPreviousPage()}
-              >
-                <MdKeyboardDoubleArrowLeft className='text-xl' />
-              </button>
-              <button
-                className='border rounded p-1 border-slate-400'
-                onClick={() => discTable.previousPage()}
-                disabled={!discTable.getCanPreviousPage()}
-              >
-                <MdKeyboardArrowLeft className='text-xl' />
-              </button>
-              <button
-                className='border rounded p-1 border-slate-400'
-                onClick={() => discTable.nextPage()}
-                disabled={!discTable.getCanNextPage()}
-              >
-                <MdKeyboardArrowRight className='text-xl' />
-              </button>
-              <button
-                className='border rounded p-1 border-slate-400'
-                onClick={() => discTable.setPageIndex(discTable.getPageCount() - 1)}
-                disabled={!discTable.getCanNextPage()}
-              >
-                <MdKeyboardDoubleArrowRight className='text-xl' />
-              </button>
-              <span className='flex items-center gap-1'>
-                <div>Page</div>
-                <strong>
-                  {discTable.getState().pagination.pageIndex + 1} of {discTable.getPageCount()}
-                </strong>
-              </span>
-              <span className='flex items-center gap-1'>
-                | Go to page:
-                <input
-                  type='number'
-                  defaultValue={discTable.getState().pagination.pageIndex + 1}
-                  onChange={(e) => {
-                    const page = e.target.value ? Number(e.target.value) - 1 : 0
-                    discTable.setPageIndex(page)
-                  }}
-                  className='border p-1 rounded w-16 border-slate-400'
-                />
-              </span>
-              <select
-                className='border p-1 rounded border-slate-400'
-                value={discTable.getState().pagination.pageSize}
-                onChange={(e) => {
-                  discTable.setPageSize(Number(e.target.value))
-                }}
-              >
-                {[5, 10, 20, 30, 40, 50, 100].map((pageSize) => (
-                  <option key={pageSize} value={pageSize}>
-                    Show {pageSize}
-                  </option>
-                ))}
-              </select>
+              Showing {cases.length} of {casesTotal} cases{loadingCases && ", loading..."}
             </div>
           </div>
         </>